@@ -0,0 +1,331 @@
+"""Admission control for generations: how many run at once, who waits, and what may be spent.
+
+Every story or narration a session asks for needs a ticket. While fewer than
+max_running generations run in this process the ticket is admitted at once;
+otherwise it waits in a bounded FIFO queue and is admitted when a slot frees
+up. The generations that do run keep their usual latency instead of all of
+them slowing down together past the rate limit. A session holds at most one
+ticket, and a waiting ticket keeps its place only while its page is open.
+
+Under load the app degrades step by step (see level()): stories are made
+without narration, then requests wait in line, then - with the queue full or
+the budget spent - a pre-generated story is served instead of a new one.
+
+Hourly and daily token and cost budgets are counted in the backend, so with a
+shared backend they are one budget for all replicas; slots and the queue are
+per process.
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+
+from backends import get_backend
+from clients import get_secret
+
+logger = logging.getLogger(__name__)
+
+# Degradation steps, from none to the last resort
+NORMAL = "normal"      # story and narration
+NO_AUDIO = "no_audio"  # most slots taken: stories without narration, it is made only on request
+QUEUE = "queue"        # every slot taken: new requests wait in line
+SHED = "shed"          # queue full or budget spent: a pre-generated story or "try again later"
+
+# Ticket states
+WAITING = "waiting"
+ADMITTED = "admitted"
+RELEASED = "released"
+DROPPED = "dropped"
+
+# Why a request got no ticket
+BUSY = "busy"        # the session already has a generation running or waiting
+FULL = "full"        # no free slot and no room (or too long a wait) in the queue
+BUDGET = "budget"    # hourly or daily budget spent
+
+
+class AdmissionRejected(Exception):
+    """No ticket for this request; reason is BUSY, FULL or BUDGET."""
+
+    def __init__(self, reason, detail=None):
+        super().__init__(detail or reason)
+        self.reason = reason
+
+
+class Budget:
+    """Token and cost limits per UTC hour and day (0 = no limit), counted in backend.
+
+    exhausted() is read on every request, so the counters are cached for
+    refresh seconds; a replica may overshoot a limit by what it spends in that time.
+    """
+
+    WINDOWS = (("hour", "%Y%m%d%H", 3600), ("day", "%Y%m%d", 86400))
+
+    def __init__(self, backend, hourly_tokens=0, daily_tokens=0, hourly_usd=0.0, daily_usd=0.0, refresh=2.0):
+        self.backend = backend
+        self.limits = {
+            ("hour", "tokens"): hourly_tokens, ("day", "tokens"): daily_tokens,
+            ("hour", "usd"): hourly_usd, ("day", "usd"): daily_usd,
+        }
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._spent = None
+        self._read_at = 0.0
+
+    def _keys(self, unit):
+        now = time.gmtime()
+        return [(window, f"budget:{window}:{unit}:{time.strftime(stamp, now)}", seconds)
+                for window, stamp, seconds in self.WINDOWS]
+
+    def charge(self, tokens=0, usd=0.0):
+        """Count what a generation spent."""
+        try:
+            for unit, amount in (("tokens", tokens), ("usd", usd)):
+                if amount:
+                    for _, key, seconds in self._keys(unit):
+                        # Kept a while past the window's end - the admin page shows the last one too
+                        self.backend.incr(key, amount, seconds * 2)
+        except Exception as e:
+            logger.error("Budget not charged: %s", e)
+        with self._lock:
+            self._spent = None
+
+    def spent(self):
+        """{(window, unit): amount spent in the current hour and day}"""
+        with self._lock:
+            if self._spent is not None and time.monotonic() - self._read_at < self.refresh:
+                return self._spent
+        spent = {}
+        for unit in ("tokens", "usd"):
+            for window, key, _ in self._keys(unit):
+                value = self.backend.get(key)
+                spent[(window, unit)] = float(value) if value is not None else 0.0
+        with self._lock:
+            self._spent, self._read_at = spent, time.monotonic()
+        return spent
+
+    def exhausted(self):
+        """The first spent limit as "window:unit", or None."""
+        if not any(self.limits.values()):
+            return None
+        try:
+            spent = self.spent()
+        except Exception as e:
+            # Better to serve than to stop everything while the backend is away
+            logger.warning("Budget not read: %s", e)
+            return None
+        for (window, unit), limit in self.limits.items():
+            if limit and spent[(window, unit)] >= limit:
+                return f"{window}:{unit}"
+        return None
+
+
+class Ticket:
+    """One session's place: waiting in the queue, or admitted and holding a slot."""
+
+    def __init__(self, owner, kind, alive=None):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.kind = kind
+        self.alive = alive
+        self.status = WAITING
+        self.created_at = self.seen_at = time.monotonic()
+        self.admitted_at = None
+        self.started = False
+        # Decided when admitted: narrate along, or leave narration for later
+        self.with_audio = True
+
+    @property
+    def admitted(self):
+        return self.status == ADMITTED
+
+    @property
+    def waited(self):
+        """Seconds spent in the queue before admission."""
+        return (self.admitted_at or time.monotonic()) - self.created_at
+
+
+class AdmissionController:
+    """Slots for running generations, a bounded wait queue in front of them and the budget.
+
+    max_running - generations running at once (match JOB_WORKERS, so admitted jobs never wait for a worker)
+    max_queue - tickets waiting at most; max_wait - estimated wait beyond which a request isn't queued
+    no_audio_at - share of slots taken from which stories are made without narration
+    abandon_after - seconds a waiting (or admitted, not started) ticket is kept without being polled
+    max_hold - seconds after which an admitted ticket's slot is taken back even if never released
+    """
+
+    def __init__(self, max_running=8, max_queue=20, max_wait=90.0, no_audio_at=0.75, budget=None,
+                 abandon_after=30.0, max_hold=900.0, service_seconds=30.0):
+        self.max_running = max_running
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.no_audio_at = no_audio_at
+        self.budget = budget
+        self.abandon_after = abandon_after
+        self.max_hold = max_hold
+        # Moving average of how long a slot is held - the queue's wait estimate
+        self.service_seconds = service_seconds
+        self._lock = threading.Lock()
+        self._running = {}
+        self._waiting = deque()
+        self._owners = {}
+
+    def level(self):
+        """The degradation step a new request meets now."""
+        if self.budget and self.budget.exhausted():
+            return SHED
+        with self._lock:
+            self._expire(time.monotonic())
+            if self._waiting or len(self._running) >= self.max_running:
+                return SHED if len(self._waiting) >= self.max_queue else QUEUE
+            return NO_AUDIO if len(self._running) >= self.no_audio_at * self.max_running else NORMAL
+
+    def request(self, owner, kind, wait=True, alive=None):
+        """A ticket for owner's generation - admitted, or (with wait) waiting in the queue.
+
+        alive (optional) tells whether the owner's page is still open. Raises
+        AdmissionRejected when the owner holds a ticket already, when neither
+        a slot nor a place in the queue is free, or when the budget is spent.
+        """
+        spent = self.budget.exhausted() if self.budget else None
+        if spent:
+            raise AdmissionRejected(BUDGET, f"budget {spent} spent")
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if owner in self._owners:
+                raise AdmissionRejected(BUSY)
+            ticket = Ticket(owner, kind, alive)
+            if not self._waiting and len(self._running) < self.max_running:
+                self._admit(ticket, now)
+            elif (
+                wait and len(self._waiting) < self.max_queue
+                and self._estimate(len(self._waiting) + 1) <= self.max_wait
+            ):
+                self._waiting.append(ticket)
+            else:
+                raise AdmissionRejected(FULL)
+            self._owners[owner] = ticket
+        return ticket
+
+    def poll(self, ticket):
+        """Place of a ticket: 0 once admitted, 1.. in the queue, None if released or dropped."""
+        with self._lock:
+            now = time.monotonic()
+            ticket.seen_at = now
+            self._expire(now)
+            self._promote(now)
+            if ticket.status == ADMITTED:
+                return 0
+            if ticket.status == WAITING:
+                return self._waiting.index(ticket) + 1
+            return None
+
+    def estimated_wait(self, position):
+        """Seconds until the ticket at position is admitted, roughly."""
+        with self._lock:
+            return self._estimate(position)
+
+    def run(self, ticket, fn, *args, **kwargs):
+        """fn(*args, **kwargs) holding ticket's slot - released when fn returns or raises."""
+        ticket.started = True
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.release(ticket)
+
+    def release(self, ticket):
+        """Give the slot or the place in the queue back (safe to call more than once)."""
+        with self._lock:
+            now = time.monotonic()
+            if ticket.status == ADMITTED:
+                self.service_seconds = 0.8 * self.service_seconds + 0.2 * (now - ticket.admitted_at)
+            self._remove(ticket, RELEASED)
+            self._promote(now)
+
+    def stats(self):
+        with self._lock:
+            self._expire(time.monotonic())
+            return {"running": len(self._running), "waiting": len(self._waiting)}
+
+    def _estimate(self, position):
+        return position * self.service_seconds / self.max_running
+
+    def _admit(self, ticket, now):
+        ticket.with_audio = len(self._running) < self.no_audio_at * self.max_running
+        ticket.status = ADMITTED
+        ticket.admitted_at = ticket.seen_at = now
+        self._running[ticket.id] = ticket
+
+    def _remove(self, ticket, status):
+        if ticket.status == ADMITTED:
+            self._running.pop(ticket.id, None)
+        elif ticket.status == WAITING and ticket in self._waiting:
+            self._waiting.remove(ticket)
+        ticket.status = status
+        if self._owners.get(ticket.owner) is ticket:
+            del self._owners[ticket.owner]
+
+    def _promote(self, now):
+        while self._waiting and len(self._running) < self.max_running:
+            self._admit(self._waiting.popleft(), now)
+
+    def _gone(self, ticket, now):
+        if now - ticket.seen_at > self.abandon_after:
+            return True
+        try:
+            return ticket.alive is not None and not ticket.alive()
+        except Exception:
+            return False
+
+    def _expire(self, now):
+        """Drop tickets of closed pages and slots never given back."""
+        for ticket in [t for t in self._waiting if self._gone(t, now)]:
+            self._remove(ticket, DROPPED)
+        for ticket in list(self._running.values()):
+            if not ticket.started and self._gone(ticket, now):
+                self._remove(ticket, DROPPED)
+            elif now - ticket.admitted_at > self.max_hold:
+                logger.warning("Admission slot of a %s held over %.0fs, taken back", ticket.kind, self.max_hold)
+                self._remove(ticket, DROPPED)
+        self._promote(now)
+
+
+_budget = None
+_budget_lock = threading.Lock()
+
+
+def get_budget():
+    """Process-wide budget (BUDGET_HOURLY_TOKENS, BUDGET_DAILY_TOKENS, BUDGET_HOURLY_USD, BUDGET_DAILY_USD)."""
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = Budget(
+                get_backend(),
+                hourly_tokens=float(get_secret("BUDGET_HOURLY_TOKENS", 0)),
+                daily_tokens=float(get_secret("BUDGET_DAILY_TOKENS", 0)),
+                hourly_usd=float(get_secret("BUDGET_HOURLY_USD", 0)),
+                daily_usd=float(get_secret("BUDGET_DAILY_USD", 0))
+            )
+    return _budget
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller():
+    """Process-wide admission controller (ADMISSION_MAX_RUNNING, ADMISSION_MAX_QUEUE,
+    ADMISSION_MAX_WAIT_SECONDS, ADMISSION_NO_AUDIO_AT)."""
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = AdmissionController(
+                max_running=int(get_secret("ADMISSION_MAX_RUNNING", get_secret("JOB_WORKERS", 8))),
+                max_queue=int(get_secret("ADMISSION_MAX_QUEUE", 20)),
+                max_wait=float(get_secret("ADMISSION_MAX_WAIT_SECONDS", 90)),
+                no_audio_at=float(get_secret("ADMISSION_NO_AUDIO_AT", 0.75)),
+                budget=get_budget()
+            )
+    return _controller
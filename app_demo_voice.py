@@ -1,14 +1,36 @@
 import os
+import re
 import sys
 import streamlit as st
-from openai import OpenAI
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import time
-import re
-from datetime import datetime, timedelta
-from langfuse.openai import openai as langfuse_openai
-from langfuse import Langfuse
-import requests
-from io import BytesIO
+import tempfile
+import uuid
+from functools import partial
+from audio_pipeline import AUDIO_MIME_TYPES, NarrationPipeline, synthesize_narration
+from audio_server import get_audio_server, preferred_format
+from assets import page_chrome
+from audio_cache import get_audio_cache
+from admission import BUDGET, BUSY, NORMAL, AdmissionRejected, get_admission_controller, get_budget
+from singleflight import get_single_flight
+from backends import get_backend
+from jobs import DONE, QUEUED, RUNNING, JobCancelled, RemoteJobError, get_job_runner
+from metrics import get_metrics
+from session_store import memory_report
+from story_library import get_story_library
+from safety import StreamGuard, UnsafeContentError, check_prompt
+from ratelimit import RateLimitTimeout, call_with_retry, estimate_tokens, get_rate_limiter, is_retryable
+from clients import get_secret, get_openai_client
+from prompts import LESSON_OPTIONS, AGE_OPTIONS
+from story_engine import (
+    STORY_MODEL, STORY_TEMPERATURE, TTS_MODEL, TTS_VOICE, TTS_FORMAT, LengthCutoff, StreamCollector,
+    continuation_request, continuation_start, finish_text, join_continuation, needs_continuation,
+    raw_prompt, story_budget, story_messages, story_record, story_stats, story_cost, tts_cost,
+    narration_cache_key
+)
+from story_pool import get_story_pool, guess_gender, fill_template
+from telemetry import Telemetry, get_telemetry
 
 # Set UTF-8 encoding for Windows to handle Polish characters
 if sys.platform == 'win32':
@@ -26,42 +48,25 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
-def get_secret(name, default=None):
-    """Pobiera sekrety najpierw ze st.secrets, a jak ich nie ma – z ENV (np. na DO)."""
-    try:
-        if name in st.secrets:
-            return st.secrets[name]
-    except Exception:
-        pass
-    return os.getenv(name, default)
+# Process-wide metrics (histograms, counters, gauges) - /metrics on METRICS_PORT and the admin page
+metrics = get_metrics()
+script_run_started = time.perf_counter()
+metrics.script_runs.inc()
 
-# Initialize Langfuse
+# Telemetry: traces are queued and exported to Langfuse by a background thread
 try:
-    langfuse_secret = get_secret("LANGFUSE_SECRET_KEY")
-    langfuse_public = get_secret("LANGFUSE_PUBLIC_KEY")
-    langfuse_host = get_secret("LANGFUSE_HOST", "https://cloud.langfuse.com")
-
-    if langfuse_secret and langfuse_public:
-        langfuse = Langfuse(
-            secret_key=langfuse_secret,
-            public_key=langfuse_public,
-            host=langfuse_host,
-        )
-    else:
-        langfuse = None
+    telemetry = get_telemetry()
 except Exception as e:
     st.error(f"Błąd inicjalizacji Langfuse: {e}")
-    langfuse = None
+    telemetry = Telemetry(None)
 
 # Initialize session state
 if 'page' not in st.session_state:
     st.session_state.page = 'landing'
-if 'story_history' not in st.session_state:
-    st.session_state.story_history = []
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 if 'current_story' not in st.session_state:
     st.session_state.current_story = None
-if 'generating' not in st.session_state:
-    st.session_state.generating = False
 if 'child_name' not in st.session_state:
     st.session_state.child_name = None
 if 'child_age' not in st.session_state:
@@ -69,578 +74,928 @@ if 'child_age' not in st.session_state:
 if 'lesson' not in st.session_state:
     st.session_state.lesson = None
 
-# Audio narration session state
-if 'generating_audio' not in st.session_state:
-    st.session_state.generating_audio = False
-if 'story_audio_data' not in st.session_state:
-    st.session_state.story_audio_data = None
-
-
-
-# Custom CSS
-st.markdown("""
-<style>
-    /* LANDING PAGE STYLES */
-    .landing-page {
-        background: linear-gradient(135deg, #1e3c72 0%, #2a5298 50%, #7e22ce 100%);
-        min-height: 100vh;
-        display: flex;
-        align-items: center;
-        justify-content: center;
-        position: relative;
-        overflow: hidden;
-    }
-    
-    /* FLOATING PARTICLES - SNOWFLAKES */
-    @keyframes float1 {
-        0% { transform: translateY(100vh) translateX(0); opacity: 0; }
-        10% { opacity: 0.8; }
-        90% { opacity: 0.8; }
-        100% { transform: translateY(-100px) translateX(30px); opacity: 0; }
-    }
-    @keyframes float2 {
-        0% { transform: translateY(100vh) translateX(0); opacity: 0; }
-        10% { opacity: 0.8; }
-        90% { opacity: 0.8; }
-        100% { transform: translateY(-100px) translateX(-30px); opacity: 0; }
-    }
-    @keyframes float3 {
-        0% { transform: translateY(100vh) translateX(0); opacity: 0; }
-        10% { opacity: 0.8; }
-        90% { opacity: 0.8; }
-        100% { transform: translateY(-100px) translateX(15px); opacity: 0; }
-    }
-    
-    .particle {
-        position: fixed;
-        width: 6px;
-        height: 6px;
-        background: rgba(255, 255, 255, 0.9);
-        border-radius: 50%;
-        box-shadow: 0 0 8px rgba(255, 255, 255, 0.8), 0 0 15px rgba(200, 230, 255, 0.6);
-        pointer-events: none;
-        z-index: 1;
-    }
-    
-    .particle:nth-child(1) { left: 10%; animation: float1 15s infinite; animation-delay: 0s; width: 4px; height: 4px; }
-    .particle:nth-child(2) { left: 20%; animation: float2 18s infinite; animation-delay: 2s; width: 6px; height: 6px; }
-    .particle:nth-child(3) { left: 30%; animation: float3 20s infinite; animation-delay: 4s; width: 5px; height: 5px; }
-    .particle:nth-child(4) { left: 40%; animation: float1 17s infinite; animation-delay: 1s; width: 7px; height: 7px; }
-    .particle:nth-child(5) { left: 50%; animation: float2 16s infinite; animation-delay: 3s; width: 4px; height: 4px; }
-    .particle:nth-child(6) { left: 60%; animation: float3 19s infinite; animation-delay: 5s; width: 6px; height: 6px; }
-    .particle:nth-child(7) { left: 70%; animation: float1 21s infinite; animation-delay: 2s; width: 5px; height: 5px; }
-    .particle:nth-child(8) { left: 80%; animation: float2 14s infinite; animation-delay: 6s; width: 7px; height: 7px; }
-    .particle:nth-child(9) { left: 90%; animation: float3 22s infinite; animation-delay: 1s; width: 4px; height: 4px; }
-    .particle:nth-child(10) { left: 15%; animation: float1 16s infinite; animation-delay: 4s; width: 6px; height: 6px; }
-    .particle:nth-child(11) { left: 25%; animation: float2 19s infinite; animation-delay: 3s; width: 5px; height: 5px; }
-    .particle:nth-child(12) { left: 35%; animation: float3 15s infinite; animation-delay: 5s; width: 7px; height: 7px; }
-    .particle:nth-child(13) { left: 45%; animation: float1 20s infinite; animation-delay: 2s; width: 4px; height: 4px; }
-    .particle:nth-child(14) { left: 55%; animation: float2 17s infinite; animation-delay: 6s; width: 6px; height: 6px; }
-    .particle:nth-child(15) { left: 65%; animation: float3 18s infinite; animation-delay: 1s; width: 5px; height: 5px; }
-    .particle:nth-child(16) { left: 75%; animation: float1 21s infinite; animation-delay: 4s; width: 7px; height: 7px; }
-    .particle:nth-child(17) { left: 85%; animation: float2 16s infinite; animation-delay: 3s; width: 4px; height: 4px; }
-    .particle:nth-child(18) { left: 95%; animation: float3 19s infinite; animation-delay: 5s; width: 6px; height: 6px; }
-    .particle:nth-child(19) { left: 12%; animation: float1 14s infinite; animation-delay: 2s; width: 5px; height: 5px; }
-    .particle:nth-child(20) { left: 88%; animation: float2 22s infinite; animation-delay: 6s; width: 7px; height: 7px; }
-    
-    /* LANDING CONTENT */
-    .landing-content {
-        text-align: center;
-        color: white;
-        z-index: 10;
-        position: relative;
-        padding: 3rem;
-    }
-    
-    .landing-title {
-        font-size: 4rem;
-        font-weight: bold;
-        margin-bottom: 1rem;
-        text-shadow: 0 0 20px rgba(255, 255, 255, 0.5), 0 0 40px rgba(200, 230, 255, 0.3);
-        animation: glow 2s ease-in-out infinite alternate;
-    }
-    
-    @keyframes glow {
-        from { text-shadow: 0 0 20px rgba(255, 255, 255, 0.5), 0 0 40px rgba(200, 230, 255, 0.3); }
-        to { text-shadow: 0 0 30px rgba(255, 255, 255, 0.8), 0 0 60px rgba(200, 230, 255, 0.5); }
-    }
-    
-    .landing-subtitle {
-        font-size: 1.5rem;
-        margin-bottom: 3rem;
-        color: rgba(255, 255, 255, 0.9);
-        text-shadow: 0 2px 4px rgba(0,0,0,0.3);
-    }
-    
-    /* GENERATOR PAGE - SIMPLIFIED STYLES */
-    .stApp {
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%) !important;
-    }
-    
-    .main .block-container {
-        padding-top: 1rem;
-        padding-bottom: 1rem;
-    }
-    
-    /* Pills styling */
-    .pill-container {
-        display: flex;
-        gap: 10px;
-        flex-wrap: wrap;
-        margin: 15px 0;
-    }
-    
-    .pill {
-        background: rgba(255, 255, 255, 0.2);
-        border: 2px solid rgba(255, 255, 255, 0.3);
-        border-radius: 25px;
-        padding: 12px 24px;
-        color: white;
-        font-size: 16px;
-        font-weight: 500;
-        cursor: pointer;
-        transition: all 0.3s ease;
-        text-align: center;
-        min-width: 150px;
-    }
-    
-    .pill:hover {
-        background: rgba(255, 255, 255, 0.3);
-        border-color: rgba(255, 255, 255, 0.5);
-        transform: translateY(-2px);
-        box-shadow: 0 4px 12px rgba(0,0,0,0.2);
-    }
-    
-    .pill.selected {
-        background: rgba(255, 255, 255, 0.9);
-        border-color: rgba(255, 255, 255, 1);
-        color: #667eea;
-        font-weight: bold;
-        box-shadow: 0 6px 20px rgba(255, 255, 255, 0.4);
-    }
-    
-    /* Text area styling */
-    .stTextArea textarea {
-        background: rgba(255, 255, 255, 0.95) !important;
-        border: 2px solid #667eea !important;
-        border-radius: 15px !important;
-        font-size: 16px !important;
-        color: #333333 !important;
-        padding: 12px !important;
-    }
-
-    .stTextArea textarea::placeholder {
-        color: #999999 !important;
-        font-weight: bold !important;
-        font-size: 16px !important;
-    }
-        
-    .stTextArea label {
-        color: white !important;
-        font-weight: bold !important;
-        font-size: 16px !important;
-    }
-    
-    /* Button styling */
-    .stButton > button {
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-        color: white;
-        border: none;
-        padding: 0.75rem 2rem;
-        border-radius: 50px;
-        font-weight: bold;
-        font-size: 18px;
-        transition: all 0.3s ease;
-        box-shadow: 0 4px 15px rgba(255, 255, 255, 0.4);
-        width: 100%;
-    }
-    
-    .stButton > button:hover {
-        transform: translateY(-4px);
-        box-shadow: 0 6px 20px rgba(57, 255, 20, 0.9);
-    }
-    
-    /* SELECTED BUTTON (primary) */
-    .stButton > button[kind="primary"] {
-        background: rgba(255, 255, 255, 0.4) !important;
-        color: white !important;
-        border: 2px solid rgba(255, 255, 255, 0.8) !important;
-        font-weight: bold !important;
-        box-shadow: 0 0 15px rgba(255, 255, 255, 0.6) !important;
-    }
-
-    /* UNSELECTED BUTTON (secondary) */
-    .stButton > button[kind="secondary"] {
-        background: rgba(255, 255, 255, 0.2) !important;
-        color: white !important;
-        border: 2px solid rgba(255, 255, 255, 0.3) !important;
-    }
-    
-    /* Story content */
-    .story-content {
-        background: rgba(255, 255, 255, 0.95);
-        padding: 2rem;
-        border-radius: 15px;
-        margin: 1rem 0;
-        color: #333;
-        line-height: 1.8;
-        font-size: 16px;
-        box-shadow: 0 10px 30px rgba(0,0,0,0.1);
-    }
-    
-    /* Section headers */
-    .section-header {
-        color: white;
-        font-size: 20px;
-        font-weight: bold;
-        margin: 25px 0 15px 0;
-        text-shadow: 0 2px 4px rgba(0,0,0,0.2);
-        text-align: center;
-    }
-    
-    /* Loading animation */
-    @keyframes pulse {
-        0% { opacity: 0.6; }
-        50% { opacity: 1; }
-        100% { opacity: 0.6; }
-    }
-    
-    .loading-text {
-        animation: pulse 1.5s infinite;
-        color: white;
-        font-size: 20px;
-        text-align: center;
-    }
-    
-    /* Hide Streamlit elements */
-    #MainMenu {visibility: hidden;}
-    footer {visibility: hidden;}
-    header {visibility: hidden;}
-</style>
-""", unsafe_allow_html=True)
+# Audio narration session state - the narration is a file reference into the
+# audio cache, never audio bytes held by the session
+if 'story_audio_path' not in st.session_state:
+    st.session_state.story_audio_path = None
+
+# Background generation job of this session - also carried in the URL (?job=...),
+# so the result is picked up again after a refresh or reconnect
+if 'job_id' not in st.session_state:
+    st.session_state.job_id = st.query_params.get("job")
+    if st.session_state.job_id:
+        st.session_state.page = 'generator'
+if 'job_error' not in st.session_state:
+    st.session_state.job_error = None
+if 'notice' not in st.session_state:
+    st.session_state.notice = None
+
+# Owner of the persistent story library - carried in the URL (?lib=...), so a
+# bookmarked link brings a parent's stories back in a new session
+if 'library_owner' not in st.session_state:
+    owner = st.query_params.get("lib", "")
+    st.session_state.library_owner = owner if re.fullmatch(r"[0-9a-f]{32}", owner) else uuid.uuid4().hex
+    st.query_params["lib"] = st.session_state.library_owner
+if 'library_cursors' not in st.session_state:
+    # before_id of every library page opened so far - None is the newest page
+    st.session_state.library_cursors = [None]
+
+# Hidden admin page with the metrics: ?admin=<ADMIN_TOKEN>
+if st.query_params.get("admin") and st.query_params.get("admin") == get_secret("ADMIN_TOKEN"):
+    st.session_state.page = 'admin'
+
+metrics.touch_session(st.session_state.session_id)
+# Full script runs of this session (fragment reruns not included)
+st.session_state.script_runs = st.session_state.get('script_runs', 0) + 1
+
+
+
+# Custom CSS and floating particles (snowflakes) - one element built once per
+# process; identical on every rerun, so after the first run the browser gets
+# only a cache reference instead of the whole stylesheet
+PAGE_PARTICLES = {'landing': 20, 'generator': 15}
+st.html(page_chrome(PAGE_PARTICLES.get(st.session_state.page, 0)))
 
 # Initialize OpenAI client
-openai_api_key = get_secret("OPENAI_API_KEY")
-if not openai_api_key:
+# Plain OpenAI client (not wrapped by Langfuse to avoid encoding issues),
+# created once per process with a pre-warmed keep-alive connection pool
+openai_client = get_openai_client()
+if not openai_client:
     st.error("Brak klucza OPENAI_API_KEY w secrets lub zmiennych środowiskowych.")
     st.stop()
 
-# Create plain OpenAI client (not wrapped by Langfuse to avoid encoding issues)
-openai_client = OpenAI(api_key=openai_api_key)
+# Ready stories for the empty-prompt path (most of our traffic), refilled in the background
+story_pool = get_story_pool(openai_client) if str(get_secret("POOL_ENABLED", "1")) == "1" else None
 
-# Note: We're using manual Langfuse logging instead of automatic wrapping
+# Generations run in background jobs, not in the Streamlit script thread
+job_runner = get_job_runner()
+# ...admitted a few at a time, the rest wait in line or get a lighter answer (see admission.py)
+admission = get_admission_controller()
+spend_budget = get_budget()
+
+# Generator page states. Clicks are handled in widget callbacks and moved
+# along TRANSITIONS, so every click costs one script run and nothing reruns
+# the script just to reach the next state.
+FORM = 'form'              # no story yet
+WAITING = 'waiting'        # story request waits in the admission queue
+STORY_JOB = 'story_job'    # story streams in a background job
+STORY = 'story'            # story (and narration, if any) on screen
+AUDIO_JOB = 'audio_job'    # narration of the story on screen is being made
+
+TRANSITIONS = {
+    (FORM, 'story_started'): STORY_JOB,
+    (STORY, 'story_started'): STORY_JOB,
+    (FORM, 'queued'): WAITING,
+    (STORY, 'queued'): WAITING,
+    (WAITING, 'admitted'): STORY_JOB,
+    (WAITING, 'story_ready'): STORY,
+    (WAITING, 'failed'): FORM,
+    (WAITING, 'cancelled'): FORM,
+    (FORM, 'story_ready'): STORY,
+    (STORY, 'story_ready'): STORY,
+    (STORY_JOB, 'story_ready'): STORY,
+    (STORY_JOB, 'failed'): FORM,
+    (FORM, 'rejected'): FORM,
+    (STORY, 'rejected'): FORM,
+    (STORY, 'audio_started'): AUDIO_JOB,
+    (AUDIO_JOB, 'audio_ready'): STORY,
+    (AUDIO_JOB, 'failed'): STORY,
+    (FORM, 'cleared'): FORM,
+    (STORY, 'cleared'): FORM,
+}
+
+def transition(event):
+    """Move the generator page along TRANSITIONS; False (and nothing changes) if event doesn't apply now"""
+    target = TRANSITIONS.get((st.session_state.phase, event))
+    if target is None:
+        metrics.errors.inc(stage="state", type=f"{st.session_state.phase}:{event}")
+        return False
+    st.session_state.phase = target
+    requested_at = st.session_state.get('story_requested_at_run')
+    if target == STORY and event == 'story_ready' and requested_at is not None:
+        # The story shows up in the next full run
+        metrics.runs_per_story.observe(st.session_state.script_runs - requested_at + 1)
+        st.session_state.story_requested_at_run = None
+    return True
+
+# A job carried over in the URL resumes in its running state
+if 'phase' not in st.session_state:
+    resumed_job = job_runner.get(st.session_state.job_id) if st.session_state.job_id else None
+    st.session_state.phase = (
+        {'story': STORY_JOB, 'prefetch': STORY_JOB, 'audio': AUDIO_JOB}.get(resumed_job.kind) if resumed_job else FORM
+    )
+
+# Identical generations in flight at the same time share one upstream call
+story_flights = get_single_flight("story")
+audio_flights = get_single_flight("audio")
+
+# Narrations are cached on disk by content hash - re-listens cost nothing
+audio_cache = get_audio_cache()
+# ...and, with AUDIO_SERVER_PORT set, streamed to players from there with Range requests
+audio_server = get_audio_server(audio_cache.directory)
+
+# Narration formats offered to clients; phones get the smaller opus/aac by default
+AUDIO_FORMATS = [
+    fmt.strip() for fmt in str(get_secret("AUDIO_FORMATS", "mp3,opus,aac")).split(",")
+    if fmt.strip() in AUDIO_MIME_TYPES
+] or [TTS_FORMAT]
+AUDIO_FORMAT_LABELS = {
+    "mp3": "MP3 - działa wszędzie",
+    "opus": "Opus - najmniej danych (Android)",
+    "aac": "AAC - mniej danych (iPhone)",
+}
+
+# Narration format of this session - picked from the browser's User-Agent until the user chooses
+if 'audio_format' not in st.session_state:
+    st.session_state.audio_format = preferred_format(
+        st.context.headers.get("User-Agent"), AUDIO_FORMATS, AUDIO_FORMATS[0]
+    )
+
+# Every story ever shown, per library owner, searchable (SQLite + FTS5, or the shared backend)
+story_library = get_story_library()
+LIBRARY_PAGE_SIZE = 5
+
+def cached_narration_path(story_content, fmt):
+    """Return the cached narration file for a story in fmt, or None"""
+    path = audio_cache.path(narration_cache_key(story_content, fmt))
+    metrics.cache_result("audio", path is not None)
+    return path
+
+def audio_format_of(path):
+    return os.path.splitext(path)[1].lstrip('.')
+
+# Files here are served by Streamlit itself at /app/static/ (server.enableStaticServing), with Range requests
+APP_STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+def audio_source(path):
+    """What the player loads: a URL of the audio server or of Streamlit's static files.
+
+    The file itself is the last resort (AUDIO_CACHE_DIR outside static/ and no
+    audio server reachable from the page) - Streamlit then reads it into its
+    media store on every run.
+    """
+    url = audio_server.url(path, st.context.url) if audio_server is not None else None
+    if url:
+        return url
+    relative = os.path.relpath(os.path.abspath(path), APP_STATIC_DIR)
+    if st.get_option("server.enableStaticServing") and not relative.startswith(os.pardir):
+        return "/app/static/" + relative.replace(os.sep, "/")
+    return path
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+# Note: We're using our own telemetry traces instead of automatic wrapping
 # to avoid UTF-8/ASCII encoding issues with Polish characters in HTTP headers
 
-def count_words_and_sentences(text):
-    words = len(text.split())
-    sentences = len(re.findall(r'[.!?]+', text))
-    reading_time = max(1, round(words / 200))
-    return words, sentences, reading_time
-
-def get_safety_rules():
-    """Return enhanced safety rules for children's fairy tales"""
-    return """
-=== ABSOLUTNE ZAKAZY (ZERO TOLERANCJI) ===
-NIGDY nie pisz o:
-- Śmierci, umieraniu, zabijaniu (nawet złych postaci)
-- Przemocy fizycznej (bicie, kopanie, krzywdzenie)
-- Przemocy psychicznej (zastraszanie, upokarzanie, wykluczanie)
-- Tematach seksualnych lub romantycznych (całowanie, "miłość" między postaciami)
-- Alkoholu, papierosach, narkotykach, lekach
-- Strasznych potworach, duchach, zombie, czarownicach
-- Krwi, ranach, urazach, bólu
-- Wulgaryzmach, brzydkich słowach, przekleństwach
-- Smutnych, traumatycznych scenach
-- Krzywdzie zwierząt
-- Opuszczeniu, samotności dziecka, zgubieniu się
-- Kłótniach rodziców lub dorosłych
-- Chorobach, szpitalach, lekarzach, dentystach
-- Ciemności, nocy jako czegoś strasznego
-- Kłamstwach jako głównym motywie
-
-=== BEZPIECZNE KONFLIKTY (jeśli potrzebne) ===
-Jeśli historia wymaga drobnego konfliktu, użyj TYLKO:
-- Zagubienie przedmiotu → szybkie odnalezienie z pomocą przyjaciół
-- Drobna pomyłka → łatwa do naprawienia, wszyscy się śmieją
-- Niezrozumienie między przyjaciółmi → wyjaśnione przez rozmowę
-- Łagodna przeszkoda → przekraczalna razem, bez stresu
-- Drobne niepowodzenie → prowadzące do nauki i sukcesu
-
-=== OBOWIĄZKOWE ELEMENTY ===
-KAŻDA bajka MUSI zawierać:
-- Wyłącznie pozytywne emocje (radość, ciekawość, ekscytacja, duma)
-- Przyjazne, pomocne postacie (wszyscy są mili)
-- Bezpieczne, kolorowe, przyjazne środowisko
-- Szczęśliwe zakończenie (ZAWSZE - bez wyjątków)
-- Język pełen ciepła, zachęty i pozytywnego wzmocnienia
-- Poczucie bezpieczeństwa przez całą narrację
-- Zero dramatyzmu, napięcia lub niepokoju
-- Zero negatywnych konsekwencji dla bohaterów
-- Współpraca zamiast konkurencji
-- Sukces i radość dla wszystkich postaci
-
-=== STYL NARRACJI ===
-- Używaj słów: "cudowny", "wspaniały", "radosny", "wesoły", "kolorowy"
-- Opisuj przyjemne detale: kolory, zapachy, przyjemne dźwięki
-- Buduj atmosferę bezpieczeństwa, ciepła i komfortu
-- Każda postać jest dobra, życzliwa i pomocna
-- Magia jest zawsze pomocna, kolorowa, nigdy groźna
-- Przyroda jest przyjazna (słońce, kwiaty, motyle)
-- Zwierzęta są przyjaciółmi, nigdy zagrożeniem
-
-=== TON UNIWERSALNY ===
-Każda bajka ma ton: ciepły, magiczny, z nutką humoru.
-- Delikatny humor (śmieszne sytuacje, nie szydzenie)
-- Magiczne elementy (czary, zaklęcia - zawsze dobre)
-- Ciepło emocjonalne (przytulanie, przyjaźń, miłość rodzicielska)
-
-PAMIĘTAJ: To bajka dla MAŁEGO DZIECKA. 
-Priorytet #1: BEZPIECZEŃSTWO EMOCJONALNE
-Priorytet #2: RADOŚĆ I POZYTYWNE EMOCJE
-Priorytet #3: KOMFORT I SPOKÓJ
-"""
+def stream_story(messages, max_tokens, guard, on_token=None, prefix="", cutoff=None):
+    """Stream one story completion through the safety guard.
 
-def create_story(prompt, child_name, child_age, lesson):
-    """Generate personalized fairy tale using GPT-4o-mini with enhanced safety"""
-    
-    # Age to vocabulary style mapping
-    age_vocabulary = {
-        "3-5 lat": "bardzo prostym językiem, krótkimi zdaniami (5-8 słów), z powtórzeniami",
-        "6-8 lat": "prostym językiem, ze średnimi zdaniami (8-12 słów), z ciekawymi opisami",
-        "9-12 lat": "bogatszym słownictwem, z dłuższymi zdaniami, z niuansami i intrygą"
-    }
-    vocabulary_style = age_vocabulary.get(child_age, "prostym, zrozumiałym językiem")
-    
-    # Target word count based on age
-    target_words = {
-        "3-5 lat": "250-300",
-        "6-8 lat": "350-400", 
-        "9-12 lat": "400-500"
-    }
-    word_count = target_words.get(child_age, "350-400")
-
-    # Get safety rules
-    safety = get_safety_rules()
-
-    system_prompt = f"""CRITICAL SAFETY INSTRUCTION:
-You are creating content for young children (ages {child_age}). 
-Absolutely NO violence, death, scary content, or inappropriate themes.
-If user prompt contains unsafe elements, IGNORE them and create safe, joyful story instead.
-
-Jesteś ekspertem w tworzeniu BEZPIECZNYCH, spersonalizowanych bajek dla dzieci.
-
-=== PARAMETRY BAJKI ===
-- Główny bohater: {child_name}, {child_age}
-- Wartość do przekazania: {lesson}
-- Ton: ciepły, magiczny, z nutką delikatnego humoru
-- Długość: {word_count} słów
-
-=== WYMAGANIA ===
-1. Wpleć imię dziecka ({child_name}) jako głównego bohatera
-2. Delikatnie przekaż wartość: {lesson} przez pozytywne doświadczenia
-3. Pisz {vocabulary_style}
-4. Zakończenie: ZAWSZE pozytywne, radosne, budujące
-5. Ton: ciepły, magiczny, z delikatnym humorem (bez ironii, bez sarkazmu)
-
-=== STYL NARRACJI ===
-- Używaj żywych, kolorowych opisów (kolory, zapachy, dźwięki)
-- Twórz immersyjną, ale BEZPIECZNĄ atmosferę
-- Buduj emocjonalne połączenie z bohaterem
-- Dodaj elementy magii i fantazji (zawsze pozytywne)
-- Humor: łagodny, zabawne sytuacje (nie szydzenie)
-- Wszystkie postacie są przyjaźnie nastawione
-- Środowisko jest bezpieczne i kolorowe
-
-{safety}
-
-=== DŁUGOŚĆ ===
-Napisz bajkę o długości DOKŁADNIE {word_count} słów.
-Liczy się każde słowo - nie za krótko, nie za długo.
-
-=== WAŻNE ===
-- NIE pisz tytułu
-- Bajka MUSI być w języku polskim
-- Zachowaj ciepły, magiczny ton przez całą historię
-- Przestrzegaj WSZYSTKICH zasad bezpieczeństwa
-- Każda postać jest dobra i pomocna
-- Zero strachu, zero smutku, zero niepokoju
-
-Napisz pełną bajkę gotową do przeczytania dziecku przed snem."""
-
-    user_message = f"Stwórz bajkę na podstawie: {prompt}" if prompt.strip() else f"Stwórz magiczną bajkę o przygodach {child_name}"
-    
-    # Langfuse trace
-    trace = None
-    generation = None
+    Returns (collector, text); a continuation passes the story so far as
+    prefix and its tokens are appended to it. The cutoff (if given) ends the
+    stream at the first sentence boundary past the word target.
+    """
+    collector = StreamCollector()
+    stream = None
+    text = prefix
+    try:
+        # Waits for the shared rate budget and retries 429/5xx with backoff
+        stream = call_with_retry(
+            lambda: openai_client.chat.completions.create(
+                model=STORY_MODEL,
+                messages=messages,
+                temperature=STORY_TEMPERATURE,
+                max_tokens=max_tokens,
+                stream=True,
+                stream_options={"include_usage": True}
+            ),
+            limiter=get_rate_limiter("chat"),
+            tokens=estimate_tokens(messages, max_tokens)
+        )
+        for chunk in stream:
+            if collector.add(chunk):
+                text = join_continuation(prefix, collector.text) if prefix else collector.text
+                cut = cutoff.check(text) if cutoff else None
+                if cut:
+                    text = cut
+                    collector.finish_reason = "cutoff"
+                # Only text the guard has already passed reaches the page
+                safe_text = guard.feed(text)
+                if on_token:
+                    on_token(safe_text)
+                if cut:
+                    # Closing the stream stops the generation - no more tokens billed
+                    stream.close()
+                    break
+        guard.finish(text)
+    except Exception as e:
+        if stream is not None:
+            stream.close()
+        metrics.errors.inc(stage="story", type=type(e).__name__)
+        raise
+    return collector, finish_text(text, collector.finish_reason)
 
-    if langfuse:
-        try:
-            safe_metadata = {
-                "genre": "Bajka",
-                "child_name": str(child_name).encode('utf-8', errors='ignore').decode('utf-8'),
-                "child_age": str(child_age).encode('utf-8', errors='ignore').decode('utf-8'),
-                "lesson": str(lesson).encode('utf-8', errors='ignore').decode('utf-8'),
-                "prompt_length": len(prompt),
-                "session_id": str(id(st.session_state)),
-                "model": "gpt-4o-mini"
-            }
-            trace = langfuse.trace(
-                name="story_generation",
-                user_id="demo_user",
-                metadata=safe_metadata
+def record_story_generation(trace, name, collector, started_at, messages, max_tokens, output):
+    """Trace and meter one story completion (the story or its continuation)."""
+    usage = collector.usage
+    first_token_at = started_at + collector.ttft if collector.ttft is not None else None
+    trace.generation(
+        name,
+        STORY_MODEL,
+        started_at,
+        time.time(),
+        model_parameters={
+            "temperature": STORY_TEMPERATURE,
+            "max_tokens": max_tokens
+        },
+        input=messages,
+        output=output,
+        completion_start=first_token_at,
+        usage={
+            "input": usage.prompt_tokens,
+            "output": usage.completion_tokens,
+            "total": usage.total_tokens
+        } if usage else None,
+        metadata={
+            # Prefix-cache hits on the static part of the system prompt
+            "cached_tokens": collector.cached_tokens,
+            "finish_reason": collector.finish_reason
+        }
+    )
+    if usage:
+        metrics.tokens.inc(usage.prompt_tokens, model=STORY_MODEL, direction="input")
+        metrics.tokens.inc(collector.cached_tokens, model=STORY_MODEL, direction="cached_input")
+        metrics.tokens.inc(usage.completion_tokens, model=STORY_MODEL, direction="output")
+    cost = story_cost(usage, collector.cached_tokens)
+    metrics.cost_usd.inc(cost, model=STORY_MODEL)
+    spend_budget.charge(usage.total_tokens if usage else 0, cost)
+
+def create_story(prompt, child_name, child_age, lesson, on_token=None, session_id=None, on_continuation=None):
+    """Generate personalized fairy tale using GPT-4o-mini with enhanced safety.
+
+    The completion is streamed; on_token (if given) is called with the text
+    generated so far every time new tokens arrive. The output budget follows
+    the age band's word target; a story that comes out short gets a short
+    continuation request instead of a full regeneration. on_continuation (if
+    given) is called with the offset the continuation's text starts at before
+    on_token sees the joined story.
+    """
+    with telemetry.trace(
+        "story_generation",
+        user_id="demo_user",
+        genre="Bajka",
+        child_name=child_name,
+        child_age=child_age,
+        lesson=lesson,
+        prompt_length=len(prompt),
+        session_id=session_id,
+        model=STORY_MODEL
+    ) as trace:
+        with trace.span("prompt_build"):
+            messages = story_messages(prompt, child_name, child_age, lesson)
+            budget = story_budget(child_age)
+
+        # Call OpenAI API with GPT-4o-mini (streamed, so text shows up as it is written)
+        started_at = time.time()
+        # The guard cuts the story off at the first forbidden word instead of paying for the rest
+        collector, content = stream_story(
+            messages, budget['max_tokens'], StreamGuard(), on_token, cutoff=LengthCutoff(budget['max_words'])
+        )
+        timings = collector.timings()
+        first_token_at = started_at + collector.ttft if collector.ttft is not None else None
+        if first_token_at:
+            trace.add_span("ttft", started_at, first_token_at)
+        trace.add_span(
+            "completion", first_token_at or started_at, time.time(),
+            characters=len(content), finish_reason=collector.finish_reason
+        )
+        record_story_generation(
+            trace, "gpt4o_mini_story", collector, started_at, messages, budget['max_tokens'], content
+        )
+
+        continued = needs_continuation(content, budget)
+        if continued:
+            continuation_messages, max_tokens = continuation_request(messages, content, budget)
+            with trace.span("continuation", words_before=story_stats(content)['words']) as span:
+                continuation_started_at = time.time()
+                start = continuation_start(content)
+                if on_continuation:
+                    on_continuation(start)
+                more, content = stream_story(
+                    continuation_messages, max_tokens, StreamGuard(start), on_token, prefix=content,
+                    cutoff=LengthCutoff(budget['max_words'])
+                )
+                span["words_after"] = story_stats(content)['words']
+            record_story_generation(
+                trace, "gpt4o_mini_story_continuation", more, continuation_started_at,
+                continuation_messages, max_tokens, content
             )
+            timings = dict(timings, generation_seconds=collector.timings()['generation_seconds'])
 
-            generation = trace.generation(
-                name="gpt4o_mini_story",
-                model="gpt-4o-mini",
-                model_parameters={
-                    "temperature": 0.8,
-                    "max_tokens": 1500
-                },
-                input=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ]
+    metrics.story_seconds.observe(timings['generation_seconds'])
+    if timings['ttft_seconds'] is not None:
+        metrics.ttft_seconds.observe(timings['ttft_seconds'])
+
+    return story_record(content, prompt, child_name, child_age, lesson, continued=continued, **timings)
+
+def create_story_with_narration(prompt, child_name, child_age, lesson, on_token=None, session_id=None,
+                                fmt=TTS_FORMAT, narrate=True):
+    """Stream a story and narrate it (in fmt) sentence by sentence while it is being written.
+
+    Returns (story, audio_path, audio_error). Identical requests in flight at
+    the same time (double clicks, reruns, refreshes) share one upstream run;
+    on_token receives the streamed text in every waiting session. Without
+    narrate (under load) only the story is made and audio_path is None.
+    """
+    def run(update):
+        tts_started_at = time.time()
+        narration = NarrationPipeline(partial(synthesize_speech, fmt=fmt), fmt=fmt) if narrate else None
+
+        def publish(text):
+            if narration:
+                narration.feed(text)
+            update(text)
+            if on_token:
+                on_token(text)
+
+        try:
+            story = create_story(
+                prompt, child_name, child_age, lesson, on_token=publish, session_id=session_id,
+                on_continuation=narration.continue_at if narration else None
             )
-        except Exception as e:
-            st.warning(f"Langfuse logging błąd: {e}")
-    
-    # Call OpenAI API with GPT-4o-mini
-    response = openai_client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message}
-        ],
-        temperature=0.8,
-        max_tokens=1500
-    )
-    
-    # Log output to Langfuse
-    if langfuse and generation:
+        except Exception:
+            if narration:
+                narration.cancel()
+            raise
+        if narration is None:
+            return story, None, None
         try:
-            generation.end(
-                output=response.choices[0].message.content,
-                usage={
-                    "input": response.usage.prompt_tokens,
-                    "output": response.usage.completion_tokens,
-                    "total": response.usage.total_tokens
-                }
+            # Joined straight into the cache file, chunk by chunk
+            audio_path, audio_size = audio_cache.put_stream(
+                narration_cache_key(story['content'], fmt),
+                lambda out: narration.finish(story['content'], out)
             )
         except Exception as e:
-            st.warning(f"Langfuse end logging błąd: {e}")
-
-    return {
-        'content': response.choices[0].message.content,
-        'genre': '🧚 Bajka',
-        'child_name': child_name,
-        'child_age': child_age,
-        'lesson': lesson,
-        'prompt': prompt if prompt.strip() else "Magiczna przygoda",
-        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M")
-    }
-
-def generate_audio_narration(story_content, child_name):
-    """Generate audio narration using OpenAI TTS with nova voice"""
-    try:
-        # Langfuse trace dla audio
-        trace = None
-        generation = None
-        
-        if langfuse:
-            try:
-                safe_metadata = {
-                    "child_name": str(child_name).encode('utf-8', errors='ignore').decode('utf-8'),
-                    "model": "tts-1",
-                    "voice": "nova",
-                    "text_length": len(story_content)
-                }
-                trace = langfuse.trace(
-                    name="audio_generation",
-                    metadata=safe_metadata
-                )
-                
-                generation = trace.generation(
-                    name="openai_tts",
-                    model="tts-1",
-                    model_parameters={
-                        "voice": "nova",
-                        "response_format": "mp3"
-                    },
-                    input=story_content[:100] + "..."  # First 100 chars for logging
-                )
-            except:
-                pass
-        
-        # Generate audio using OpenAI TTS
-        response = openai_client.audio.speech.create(
-            model="tts-1",
-            voice="nova",
-            input=story_content
+            narration.cancel()
+            metrics.errors.inc(stage="tts", type=type(e).__name__)
+            return story, None, e
+        log_pipelined_audio(story['content'], audio_size, narration.chunk_count, tts_started_at, fmt)
+        return story, audio_path, None
+
+    key = (prompt.strip(), child_name, child_age, lesson, fmt if narrate else None)
+    story, audio_path, audio_error = story_flights.do(key, run, on_update=on_token)
+    # Every session gets its own copy of the shared story dict
+    return dict(story), audio_path, audio_error
+
+def serve_pooled_story(child_name, child_age, lesson):
+    """Take a pre-generated story for the empty-prompt path, or None if the pool is empty"""
+    served_ids = st.session_state.setdefault('pool_served_ids', set())
+    pooled = story_pool.take((child_age, lesson, guess_gender(child_name)), served_ids)
+    metrics.cache_result("pool", pooled is not None)
+    if not pooled:
+        return None
+    story_id, template = pooled
+    served_ids.add(story_id)
+    return story_record(
+        fill_template(template, child_name), "", child_name, child_age, lesson,
+        ttft_seconds=0.0,
+        generation_seconds=0.0,
+        pooled=True
+    )
+
+# TTS responses bigger than this spill from memory to a temp file while they download
+TTS_SPOOL_BYTES = int(get_secret("TTS_SPOOL_KB", 256)) * 1024
+
+def synthesize_speech(text, fmt=TTS_FORMAT):
+    """Single OpenAI TTS call (nova voice) - returns the audio in fmt as a spooled temp file"""
+    def request():
+        with openai_client.audio.speech.with_streaming_response.create(
+            model=TTS_MODEL,
+            voice=TTS_VOICE,
+            input=text,
+            response_format=fmt
+        ) as response:
+            audio_file = tempfile.SpooledTemporaryFile(max_size=TTS_SPOOL_BYTES)
+            for chunk in response.iter_bytes(64 * 1024):
+                audio_file.write(chunk)
+        audio_file.seek(0)
+        return audio_file
+
+    return call_with_retry(request, limiter=get_rate_limiter("tts"))
+
+def record_narration(story_content, audio_size, seconds, mode):
+    metrics.tts_seconds.observe(seconds, mode=mode)
+    metrics.audio_bytes.observe(audio_size)
+    metrics.tts_characters.inc(len(story_content), model=TTS_MODEL)
+    metrics.cost_usd.inc(tts_cost(len(story_content)), model=TTS_MODEL)
+    spend_budget.charge(usd=tts_cost(len(story_content)))
+
+def log_pipelined_audio(story_content, audio_size, chunk_count, started_at, fmt):
+    """Trace audio produced by the text->audio pipeline"""
+    record_narration(story_content, audio_size, time.time() - started_at, "pipelined")
+    with telemetry.trace(
+        "audio_generation",
+        model=TTS_MODEL,
+        voice=TTS_VOICE,
+        text_length=len(story_content),
+        pipelined=True,
+        chunks=chunk_count
+    ) as trace:
+        trace.generation(
+            "openai_tts",
+            TTS_MODEL,
+            started_at,
+            time.time(),
+            model_parameters={
+                "voice": TTS_VOICE,
+                "response_format": fmt
+            },
+            input=story_content[:100] + "...",
+            output="audio_generated",
+            metadata={"audio_size_bytes": audio_size}
         )
-        
-        # Convert to BytesIO for download button
-        audio_buffer = BytesIO(response.content)
-        
-        # Log to Langfuse
-        if langfuse and generation:
+
+def narrate_story(story_content, child_name, fmt=TTS_FORMAT):
+    """Generate audio narration using OpenAI TTS with nova voice (cached on disk) - returns the file path"""
+    with telemetry.trace(
+        "audio_generation",
+        model=TTS_MODEL,
+        voice=TTS_VOICE,
+        text_length=len(story_content)
+    ) as trace:
+        with trace.span("cache_lookup") as lookup:
+            cached = cached_narration_path(story_content, fmt)
+            lookup["hit"] = bool(cached)
+        if cached:
+            return cached
+
+        # Generate audio using OpenAI TTS - chunked and in parallel, so long
+        # stories don't hit the 4096-character input limit
+        def narrate(update):
+            started_at = time.time()
             try:
-                generation.end(
-                    output="audio_generated",
-                    metadata={
-                        "audio_size_bytes": len(response.content)
-                    }
+                audio_path, audio_size = audio_cache.put_stream(
+                    narration_cache_key(story_content, fmt),
+                    lambda out: synthesize_narration(
+                        partial(synthesize_speech, fmt=fmt), story_content, out=out, fmt=fmt
+                    )
                 )
-            except:
-                pass
-        
-        return audio_buffer
-        
-    except Exception as e:
-        st.error(f"Błąd generowania audio: {e}")
+            except Exception as e:
+                metrics.errors.inc(stage="tts", type=type(e).__name__)
+                raise
+            record_narration(story_content, audio_size, time.time() - started_at, "chunked")
+            return audio_path, audio_size
+
+        # Concurrent requests for the same text share one TTS run
+        started_at = time.time()
+        audio_path, audio_size = audio_flights.do(narration_cache_key(story_content, fmt), narrate)
+        trace.generation(
+            "openai_tts",
+            TTS_MODEL,
+            started_at,
+            time.time(),
+            model_parameters={
+                "voice": TTS_VOICE,
+                "response_format": fmt
+            },
+            input=story_content[:100] + "...",  # First 100 chars for logging
+            output="audio_generated",
+            metadata={"audio_size_bytes": audio_size}
+        )
+
+    return audio_path
+
+def start_job(kind, fn, params):
+    """Run fn in the background and remember the job in the session and the URL"""
+    track_job(job_runner.submit(kind, fn, params))
+
+def track_job(job_id):
+    st.session_state.job_id = job_id
+    st.query_params["job"] = job_id
+
+def start_story_job(prompt, child_name, child_age, lesson, ticket):
+    """Story job holding the admission ticket's slot until it ends"""
+    session_id = st.session_state.session_id
+    fmt = st.session_state.audio_format
+    if not ticket.with_audio:
+        metrics.admission.inc(kind='story', decision='no_audio')
+    start_job(
+        'story',
+        lambda progress: admission.run(
+            ticket, create_story_with_narration,
+            prompt, child_name, child_age, lesson,
+            on_token=progress,
+            session_id=session_id,
+            fmt=fmt,
+            narrate=ticket.with_audio
+        ),
+        {'child_name': child_name, 'child_age': child_age, 'lesson': lesson, 'prompt': prompt}
+    )
+
+def start_narration_job(story, ticket):
+    fmt = st.session_state.audio_format
+    start_job(
+        'audio',
+        lambda progress: admission.run(ticket, narrate_story, story['content'], story['child_name'], fmt),
+        {'child_name': story['child_name'], 'story': story}
+    )
+
+# Speculative prefetch (opt-in): once a story is on screen, the next variant
+# for the same inputs is generated in the background, so "🔄 Nowa bajka" -
+# the most common action after the first story - is instant
+PREFETCH_ENABLED = str(get_secret("PREFETCH_ENABLED", "0")) == "1"
+PREFETCH_AUDIO = str(get_secret("PREFETCH_AUDIO", "0")) == "1"
+# Budget: speculative generations per session, and running at once in the process
+PREFETCH_PER_SESSION = int(get_secret("PREFETCH_PER_SESSION", 3))
+PREFETCH_MAX_RUNNING = int(get_secret("PREFETCH_MAX_RUNNING", 4))
+# Unclaimed prefetched stories are forgotten after this long
+PREFETCH_TTL_SECONDS = float(get_secret("PREFETCH_TTL_MINUTES", 10)) * 60
+
+def story_params(story):
+    return (story['child_name'], story['child_age'], story['lesson'], raw_prompt(story))
+
+def form_params():
+    """The form's current inputs, comparable with story_params()"""
+    return (
+        (st.session_state.get('child_name_input') or "").strip(),
+        st.session_state.get('child_age_input'),
+        st.session_state.get('lesson_input'),
+        (st.session_state.get('story_prompt_input') or "").strip()
+    )
+
+def session_liveness():
+    """Callable telling a background job whether this browser session is still connected"""
+    ctx = get_script_run_ctx()
+    session_id = ctx.session_id if ctx else None
+
+    def alive():
+        try:
+            return Runtime.instance().is_active_session(session_id)
+        except Exception:
+            return True
+    return alive
+
+def prefetch_story(params, progress, alive, fmt):
+    """Background part of a prefetch - (story, audio_path, None) like create_story_with_narration.
+
+    Not coalesced with other sessions' requests, so cancelling it can't fail anybody else.
+    """
+    child_name, child_age, lesson, prompt = params
+
+    def on_token(text):
+        if not alive():
+            raise JobCancelled("session ended")
+        progress(text)
+
+    story = create_story(prompt, child_name, child_age, lesson, on_token=on_token, session_id="prefetch")
+    audio_path = narrate_story(story['content'], child_name, fmt) if PREFETCH_AUDIO and alive() else None
+    return story, audio_path, None
+
+def start_prefetch(story):
+    """Generate the next variant of the story on screen in the background, within the budget"""
+    params = story_params(story)
+    if (
+        not PREFETCH_ENABLED
+        or st.session_state.get('prefetch')
+        or st.session_state.get('prefetches_started', 0) >= PREFETCH_PER_SESSION
+        # Only while the form still asks for this story
+        or params != form_params()
+        or job_runner.active('prefetch') >= PREFETCH_MAX_RUNNING
+        # Speculation only while there is room to spare
+        or admission.level() != NORMAL
+    ):
+        return
+    alive = session_liveness()
+    try:
+        # A slot of its own, so the session's next request isn't refused as busy meanwhile
+        ticket = admission.request(f"{st.session_state.session_id}:prefetch", 'prefetch', wait=False, alive=alive)
+    except AdmissionRejected:
+        return
+    fmt = st.session_state.audio_format
+    job_id = job_runner.submit(
+        'prefetch',
+        lambda progress: admission.run(ticket, prefetch_story, params, progress, alive, fmt),
+        {'child_name': params[0], 'child_age': params[1], 'lesson': params[2], 'prompt': params[3]},
+        ttl=PREFETCH_TTL_SECONDS
+    )
+    st.session_state.prefetch = {'job_id': job_id, 'params': params}
+    st.session_state.prefetches_started = st.session_state.get('prefetches_started', 0) + 1
+
+def discard_prefetch():
+    prefetch = st.session_state.get('prefetch')
+    if prefetch:
+        job_runner.cancel(prefetch['job_id'])
+        st.session_state.prefetch = None
+        metrics.cache.inc(cache="prefetch", result="discarded")
+
+def take_prefetch(params):
+    """The prefetch job for these inputs (done or still running), or None - any other prefetch is discarded"""
+    prefetch = st.session_state.get('prefetch')
+    if not prefetch:
+        return None
+    job = job_runner.get(prefetch['job_id'])
+    if prefetch['params'] != params or job is None or job.status not in (QUEUED, RUNNING, DONE):
+        discard_prefetch()
         return None
+    st.session_state.prefetch = None
+    return job
 
-# ==================== LANDING PAGE ====================
-if st.session_state.page == 'landing':
-    # Floating particles (snowflakes)
-    particles_html = "".join([f'<div class="particle"></div>' for _ in range(20)])
-    st.markdown(particles_html, unsafe_allow_html=True)
-    
-    # Landing content
-    st.markdown("""
-        <div class="landing-content">
-            <h1 class="landing-title">🧚 Generator Bajek AI dla Dzieci</h1>
-            <p class="landing-subtitle">
-                Spersonalizowana bajka + audio w 2 minuty!<br>
-                Prosto, szybko, magicznie ✨
-            </p>
+def finish_job():
+    st.session_state.job_id = None
+    st.query_params.pop("job", None)
+
+# Retryable errors as named in jobs finished on another replica
+RETRYABLE_ERROR_TYPES = {"RateLimitTimeout", "RateLimitError", "APIConnectionError", "APITimeoutError", "InternalServerError"}
+
+def generation_error_message(e):
+    remote_type = e.type_name if isinstance(e, RemoteJobError) else None
+    if isinstance(e, UnsafeContentError) or remote_type == UnsafeContentError.__name__:
+        return "🛡️ Bajka zeszła na temat nieodpowiedni dla dzieci, więc ją przerwaliśmy. Spróbuj jeszcze raz lub zmień pomysł."
+    if isinstance(e, RateLimitTimeout) or is_retryable(e) or remote_type in RETRYABLE_ERROR_TYPES:
+        return "⏳ Teraz tworzymy bardzo dużo bajek - spróbuj ponownie za chwilę."
+    return f"Błąd generowania bajki: {e}"
+
+def overload_message(reason):
+    """Why a request got no admission ticket, for the page"""
+    if reason == BUSY:
+        return "⏳ Poprzednia bajka jeszcze powstaje - poczekaj chwilę."
+    if reason == BUDGET:
+        return "⏳ Na teraz wyczerpaliśmy limit nowych bajek - spróbuj ponownie później."
+    return "⏳ Teraz tworzymy bardzo dużo bajek - spróbuj ponownie za chwilę."
+
+def accept_story(story, audio_path, audio_error):
+    """Put a finished story on screen and into the library"""
+    story['library_id'] = story_library.add(st.session_state.library_owner, story)
+    st.session_state.current_story = story
+    st.session_state.child_name = story['child_name']
+    st.session_state.child_age = story['child_age']
+    st.session_state.lesson = story['lesson']
+    if audio_error:
+        st.session_state.job_error = f"Błąd generowania audio: {audio_error}"
+    elif audio_path:
+        st.session_state.story_audio_path = audio_path
+    elif admission.level() == NORMAL:
+        # Prefetched or pooled without audio - narrate it now
+        request_narration()
+    else:
+        # Under load narration waits until it is asked for
+        st.session_state.story_audio_path = cached_narration_path(story['content'], st.session_state.audio_format)
+        if not st.session_state.story_audio_path:
+            st.session_state.notice = "🎧 Teraz tworzymy bardzo dużo bajek - narrację włączysz przyciskiem „Czytaj bajkę”."
+
+@st.fragment(run_every=0.5)
+def job_status_panel():
+    """Polls this session's background job - only this fragment reruns while it works"""
+    metrics.fragment_runs.inc(fragment="job_status")
+    job = job_runner.get(st.session_state.job_id)
+    if job is None:
+        # Unknown or expired job (e.g. old link, server restart)
+        finish_job()
+        transition('failed')
+        st.rerun()
+
+    if not job.finished:
+        if job.kind in ('story', 'prefetch'):
+            st.markdown(f"""
+                <div class='loading-text'>
+                    🪄 Tworzę spersonalizowaną bajkę dla {job.params['child_name']}...<br>
+                    💡 Wartość: <b>{job.params['lesson']}</b><br>
+                    🎯 Model: GPT-4o-mini
+                </div>
+            """, unsafe_allow_html=True)
+            if job.progress:
+                st.markdown(f"""
+                    <div class='story-content'>
+                        {job.progress}▌
+                    </div>
+                """, unsafe_allow_html=True)
+        else:
+            st.markdown(f"""
+                <div class='loading-text'>
+                    🎧 Tworzę narrację audio dla {job.params['child_name']}...<br>
+                    Głos: Nova (OpenAI TTS)<br>
+                    To może potrwać 10-20 sekund<br>
+                    💰 Koszt: ~$0.015
+                </div>
+            """, unsafe_allow_html=True)
+        return
+
+    finish_job()
+    if job.status != DONE:
+        transition('failed')
+        if job.kind == 'audio':
+            st.session_state.job_error = f"Błąd generowania audio: {job.error}"
+        else:
+            st.session_state.job_error = generation_error_message(job.error)
+    elif job.kind in ('story', 'prefetch'):
+        transition('story_ready')
+        accept_story(*job.result)
+    else:
+        transition('audio_ready')
+        if not st.session_state.current_story:
+            # Page was refreshed while the narration was being generated
+            st.session_state.current_story = job.params['story']
+        st.session_state.story_audio_path = job.result
+    st.rerun()
+
+def serve_instead(child_name, child_age, lesson):
+    """Last degradation step: a pre-generated story instead of a new one; False if the pool has none"""
+    story = serve_pooled_story(child_name, child_age, lesson) if story_pool else None
+    if not story:
+        return False
+    if st.session_state.get('ticket'):
+        # Served instead of waiting - the place in the queue goes to the next one
+        leave_queue()
+    if not transition('story_ready'):
+        return False
+    metrics.admission.inc(kind='story', decision='pooled')
+    st.session_state.story_audio_path = None
+    accept_story(story, None, None)
+    st.session_state.notice = (
+        f"📚 Teraz tworzymy bardzo dużo bajek, więc {child_name} dostaje od razu gotową bajkę. "
+        "Na nową, według Twojego pomysłu, zapraszamy za chwilę."
+    )
+    return True
+
+def leave_queue():
+    admission.release(st.session_state.ticket)
+    st.session_state.ticket = None
+
+@st.fragment(run_every=0.5)
+def queue_panel():
+    """Polls this session's place in the admission queue and starts the story job once a slot is free"""
+    metrics.fragment_runs.inc(fragment="queue")
+    ticket = st.session_state.get('ticket')
+    position = admission.poll(ticket) if ticket else None
+    if position is None:
+        # Dropped from the queue meanwhile (e.g. the page was away too long)
+        st.session_state.ticket = None
+        transition('failed')
+        st.session_state.job_error = overload_message(None)
+        st.rerun()
+    if position == 0:
+        metrics.queue_wait_seconds.observe(ticket.waited)
+        st.session_state.ticket = None
+        request = st.session_state.pending_story
+        transition('admitted')
+        start_story_job(request['prompt'], request['child_name'], request['child_age'], request['lesson'], ticket)
+        # The job panel is outside this fragment
+        st.rerun()
+
+    request = st.session_state.pending_story
+    st.markdown(f"""
+        <div class='loading-text'>
+            ⏳ Teraz tworzymy bardzo dużo bajek!<br>
+            Bajka dla {request['child_name']} jest <b>{position}.</b> w kolejce<br>
+            Zaczniemy za ok. {max(1, round(admission.estimated_wait(position)))} s
         </div>
     """, unsafe_allow_html=True)
-    
-    # Center the button
-    col1, col2, col3 = st.columns([1, 1, 1])
-    with col2:
-        if st.button("🚀 WEJDŹ", key="enter_app", use_container_width=True):
-            st.session_state.page = 'generator'
+    col_ready, col_cancel = st.columns(2)
+    with col_ready:
+        if story_pool and st.button("📚 Gotowa bajka od razu", use_container_width=True, key="queue_pooled"):
+            if serve_instead(request['child_name'], request['child_age'], request['lesson']):
+                # The story panel is outside this fragment
+                st.rerun()
+            st.warning("Nie mamy teraz gotowej bajki - zostajesz w kolejce.")
+    with col_cancel:
+        if st.button("✖️ Anuluj", use_container_width=True, key="queue_cancel"):
+            leave_queue()
+            transition('cancelled')
             st.rerun()
 
-# ==================== GENERATOR PAGE ====================
-else:
-    # Floating particles (snowflakes on generator too)
-    particles_html = "".join([f'<div class="particle"></div>' for _ in range(15)])
-    st.markdown(particles_html, unsafe_allow_html=True)
-    
-    # Header
-    st.markdown("""
-        <h1 style='text-align: center; color: white; margin-top: 0; margin-bottom: 2rem; text-shadow: 2px 2px 4px rgba(0,0,0,0.3);'>
-            🧚 Stwórz Bajkę dla Twojego Dziecka
-        </h1>
-    """, unsafe_allow_html=True)
+def request_story(child_name, child_age, lesson, prompt):
+    """Generate / "Nowa bajka" callback: a pooled story right away, otherwise a background job"""
+    st.session_state.child_name = child_name
+    st.session_state.child_age = child_age
+    st.session_state.lesson = lesson
+    st.session_state.user_prompt = prompt
+    st.session_state.story_requested_at_run = st.session_state.script_runs
 
-    # Info box at the top
-    if not st.session_state.current_story:
-        st.info("✨ Wypełnij formularz i wygeneruj spersonalizowaną bajkę + audio!")
-   
+    # Screened locally first - unsafe or nonsense prompts never reach the API, and an
+    # unsafe name never ends up in a pooled or prefetched story either
+    rejection = check_prompt(prompt, child_name)
+    if rejection:
+        metrics.errors.inc(stage="prompt", type="rejected")
+        if transition('rejected'):
+            st.session_state.current_story = None
+            st.session_state.story_audio_path = None
+            st.session_state.job_error = rejection
+        return
+
+    # A prefetched variant for the same inputs - ready, or at least already underway
+    job = take_prefetch((child_name, child_age, lesson, prompt)) if PREFETCH_ENABLED else None
+    if PREFETCH_ENABLED:
+        metrics.cache_result("prefetch", job is not None)
+    if job and job.status == DONE:
+        if transition('story_ready'):
+            st.session_state.story_audio_path = None
+            accept_story(*job.result)
+        return
+    if job and transition('story_started'):
+        st.session_state.current_story = None
+        st.session_state.story_audio_path = None
+        # Polled by job_status_panel like any story job
+        track_job(job.id)
+        return
+
+    # Empty prompt: serve a ready story from the pool if there is one
+    story = serve_pooled_story(child_name, child_age, lesson) if story_pool and not prompt else None
+    if story:
+        if transition('story_ready'):
+            st.session_state.story_audio_path = None
+            accept_story(story, None, None)
+        return
+
+    # Admission: a slot now, a place in the queue, or - over capacity or budget - a pre-generated story
+    try:
+        ticket = admission.request(st.session_state.session_id, 'story', alive=session_liveness())
+    except AdmissionRejected as e:
+        metrics.admission.inc(kind='story', decision=e.reason)
+        # (an empty idea has been looked up in the pool already)
+        if e.reason != BUSY and prompt and serve_instead(child_name, child_age, lesson):
+            return
+        if transition('rejected'):
+            st.session_state.current_story = None
+            st.session_state.story_audio_path = None
+            st.session_state.job_error = overload_message(e.reason)
+        return
+    metrics.admission.inc(kind='story', decision='admitted' if ticket.admitted else 'queued')
+    if ticket.admitted and transition('story_started'):
+        st.session_state.current_story = None
+        st.session_state.story_audio_path = None
+        # Streamed in a background job; the page polls it in job_status_panel
+        start_story_job(prompt, child_name, child_age, lesson, ticket)
+    elif not ticket.admitted and transition('queued'):
+        st.session_state.current_story = None
+        st.session_state.story_audio_path = None
+        # queue_panel shows the place in line and starts the job when it's this session's turn
+        st.session_state.ticket = ticket
+        st.session_state.pending_story = {
+            'child_name': child_name, 'child_age': child_age, 'lesson': lesson, 'prompt': prompt
+        }
+    else:
+        admission.release(ticket)
+
+def request_narration():
+    """"Czytaj bajkę" callback - cached narrations are served right away, the rest runs in the background"""
+    story = st.session_state.current_story
+    st.session_state.story_audio_path = cached_narration_path(story['content'], st.session_state.audio_format)
+    if st.session_state.story_audio_path:
+        return
+    # Narration doesn't queue - with no free slot it is simply offered again later
+    try:
+        ticket = admission.request(st.session_state.session_id, 'audio', wait=False)
+    except AdmissionRejected as e:
+        metrics.admission.inc(kind='audio', decision=e.reason)
+        st.session_state.job_error = (
+            "🎧 Narracja jest teraz niedostępna - spróbuj „Czytaj bajkę” za chwilę." if e.reason != BUSY
+            else overload_message(BUSY)
+        )
+        return
+    metrics.admission.inc(kind='audio', decision='admitted')
+    if transition('audio_started'):
+        start_narration_job(story, ticket)
+    else:
+        admission.release(ticket)
+
+def load_story(story):
+    if transition('story_ready'):
+        st.session_state.current_story = story
+        # Reuse narration from the disk cache instead of a new TTS call
+        st.session_state.story_audio_path = cached_narration_path(story['content'], st.session_state.audio_format)
+
+def change_audio_format():
+    """Format picker callback - the story on screen switches to its narration in the new format, if cached"""
+    st.session_state.audio_format = st.session_state.audio_format_input
+    story = st.session_state.current_story
+    if story and st.session_state.phase != AUDIO_JOB:
+        st.session_state.story_audio_path = cached_narration_path(story['content'], st.session_state.audio_format)
+
+def open_library_story(story_id):
+    """Load a library entry - its full text is read only now, its narration comes from the audio cache"""
+    story = story_library.get(st.session_state.library_owner, story_id)
+    metrics.cache_result("library", story is not None)
+    if story:
+        load_story(story)
+
+def reset_library_pages():
+    st.session_state.library_cursors = [None]
+
+def clear_history():
+    story_library.delete_owner(st.session_state.library_owner)
+    reset_library_pages()
+    if transition('cleared'):
+        st.session_state.current_story = None
+        st.session_state.story_audio_path = None
+
+def go_to(page):
+    st.session_state.page = page
+
+@st.fragment
+def story_form():
+    """Name, age, lesson and idea - typing reruns only this fragment, not the story below"""
+    metrics.fragment_runs.inc(fragment="story_form")
     # Name input
     child_name_input = st.text_input(
             "👶 Imię dziecka *",
@@ -653,25 +1008,14 @@ else:
         # Age selection
     child_age_input = st.select_slider(
             "🎂 Wiek dziecka *",
-            options=["3-5 lat", "6-8 lat", "9-12 lat"],
+            options=AGE_OPTIONS,
             value=st.session_state.child_age or "6-8 lat",
             key="child_age_input",
             help="Dostosujemy język i styl do wieku"
         )
 
         # Lesson/value
-    lesson_options = [
-            "Odwaga",
-            "Przyjaźń", 
-            "Uczciwość",
-            "Dobroć",
-            "Wytrwałość",
-            "Dzielenie się",
-            "Szacunek",
-            "Cierpliwość",
-            "Kreatywność",
-            "Pomoc innym"
-        ]
+    lesson_options = LESSON_OPTIONS
     lesson_input = st.selectbox(
             "💡 Co chcesz przekazać dziecku? *",
             options=lesson_options,
@@ -703,92 +1047,157 @@ else:
 
     st.markdown("</div>", unsafe_allow_html=True)
 
+    prefetch = st.session_state.get('prefetch')
+    if prefetch and prefetch['params'] != (child_name_input.strip(), child_age_input, lesson_input, user_input.strip()):
+        # The inputs changed - the speculative story is for something else now
+        discard_prefetch()
+
         # GENERATE BUTTON
     col_gen1, col_gen2, col_gen3 = st.columns([1, 2, 1])
     with col_gen2:
             can_generate = bool(child_name_input.strip() and child_age_input and lesson_input)
-            
-            if st.button("✨ Stwórz Bajkę + Audio", disabled=not can_generate, use_container_width=True, type="primary", key="generate_story"):
-                st.session_state.child_name = child_name_input.strip()
-                st.session_state.child_age = child_age_input
-                st.session_state.lesson = lesson_input
-                st.session_state.user_prompt = user_input.strip() if user_input.strip() else ""
-                st.session_state.generating = True
-                st.session_state.current_story = None
-                st.session_state.story_audio_data = None
+            busy = st.session_state.phase in (WAITING, STORY_JOB, AUDIO_JOB)
+
+            if st.button("✨ Stwórz Bajkę + Audio", disabled=not can_generate or busy, use_container_width=True, type="primary", key="generate_story"):
+                request_story(child_name_input.strip(), child_age_input, lesson_input, user_input.strip())
+                # The job panel and the story are outside this fragment
                 st.rerun()
-        
+
     if not can_generate:
             st.markdown("""
                 <div style='text-align: center; color: rgba(255,255,255,0.8); font-size: 14px; margin-top: 1rem;'>
                     ⚠️ Wypełnij wymagane pola (*)
                 </div>
             """, unsafe_allow_html=True)
-            st.session_state.current_story = None
-            st.session_state.story_image_url = None
-            st.session_state.story_image_data = None
-            st.session_state.user_prompt = user_input.strip()
-            st.rerun()
+
+@st.fragment
+def library_panel():
+    """The sidebar library - searching and paging rerun only this fragment, one page of summaries at a time"""
+    metrics.fragment_runs.inc(fragment="library")
+    st.markdown("### 📚 Historia Bajek")
+    query = st.text_input(
+        "🔎 Szukaj w bajkach",
+        key="library_query",
+        placeholder="imię, wartość, słowo z bajki...",
+        on_change=reset_library_pages
+    ).strip()
+
+    cursors = st.session_state.library_cursors
+    # One row more than shown tells whether there is an older page
+    rows = story_library.page(st.session_state.library_owner, cursors[-1], LIBRARY_PAGE_SIZE + 1, query)
+    has_older = len(rows) > LIBRARY_PAGE_SIZE
+    rows = rows[:LIBRARY_PAGE_SIZE]
+
+    if not rows:
+        st.info("Nic nie znaleziono" if query else "Brak historii")
+        return
+
+    for row in rows:
+        with st.expander(f"📖 Dla: {row['child_name']}"):
+            st.write(f"**Wiek:** {row['child_age']}")
+            st.write(f"**Wartość:** {row['lesson']}")
+            st.write(f"**Fragment:** {row['preview']}...")
+            if st.button(f"Wczytaj", key=f"load_{row['id']}"):
+                open_library_story(row['id'])
+                # The story panel is outside this fragment
+                st.rerun()
+
+    col_newer, col_older = st.columns(2)
+    with col_newer:
+        st.button("← Nowsze", key="library_newer", disabled=len(cursors) == 1, on_click=cursors.pop)
+    with col_older:
+        st.button(
+            "Starsze →", key="library_older", disabled=not has_older,
+            on_click=cursors.append, args=(rows[-1]['id'],)
+        )
+
+    if st.button("🗑️ Wyczyść historię", use_container_width=True):
+        clear_history()
+        st.rerun()
+    st.caption("🔖 Zapisz link do tej strony, aby wrócić do swoich bajek.")
+
+def render_admin_page():
+    """Latency SLO overview and the raw /metrics text - reachable only with ?admin=<ADMIN_TOKEN>"""
+    st.markdown("## 📈 Metryki")
+    rows = []
+    for histogram in (metrics.story_seconds, metrics.ttft_seconds, metrics.tts_seconds, metrics.audio_bytes,
+                      metrics.queue_wait_seconds, metrics.script_run_seconds, metrics.run_bytes, metrics.runs_per_story):
+        for key, (counts, total) in histogram.snapshot().items():
+            labels = dict(zip(histogram.labelnames, key))
+            count = sum(counts)
+            rows.append({
+                "metryka": histogram.name + "".join(f" {name}={value}" for name, value in labels.items()),
+                "liczba": count,
+                "średnio": round(total / count, 3) if count else None,
+                "p50 ≤": histogram.quantile(0.5, **labels),
+                "p95 ≤": histogram.quantile(0.95, **labels),
+                "p99 ≤": histogram.quantile(0.99, **labels)
+            })
+    st.dataframe(rows, use_container_width=True)
+    for counter in (metrics.tokens, metrics.cost_usd, metrics.errors, metrics.cache, metrics.admission,
+                    metrics.tts_characters, metrics.websocket_bytes, metrics.script_runs, metrics.fragment_runs):
+        st.write(f"**{counter.name}**", {" / ".join(key) or "razem": value for key, value in counter.values().items()})
+    st.write("**Aktywne sesje:**", metrics.active_sessions(), "**Zadania:**", job_runner.stats())
+    st.write("**Backend:**", get_backend().name, "**Cache audio:**", audio_cache.stats())
+    st.write(
+        "**Przyjęcia:**", dict(admission.stats(), poziom=admission.level()),
+        "**Budżet (wydane / limit):**",
+        {f"{window} {unit}": f"{spent:g} / {spend_budget.limits[(window, unit)] or '∞'}"
+         for (window, unit), spent in spend_budget.spent().items()}
+    )
+    st.code(metrics.render(), language="text")
+
+# ==================== ADMIN PAGE ====================
+if st.session_state.page == 'admin':
+    render_admin_page()
+
+# ==================== LANDING PAGE ====================
+elif st.session_state.page == 'landing':
+    # Landing content
+    st.markdown("""
+        <div class="landing-content">
+            <h1 class="landing-title">🧚 Generator Bajek AI dla Dzieci</h1>
+            <p class="landing-subtitle">
+                Spersonalizowana bajka + audio w 2 minuty!<br>
+                Prosto, szybko, magicznie ✨
+            </p>
+        </div>
+    """, unsafe_allow_html=True)
     
+    # Center the button
+    col1, col2, col3 = st.columns([1, 1, 1])
+    with col2:
+        st.button("🚀 WEJDŹ", key="enter_app", use_container_width=True, on_click=go_to, args=('generator',))
+
+# ==================== GENERATOR PAGE ====================
+else:
+    # Header
+    st.markdown("""
+        <h1 style='text-align: center; color: white; margin-top: 0; margin-bottom: 2rem; text-shadow: 2px 2px 4px rgba(0,0,0,0.3);'>
+            🧚 Stwórz Bajkę dla Twojego Dziecka
+        </h1>
+    """, unsafe_allow_html=True)
+
+    # Info box at the top
+    if not st.session_state.current_story:
+        st.info("✨ Wypełnij formularz i wygeneruj spersonalizowaną bajkę + audio!")
+   
+    story_form()
+
     # Separator
     st.markdown("<hr style='border: 1px solid rgba(255,255,255,0.2); margin: 2rem 0;'>", unsafe_allow_html=True)
-    
-    # Generate story
-    if st.session_state.generating:
-        with st.spinner(""):
-            st.markdown(f"""
-                <div class='loading-text'>
-                    🪄 Tworzę spersonalizowaną bajkę dla {st.session_state.child_name}...<br>
-                    💡 Wartość: <b>{st.session_state.lesson}</b><br>
-                    🎯 Model: GPT-4o-mini
-                </div>
-            """, unsafe_allow_html=True)
 
-            progress = st.progress(0)
-            for i in range(100):
-                time.sleep(0.02)
-                progress.progress(i + 1)
+    if st.session_state.job_error:
+        st.error(st.session_state.job_error)
+        st.session_state.job_error = None
+    if st.session_state.notice:
+        st.info(st.session_state.notice)
+        st.session_state.notice = None
 
-            story = create_story(
-                st.session_state.user_prompt,
-                st.session_state.child_name,
-                st.session_state.child_age,
-                st.session_state.lesson
-            )
-            st.session_state.current_story = story
-            st.session_state.story_history.append(story)
-            st.session_state.generating = False
-            st.rerun()
-    
-    # Generate audio narration for story
-    if st.session_state.generating_audio and st.session_state.current_story:
-        with st.spinner(""):
-            st.markdown(f"""
-                <div class='loading-text'>
-                    🎧 Tworzę narrację audio dla {st.session_state.current_story['child_name']}...<br>
-                    Głos: Nova (OpenAI TTS)<br>
-                    To może potrwać 10-20 sekund<br>
-                    💰 Koszt: ~$0.015
-                </div>
-            """, unsafe_allow_html=True)
-            
-            progress = st.progress(0)
-            for i in range(100):
-                time.sleep(0.05)  # Faster progress for OpenAI TTS
-                progress.progress(i + 1)
-            
-            audio_buffer = generate_audio_narration(
-                st.session_state.current_story['content'],
-                st.session_state.current_story['child_name']
-            )
-            
-            if audio_buffer:
-                st.session_state.story_audio_data = audio_buffer
-                st.success("✅ Narracja audio wygenerowana!")
-            
-            st.session_state.generating_audio = False
-            time.sleep(1)
-            st.rerun()
+    if st.session_state.phase == WAITING:
+        queue_panel()
+    elif st.session_state.phase in (STORY_JOB, AUDIO_JOB):
+        job_status_panel()
     
     # Display story
     if st.session_state.current_story:
@@ -807,7 +1216,9 @@ else:
         """, unsafe_allow_html=True)
         
         # Stats w jednej linii
-        words, sentences, reading_time = count_words_and_sentences(story['content'])
+        # Computed once when the story was generated (older history entries lack them)
+        stats = story if 'words' in story else story_stats(story['content'])
+        words, sentences, reading_time = stats['words'], stats['sentences'], stats['reading_minutes']
         st.markdown(f"""
             <div style='display: flex; justify-content: space-around; margin: 1rem 0; padding: 1rem; background: rgba(255,255,255,0.1); border-radius: 10px;'>
                 <div style='text-align: center; color: white;'>
@@ -825,12 +1236,20 @@ else:
             </div>
         """, unsafe_allow_html=True)
         
-        # Display audio player if exists
-        if st.session_state.story_audio_data:
+        # The cached file may have been evicted since, or made by another replica -
+        # look it up in the cache (shared tier included), else offer to narrate again
+        if st.session_state.story_audio_path and not os.path.exists(st.session_state.story_audio_path):
+            st.session_state.story_audio_path = audio_cache.path(os.path.basename(st.session_state.story_audio_path))
+
+        # Display audio player if exists - played from the cached file, not session memory
+        if st.session_state.story_audio_path:
             st.markdown("<h4 style='color: white; text-align: center; margin-top: 2rem;'>🎧 Posłuchaj Bajki</h4>", unsafe_allow_html=True)
             col_aud1, col_aud2, col_aud3 = st.columns([0.5, 2, 0.5])
             with col_aud2:
-                st.audio(st.session_state.story_audio_data, format='audio/mp3')
+                st.audio(
+                    audio_source(st.session_state.story_audio_path),
+                    format=AUDIO_MIME_TYPES[audio_format_of(st.session_state.story_audio_path)]
+                )
         
         # Story content
         st.markdown(f"""
@@ -839,6 +1258,10 @@ else:
             </div>
         """, unsafe_allow_html=True)
         
+        # Next variant for the same inputs, generated while this one is being read
+        if st.session_state.phase == STORY:
+            start_prefetch(story)
+
         # Action buttons - 3 columns now
         col_b1, col_b2, col_b3 = st.columns(3)
 
@@ -861,24 +1284,29 @@ Pomysł: {story['prompt']}
             )
         
         with col_b2:
-            if st.session_state.story_audio_data:
+            if st.session_state.story_audio_path:
+                # Read from disk only when clicked, not on every rerun
                 st.download_button(
                     label="🎧 Pobierz audio",
-                    data=st.session_state.story_audio_data.getvalue(),
-                    file_name=f"bajka_{story['child_name'].lower()}_{int(time.time())}.mp3",
-                    mime="audio/mpeg",
+                    data=partial(read_file, st.session_state.story_audio_path),
+                    file_name=f"bajka_{story['child_name'].lower()}_{int(time.time())}.{audio_format_of(st.session_state.story_audio_path)}",
+                    mime=AUDIO_MIME_TYPES[audio_format_of(st.session_state.story_audio_path)],
+                    on_click="ignore",
                     use_container_width=True
                 )
             else:
-                if st.button("🎧 Czytaj bajkę", use_container_width=True, key="generate_audio"):
-                    st.session_state.generating_audio = True
-                    st.rerun()
+                st.button(
+                    "🎧 Czytaj bajkę", use_container_width=True, key="generate_audio",
+                    on_click=request_narration, disabled=st.session_state.phase == AUDIO_JOB
+                )
         
         with col_b3:
-            if st.button("🔄 Nowa bajka", use_container_width=True):
-                st.session_state.generating = True
-                st.session_state.story_audio_data = None
-                st.rerun()
+            st.button(
+                "🔄 Nowa bajka", use_container_width=True, on_click=request_story,
+                # The idea as asked for - an empty one is served from the pool again
+                args=(story['child_name'], story['child_age'], story['lesson'], raw_prompt(story)),
+                disabled=st.session_state.phase == AUDIO_JOB
+            )
     
     # Close single column container
     st.markdown("</div>", unsafe_allow_html=True)
@@ -908,32 +1336,28 @@ Pomysł: {story['prompt']}
     st.markdown("<div style='height: 2rem;'></div>", unsafe_allow_html=True)
     # =========================================
     
-    # Sidebar with history
+    # Sidebar with the story library
     with st.sidebar:
-        st.markdown("### 📚 Historia Bajek")
-
-        if st.session_state.story_history:
-            st.markdown(f"*Utworzono {len(st.session_state.story_history)} bajek*")
-
-            for i, story in enumerate(reversed(st.session_state.story_history[-5:]), 1):
-                with st.expander(f"📖 Dla: {story['child_name']}"):
-                    st.write(f"**Wiek:** {story['child_age']}")
-                    st.write(f"**Wartość:** {story['lesson']}")
-                    st.write(f"**Fragment:** {story['content'][:100]}...")
-                    if st.button(f"Wczytaj", key=f"load_{i}"):
-                        st.session_state.current_story = story
-                        st.rerun()
-
-            if st.button("🗑️ Wyczyść historię", use_container_width=True):
-                st.session_state.story_history = []
-                st.session_state.current_story = None
-                st.session_state.story_image_url = None
-                st.session_state.story_image_data = None
-                st.session_state.story_audio_data = None
-                st.rerun()
-        else:
-            st.info("Brak historii")
-        
+        if len(AUDIO_FORMATS) > 1:
+            st.selectbox(
+                "🎧 Format audio",
+                AUDIO_FORMATS,
+                index=AUDIO_FORMATS.index(st.session_state.audio_format),
+                key="audio_format_input",
+                format_func=AUDIO_FORMAT_LABELS.get,
+                on_change=change_audio_format,
+                help="Opus i AAC zużywają mniej danych komórkowych niż MP3"
+            )
+        library_panel()
+
+        # Memory accounting of this session (SHOW_MEMORY_STATS=1)
+        if get_secret("SHOW_MEMORY_STATS", "0") == "1":
+            with st.expander("🧠 Pamięć sesji"):
+                report = memory_report(st.session_state)
+                st.write(f"**Razem:** {sum(size for _, size in report) / 1024:.1f} KB")
+                for key, size in report:
+                    st.write(f"`{key}`: {size / 1024:.1f} KB")
+
         st.markdown("---")
         st.markdown("""
             <div style='text-align: center; color: rgba(255,255,255,0.7); font-size: 12px;'>
@@ -942,6 +1366,7 @@ Pomysł: {story['prompt']}
             </div>
         """, unsafe_allow_html=True)
         
-        if st.button("← Powrót do strony głównej", use_container_width=True):
-            st.session_state.page = 'landing'
-            st.rerun()
\ No newline at end of file
+        st.button("← Powrót do strony głównej", use_container_width=True, on_click=go_to, args=('landing',))
+
+# Only completed runs are timed - st.rerun()/st.stop() end a run early
+metrics.script_run_seconds.observe(time.perf_counter() - script_run_started, page=st.session_state.page)
@@ -0,0 +1,229 @@
+import hashlib
+import logging
+import os
+import threading
+
+from backends import get_backend
+from clients import get_secret
+
+logger = logging.getLogger(__name__)
+
+# Narrations go to the shared backend in parts of this size, so neither side holds a whole file
+SHARED_PART_BYTES = 256 * 1024
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class AudioCache:
+    """Content-addressed on-disk cache for narrations with LRU eviction.
+
+    Files are named after hash(text, model, voice, format); the file mtime is
+    the last access time, so the cache survives restarts without an index.
+    With a shared backend, every narration is also stored there (for
+    shared_ttl seconds, in SHARED_PART_BYTES parts) and a local miss is looked
+    up there before it counts as a miss - replicas don't pay for each other's
+    narrations.
+    """
+
+    def __init__(self, directory, max_bytes, backend=None, shared_ttl=7 * 24 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backend = backend if backend is not None and backend.shared else None
+        self.shared_ttl = shared_ttl
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # key -> (size, last access) for everything already on disk
+        self._entries = {}
+        for name in os.listdir(directory):
+            if name.endswith(".tmp"):
+                continue
+            stat = os.stat(os.path.join(directory, name))
+            self._entries[name] = (stat.st_size, stat.st_mtime)
+        self._size = sum(size for size, _ in self._entries.values())
+
+    @staticmethod
+    def key(text, model, voice, fmt):
+        digest = hashlib.sha256()
+        for part in (model, voice, fmt, text):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return f"{digest.hexdigest()}.{fmt}"
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def _fetch_shared(self, key):
+        """Copy an entry another replica stored into the local cache; returns its path or None."""
+        if not self.backend:
+            return None
+        try:
+            parts = self.backend.get(f"audio:{key}:parts")
+            if parts is None:
+                return None
+            path = self._store(key, lambda f: self._read_shared(key, int(parts), f))[0]
+        except Exception:
+            return None
+        if path:
+            with self._lock:
+                self.shared_hits += 1
+        return path
+
+    def get(self, key):
+        """Return cached bytes or None (counts as hit/miss)."""
+        if key not in self and self._fetch_shared(key):
+            return self.get(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key), "rb") as f:
+                    data = f.read()
+                os.utime(self._path(key))
+            except FileNotFoundError:
+                # Removed behind our back (e.g. manual cleanup)
+                self._size -= entry[0]
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries[key] = (entry[0], os.path.getmtime(self._path(key)))
+            self.hits += 1
+            return data
+
+    def path(self, key):
+        """Path of the cached file or None (counts as hit/miss) - lets callers
+        keep a file reference instead of the bytes."""
+        if key not in self and self._fetch_shared(key):
+            return self.path(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not os.path.exists(self._path(key)):
+                if entry is not None:
+                    self._size -= entry[0]
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            os.utime(self._path(key))
+            self._entries[key] = (entry[0], os.path.getmtime(self._path(key)))
+            self.hits += 1
+            return self._path(key)
+
+    def put(self, key, data):
+        """Store data; returns the file path, or None if it can't be cached."""
+        if len(data) > self.max_bytes:
+            return None
+        return self.put_stream(key, lambda f: f.write(data))[0]
+
+    def put_stream(self, key, write):
+        """Store whatever write(file) writes, without holding it in memory.
+
+        Returns (path, size); path is None if the file is too big to cache.
+        """
+        path, size = self._store(key, write)
+        if path and self.backend:
+            try:
+                self._write_shared(key, path)
+            except Exception as e:
+                # Still cached locally - only other replicas miss it
+                logger.warning("Narration %s not shared: %s", key, e)
+        return path, size
+
+    def _write_shared(self, key, path):
+        parts = 0
+        with open(path, "rb") as f:
+            while True:
+                part = f.read(SHARED_PART_BYTES)
+                if not part:
+                    break
+                self.backend.set(f"audio:{key}:{parts}", part, self.shared_ttl)
+                parts += 1
+        # The part count goes last - until then other replicas don't see a half-stored narration
+        self.backend.set(f"audio:{key}:parts", str(parts), self.shared_ttl)
+
+    def _read_shared(self, key, parts, f):
+        for number in range(parts):
+            part = self.backend.get(f"audio:{key}:{number}")
+            if part is None:
+                raise KeyError(f"audio:{key}:{number} expired")
+            f.write(part)
+
+    def _store(self, key, write):
+        # Unique per process and thread - replicas may share the directory
+        tmp_path = self._path(key) + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                write(f)
+                size = f.tell()
+        except BaseException:
+            _remove(tmp_path)
+            raise
+        if size > self.max_bytes:
+            _remove(tmp_path)
+            return None, size
+        with self._lock:
+            os.replace(tmp_path, self._path(key))
+            old = self._entries.get(key)
+            if old:
+                self._size -= old[0]
+            self._entries[key] = (size, os.path.getmtime(self._path(key)))
+            self._size += size
+            self._evict()
+            return (self._path(key) if key in self._entries else None), size
+
+    def _evict(self):
+        if self._size <= self.max_bytes:
+            return
+        for key, (size, _) in sorted(self._entries.items(), key=lambda item: item[1][1]):
+            if self._size <= self.max_bytes:
+                break
+            _remove(self._path(key))
+            del self._entries[key]
+            self._size -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "shared_hits": self.shared_hits,
+                "evictions": self.evictions,
+            }
+
+
+# Inside the app's static folder by default, so Streamlit's static file serving plays the files
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "audio")
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_audio_cache():
+    """Process-wide audio cache (AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_MB, AUDIO_SHARED_TTL_HOURS)."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = AudioCache(
+                get_secret("AUDIO_CACHE_DIR", DEFAULT_DIRECTORY),
+                int(float(get_secret("AUDIO_CACHE_MAX_MB", 500)) * 1024 * 1024),
+                backend=get_backend(),
+                shared_ttl=float(get_secret("AUDIO_SHARED_TTL_HOURS", 24 * 7)) * 3600
+            )
+    return _cache
@@ -0,0 +1,320 @@
+import io
+import itertools
+import os
+import re
+import shutil
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Sentence end (., !, ?, … optionally followed by closing quotes) or a paragraph break
+SENTENCE_BOUNDARY = re.compile(r'[.!?…]+["”»)]*\s+|\n\s*\n')
+
+# Shared by every session in the process - Streamlit re-runs the script,
+# but imported modules stay loaded, so this pool is created only once
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("TTS_MAX_WORKERS", "4")),
+    thread_name_prefix="tts"
+)
+
+
+def split_finished_chunks(text, min_chars):
+    """Split text into chunks of at least min_chars ending on a sentence boundary.
+
+    Returns (chunks, rest) where rest is the unfinished tail that still has to
+    wait for more tokens.
+    """
+    chunks = []
+    start = 0
+    for match in SENTENCE_BOUNDARY.finditer(text):
+        if match.end() - start >= min_chars:
+            chunks.append(text[start:match.end()])
+            start = match.end()
+    return chunks, text[start:]
+
+
+# OpenAI TTS rejects input longer than this
+MAX_TTS_CHARS = 4096
+
+# TTS response formats whose segments can be joined, with their MIME types
+# (the cache file extension is the format name)
+AUDIO_MIME_TYPES = {"mp3": "audio/mpeg", "opus": "audio/ogg", "aac": "audio/aac"}
+
+
+def _split_long(sentence, max_chars):
+    """Break a sentence longer than max_chars on commas, then on spaces."""
+    pieces = []
+    while len(sentence) > max_chars:
+        cut = sentence.rfind(", ", 0, max_chars)
+        if cut <= 0:
+            cut = sentence.rfind(" ", 0, max_chars)
+        cut = cut + 1 if cut > 0 else max_chars
+        pieces.append(sentence[:cut])
+        sentence = sentence[cut:]
+    pieces.append(sentence)
+    return pieces
+
+
+def split_for_tts(text, target_chars=600, max_chars=MAX_TTS_CHARS):
+    """Split a finished text into TTS chunks on paragraph/sentence boundaries.
+
+    Chunks are packed up to target_chars (never above max_chars), so they are
+    of similar length and synthesize in about the same time.
+    """
+    sentences = []
+    start = 0
+    for match in SENTENCE_BOUNDARY.finditer(text):
+        sentences.append(text[start:match.end()])
+        start = match.end()
+    sentences.append(text[start:])
+
+    chunks = []
+    current = ""
+    for sentence in sentences:
+        for piece in _split_long(sentence, max_chars):
+            # Prefer to start a new chunk at a paragraph break
+            paragraph_break = current.endswith("\n") and len(current) >= target_chars // 2
+            if current and (len(current) + len(piece) > target_chars or paragraph_break):
+                chunks.append(current)
+                current = ""
+            current += piece
+    chunks.append(current)
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+
+# Bitrates (kbps) and sample rates per MPEG version, for MP3 frame sizes
+_BITRATES_V1 = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+_BITRATES_V2 = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def _frame_length(header):
+    """Length of the Layer III frame starting with this 4-byte header, or None."""
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 0x03
+    if version == 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    padding = (header[2] >> 1) & 0x01
+    if version == 3:
+        return 144000 * _BITRATES_V1[bitrate_index] // _SAMPLE_RATES[3][rate_index] + padding
+    return 72000 * _BITRATES_V2[bitrate_index] // _SAMPLE_RATES[version][rate_index] + padding
+
+
+def _audio_frames(data):
+    """Strip ID3 tags and the Xing/Info header frame, leaving only audio frames."""
+    view = memoryview(data)
+    start = 0
+    if view[:3] == b"ID3" and len(view) >= 10:
+        size = (view[6] << 21) | (view[7] << 14) | (view[8] << 7) | view[9]
+        start = 10 + size + (10 if view[5] & 0x10 else 0)
+    end = len(view)
+    if end - start >= 128 and view[end - 128:end - 125] == b"TAG":
+        end -= 128
+    length = _frame_length(bytes(view[start:start + 4]))
+    if length and any(marker in bytes(view[start:start + min(length, 64)]) for marker in (b"Xing", b"Info", b"VBRI")):
+        # VBR header frame describes one segment only - wrong for the joined file
+        start += length
+    return view[start:end]
+
+
+def _strip_id3(data):
+    """ADTS (aac) segment without a leading ID3 tag - raw ADTS frames simply concatenate."""
+    view = memoryview(data)
+    if view[:3] == b"ID3" and len(view) >= 10:
+        size = (view[6] << 21) | (view[7] << 14) | (view[8] << 7) | view[9]
+        return view[10 + size + (10 if view[5] & 0x10 else 0):]
+    return view
+
+
+# Ogg's CRC-32 is the unreflected one (poly 0x04C11DB7, no init/final xor);
+# computed with zlib's reflected crc32 on bit-reversed bytes, which is much
+# faster than a CRC table loop in Python
+_REVERSED_BITS = bytes(int(f"{byte:08b}"[::-1], 2) for byte in range(256))
+
+
+def _ogg_crc(page):
+    crc = zlib.crc32(page.translate(_REVERSED_BITS), 0xFFFFFFFF) ^ 0xFFFFFFFF
+    return int(f"{crc:032b}"[::-1], 2)
+
+
+def _ogg_pages(data):
+    """(header, segment table, body) of every Ogg page in data."""
+    view = memoryview(data)
+    position = 0
+    while position + 27 <= len(view):
+        if view[position:position + 4] != b"OggS":
+            raise ValueError("Not an Ogg stream")
+        segments = view[position + 26]
+        table = bytes(view[position + 27:position + 27 + segments])
+        body_start = position + 27 + segments
+        yield bytes(view[position:position + 27]), table, view[body_start:body_start + sum(table)]
+        position = body_start + sum(table)
+
+
+class OggJoiner:
+    """Joins Ogg Opus segments into one logical stream without re-encoding.
+
+    Chained Ogg files (segments simply concatenated) stop after the first link
+    in most browsers. Here the ID and comment headers of every later segment
+    are dropped, and its pages get the first segment's serial number,
+    continuing page numbers and shifted granule positions. Each segment's
+    pre-skip is played rather than trimmed - a few milliseconds at a join.
+    """
+
+    def __init__(self):
+        self._serial = None
+        self._sequence = 0
+        self._last_granule = 0
+
+    def write(self, data, out, last):
+        skip_packets = 0 if self._serial is None else 2
+        granule_offset = self._last_granule
+        pages = list(_ogg_pages(data))
+        for index, (header, table, body) in enumerate(pages):
+            if skip_packets:
+                # Packets end on lacing values below 255; headers fill whole pages
+                skip_packets -= min(skip_packets, sum(1 for lacing in table if lacing < 255))
+                continue
+            flags, granule, serial = struct.unpack_from("<BqI", header, 5)
+            if self._serial is None:
+                self._serial = serial
+            if index == len(pages) - 1 and not last:
+                flags &= ~0x04
+            if granule != -1:
+                granule += granule_offset
+                self._last_granule = granule
+            page = bytearray(header + table + body)
+            struct.pack_into("<BqIII", page, 5, flags, granule, self._serial, self._sequence, 0)
+            struct.pack_into("<I", page, 22, _ogg_crc(page))
+            out.write(page)
+            self._sequence += 1
+
+
+def _read_part(part):
+    if isinstance(part, (bytes, bytearray)):
+        return part
+    with part:
+        return part.read()
+
+
+def write_audio(parts, out, fmt="mp3"):
+    """Join TTS segments (bytes or file objects, e.g. spooled TTS responses) in fmt into out.
+
+    Segments are read and released one at a time, so the joined narration is
+    never held in memory. parts may be a generator. mp3 and aac segments are
+    stripped of their tags and concatenated frame by frame, opus (Ogg)
+    segments are merged into one stream (OggJoiner); other formats (wav,
+    flac) can't be joined and must come as a single segment.
+    """
+    parts = iter(parts)
+    first = next(parts, None)
+    second = next(parts, None)
+    if second is None:
+        # Single segment: copy it as is, tags and VBR header included
+        if isinstance(first, (bytes, bytearray)):
+            out.write(first)
+        elif first is not None:
+            with first:
+                shutil.copyfileobj(first, out)
+        return
+    if fmt == "opus":
+        joiner = OggJoiner()
+        current = _read_part(first)
+        for part in itertools.chain((second,), parts):
+            joiner.write(current, out, last=False)
+            current = _read_part(part)
+        joiner.write(current, out, last=True)
+        return
+    frames = {"mp3": _audio_frames, "aac": _strip_id3}.get(fmt)
+    if frames is None:
+        raise ValueError(f"Cannot join {fmt} segments")
+    for part in itertools.chain((first, second), parts):
+        out.write(frames(_read_part(part)))
+
+
+def join_audio(parts, fmt="mp3"):
+    """Join segments in fmt in order without re-encoding."""
+    if len(parts) == 1:
+        return parts[0]
+    out = io.BytesIO()
+    write_audio(parts, out, fmt)
+    return out.getvalue()
+
+
+def _results(futures):
+    for future in futures:
+        yield future.result()
+
+
+def synthesize_narration(synthesize, text, target_chars=600, out=None, fmt="mp3"):
+    """Synthesize a finished text as parallel chunks and return one file in fmt.
+
+    Wall time follows the slowest chunk instead of the whole text, and texts
+    longer than the TTS input limit no longer fail. With out (a binary file)
+    the audio is written there chunk by chunk instead of being returned.
+    """
+    chunks = split_for_tts(text, target_chars)
+    futures = [_executor.submit(synthesize, chunk) for chunk in chunks]
+    try:
+        if out is not None:
+            return write_audio(_results(futures), out, fmt)
+        return join_audio([future.result() for future in futures], fmt)
+    except Exception:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+class NarrationPipeline:
+    """Synthesizes a story sentence-by-sentence while it is still being generated.
+
+    feed() is called with the whole text generated so far; every chunk that is
+    already finished is sent to TTS right away. finish() flushes the tail and
+    returns the complete narration in fmt, or writes it to out.
+    """
+
+    def __init__(self, synthesize, min_chars=400, executor=None, fmt="mp3"):
+        self._synthesize = synthesize
+        self._fmt = fmt
+        self._min_chars = min_chars
+        self._executor = executor or _executor
+        self._consumed = 0
+        self._futures = []
+
+    @property
+    def chunk_count(self):
+        return len(self._futures)
+
+    def _submit(self, chunk):
+        if chunk.strip():
+            self._futures.append(self._executor.submit(self._synthesize, chunk.strip()))
+
+    def feed(self, text):
+        chunks, _ = split_finished_chunks(text[self._consumed:], self._min_chars)
+        for chunk in chunks:
+            for piece in split_for_tts(chunk, MAX_TTS_CHARS):
+                self._submit(piece)
+            self._consumed += len(chunk)
+
+    def continue_at(self, start):
+        """The text fed from now on is rewritten up to start (a continuation joined on).
+
+        Only whitespace before start may have changed, so whatever was sent
+        beyond it is not sent again.
+        """
+        self._consumed = min(self._consumed, start)
+
+    def finish(self, text, out=None):
+        for chunk in split_for_tts(text[self._consumed:], self._min_chars):
+            self._submit(chunk)
+        self._consumed = len(text)
+        if out is not None:
+            return write_audio(_results(self._futures), out, self._fmt)
+        return join_audio([future.result() for future in self._futures], self._fmt)
+
+    def cancel(self):
+        for future in self._futures:
+            future.cancel()
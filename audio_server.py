@@ -0,0 +1,181 @@
+"""Narrations served straight from the audio cache directory, with HTTP Range support.
+
+st.audio(path) copies the whole file into Streamlit's in-memory media store
+for every session that plays it. Served from here instead, the browser
+requests byte ranges of the cached file - playback starts after the first
+range and seeking skips the rest - and, since cache files are named after
+their content hash, can keep them forever.
+"""
+import logging
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from audio_pipeline import AUDIO_MIME_TYPES
+from clients import get_secret
+
+logger = logging.getLogger(__name__)
+
+_FILE_NAME = re.compile(r"/audio/([0-9a-f]{64})\.(\w+)$")
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+COPY_CHUNK = 64 * 1024
+
+
+def parse_range(header, size):
+    """(first, last) byte of a single-range Range header, None for the whole file.
+
+    Raises ValueError when the range can't be satisfied (answered with 416).
+    Multi-range requests are answered with the whole file, as RFC 9110 allows.
+    """
+    match = _RANGE.match(header.strip()) if header else None
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        first, last = max(0, size - int(last)), size - 1
+    else:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+    if first >= size or first > last:
+        raise ValueError(header)
+    return first, last
+
+
+def preferred_format(user_agent, formats, default):
+    """Smallest narration format the client plays: aac on iOS (older Safari has no Ogg),
+    opus on other phones, default on desktops."""
+    user_agent = (user_agent or "").lower()
+    if any(device in user_agent for device in ("iphone", "ipad", "ipod")):
+        choice = "aac"
+    elif "android" in user_agent or "mobile" in user_agent:
+        choice = "opus"
+    else:
+        choice = default
+    return choice if choice in formats else default
+
+
+def start_audio_server(directory, port, host="0.0.0.0"):
+    """Serve GET/HEAD /audio/<cache file> from directory in a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_HEAD(self):
+            self._serve(body=False)
+
+        def do_GET(self):
+            self._serve(body=True)
+
+        def _serve(self, body):
+            match = _FILE_NAME.match(urlsplit(self.path).path)
+            if not match or match.group(2) not in AUDIO_MIME_TYPES:
+                self.send_error(404)
+                return
+            digest, fmt = match.groups()
+            try:
+                f = open(os.path.join(directory, f"{digest}.{fmt}"), "rb")
+            except FileNotFoundError:
+                # Evicted from the cache - the app offers to narrate again
+                self.send_error(404)
+                return
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                etag = f'"{digest}"'
+                if etag in self.headers.get("If-None-Match", ""):
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                try:
+                    byte_range = parse_range(self.headers.get("Range"), size)
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                first, last = byte_range or (0, size - 1)
+                self.send_response(206 if byte_range else 200)
+                self.send_header("Content-Type", AUDIO_MIME_TYPES[fmt])
+                self.send_header("Content-Length", str(last - first + 1))
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("ETag", etag)
+                # Named after the content hash - never changes
+                self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+                if byte_range:
+                    self.send_header("Content-Range", f"bytes {first}-{last}/{size}")
+                self.end_headers()
+                if not body:
+                    return
+                f.seek(first)
+                remaining = last - first + 1
+                try:
+                    while remaining > 0:
+                        chunk = f.read(min(COPY_CHUNK, remaining))
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+                        remaining -= len(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    # Players drop connections when seeking
+                    pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="audio-server", daemon=True).start()
+    return server
+
+
+class AudioServer:
+    """The running file server and how browsers reach it."""
+
+    def __init__(self, server, public_url=None):
+        self.server = server
+        self.port = server.server_address[1]
+        self.public_url = public_url
+
+    def url(self, path, page_url=None):
+        """Browser URL of a cached narration file, or None if browsers cannot reach it.
+
+        Without AUDIO_PUBLIC_URL the server is addressed on its own port of
+        the host the page was loaded from. It speaks plain HTTP only, which a
+        page loaded over https may not play from - such pages get None.
+        """
+        base = self.public_url
+        if not base:
+            page = urlsplit(page_url or "")
+            if page.scheme == "https":
+                return None
+            base = f"http://{page.hostname or 'localhost'}:{self.port}"
+        return f"{base.rstrip('/')}/audio/{os.path.basename(path)}"
+
+
+_audio_server = None
+_audio_server_failed = False
+_audio_server_lock = threading.Lock()
+
+
+def get_audio_server(directory):
+    """Process-wide audio file server on AUDIO_SERVER_PORT, or None when it is not set.
+
+    AUDIO_PUBLIC_URL is its address as seen by browsers (e.g. behind a
+    reverse proxy, without the /audio suffix).
+    """
+    global _audio_server, _audio_server_failed
+    with _audio_server_lock:
+        if _audio_server is None and not _audio_server_failed:
+            port = get_secret("AUDIO_SERVER_PORT")
+            if not port:
+                return None
+            try:
+                server = start_audio_server(directory, int(port), get_secret("AUDIO_SERVER_HOST", "0.0.0.0"))
+            except OSError as e:
+                # e.g. another worker process already serves this port - not retried on every run
+                logger.warning("Audio server not started on port %s: %s", port, e)
+                _audio_server_failed = True
+                return None
+            _audio_server = AudioServer(server, get_secret("AUDIO_PUBLIC_URL"))
+    return _audio_server
@@ -0,0 +1,519 @@
+"""State shared by app replicas: cache entries, story pool queues, leases, rate-limit buckets, job status,
+story library.
+
+BACKEND selects where it lives:
+  memory - this process only (default; one replica)
+  sqlite - a SQLite file (BACKEND_PATH) shared by the processes of one host
+  redis  - a Redis server (REDIS_URL), spoken to over its wire protocol, so
+           no client library is needed
+
+All three implement the same small interface on bytes values. A replica
+added behind the load balancer then finds the narrations, pooled stories
+and rate budget of the others instead of paying for its own.
+"""
+import json
+import os
+import select
+import socket
+import sqlite3
+import ssl
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from urllib.parse import unquote, urlsplit
+
+from clients import get_secret
+
+
+class BackendError(Exception):
+    """The backend answered with an error (e.g. a Redis error reply)."""
+
+
+def _bytes(value):
+    return value.encode("utf-8") if isinstance(value, str) else bytes(value)
+
+
+def _take_tokens(tokens, updated, now, amount, rate, capacity, max_wait):
+    """One token bucket reservation: (new balance, wait, granted).
+
+    The balance may go negative - the wait is how long until it is back at
+    zero - unless that wait would exceed max_wait, in which case nothing is taken.
+    """
+    tokens = capacity if tokens is None else min(capacity, tokens + (now - updated) * rate)
+    wait = max(0.0, (amount - tokens) / rate)
+    if max_wait is not None and wait > max_wait:
+        return tokens, wait, False
+    return tokens - amount, wait, True
+
+
+class Backend:
+    """Interface of the backends; values are bytes (str is stored UTF-8 encoded).
+
+    get/set/delete    - cache entries, ttl in seconds (None = no expiry); delete removes a queue too
+    add               - set only if absent; True if set (leases between replicas)
+    incr              - add to a numeric counter, returns the new value; ttl only when it is created
+    push/pop/length   - FIFO queues; items lists a queue without popping it
+    reserve/refund    - token buckets: reserve returns (granted, wait seconds)
+    """
+
+    # False when nothing is shared with other processes (no point in mirroring into it)
+    shared = True
+    name = "backend"
+
+    def get_json(self, key):
+        value = self.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set_json(self, key, value, ttl=None):
+        self.set(key, json.dumps(value, ensure_ascii=False, default=str), ttl)
+
+
+class MemoryBackend(Backend):
+    shared = False
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._lists = defaultdict(deque)
+        self._buckets = {}
+
+    def _live(self, key, now):
+        entry = self._values.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self._values[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key, time.monotonic())
+        return entry[0] if entry else None
+
+    def set(self, key, value, ttl=None):
+        now = time.monotonic()
+        with self._lock:
+            self._values[key] = (_bytes(value), now + ttl if ttl is not None else None)
+            if len(self._values) % 256 == 0:
+                for stale in [k for k, (_, expires) in self._values.items() if expires is not None and expires <= now]:
+                    del self._values[stale]
+
+    def add(self, key, value, ttl=None):
+        now = time.monotonic()
+        with self._lock:
+            if self._live(key, now) is not None:
+                return False
+            self._values[key] = (_bytes(value), now + ttl if ttl is not None else None)
+            return True
+
+    def incr(self, key, amount, ttl=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._live(key, now)
+            value = float(entry[0]) + amount if entry else float(amount)
+            expires = entry[1] if entry else (now + ttl if ttl is not None else None)
+            self._values[key] = (repr(value).encode(), expires)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+            self._lists.pop(key, None)
+
+    def push(self, key, value):
+        with self._lock:
+            self._lists[key].append(_bytes(value))
+
+    def pop(self, key):
+        with self._lock:
+            items = self._lists.get(key)
+            return items.popleft() if items else None
+
+    def length(self, key):
+        with self._lock:
+            return len(self._lists.get(key, ()))
+
+    def items(self, key):
+        with self._lock:
+            return list(self._lists.get(key, ()))
+
+    def reserve(self, key, amount, rate, capacity, max_wait=None):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (None, now))
+            tokens, wait, granted = _take_tokens(tokens, updated, now, amount, rate, capacity, max_wait)
+            self._buckets[key] = (tokens, now)
+        return granted, wait
+
+    def refund(self, key, amount, capacity):
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated = self._buckets[key]
+                self._buckets[key] = (min(capacity, tokens + amount), updated)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL);
+CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, value BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS queue_key_id ON queue (key, id);
+CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL);
+"""
+
+
+class SQLiteBackend(Backend):
+    """One SQLite file for every process on the host (WAL; read-modify-write under BEGIN IMMEDIATE).
+
+    Not for network filesystems - SQLite locking isn't reliable there; use Redis across hosts.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._writes = 0
+        # Autocommit mode - transactions are opened explicitly below
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SQLITE_SCHEMA)
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+            ).fetchone()
+        return bytes(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, _bytes(value), now + ttl if ttl is not None else None)
+            )
+            self._writes += 1
+            if self._writes % 256 == 0:
+                conn.execute("DELETE FROM kv WHERE expires_at <= ?", (now,))
+
+    def add(self, key, value, ttl=None):
+        now = time.time()
+        with self._transaction() as conn:
+            if conn.execute(
+                "SELECT 1 FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, now)
+            ).fetchone():
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, _bytes(value), now + ttl if ttl is not None else None)
+            )
+            return True
+
+    def incr(self, key, amount, ttl=None):
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT value, expires_at FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, now)
+            ).fetchone()
+            value = float(row[0]) + amount if row else float(amount)
+            expires = row[1] if row else (now + ttl if ttl is not None else None)
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)", (key, repr(value).encode(), expires)
+            )
+        return value
+
+    def delete(self, key):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+            conn.execute("DELETE FROM queue WHERE key = ?", (key,))
+
+    def push(self, key, value):
+        with self._transaction() as conn:
+            conn.execute("INSERT INTO queue (key, value) VALUES (?, ?)", (key, _bytes(value)))
+
+    def pop(self, key):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT id, value FROM queue WHERE key = ? ORDER BY id LIMIT 1", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("DELETE FROM queue WHERE id = ?", (row[0],))
+        return bytes(row[1])
+
+    def length(self, key):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM queue WHERE key = ?", (key,)).fetchone()[0]
+
+    def items(self, key):
+        with self._lock:
+            rows = self._conn.execute("SELECT value FROM queue WHERE key = ? ORDER BY id", (key,)).fetchall()
+        return [bytes(row[0]) for row in rows]
+
+    def reserve(self, key, amount, rate, capacity, max_wait=None):
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (None, now)
+            tokens, wait, granted = _take_tokens(tokens, updated, now, amount, rate, capacity, max_wait)
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+        return granted, wait
+
+    def refund(self, key, amount, capacity):
+        with self._transaction() as conn:
+            conn.execute("UPDATE buckets SET tokens = MIN(?, tokens + ?) WHERE key = ?", (capacity, amount, key))
+
+
+# Token bucket as one atomic script, timed by the Redis server's clock (Redis 5+)
+RESERVE_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local amount, rate, capacity, max_wait = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = capacity
+if state[1] then
+    tokens = math.min(capacity, tonumber(state[1]) + (now - tonumber(state[2])) * rate)
+end
+local wait = math.max(0, (amount - tokens) / rate)
+if max_wait >= 0 and wait > max_wait then
+    return {0, tostring(wait)}
+end
+tokens = tokens - amount
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+-- A bucket left alone refills completely; then it needn't be kept
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 60000)
+return {1, tostring(wait)}
+"""
+
+REFUND_SCRIPT = """
+local tokens = redis.call('HGET', KEYS[1], 'tokens')
+if tokens then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(math.min(tonumber(ARGV[2]), tonumber(tokens) + tonumber(ARGV[1]))))
+end
+return 1
+"""
+
+INCR_SCRIPT = """
+local value = redis.call('INCRBYFLOAT', KEYS[1], ARGV[1])
+if tonumber(ARGV[2]) > 0 and redis.call('PTTL', KEYS[1]) == -1 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return value
+"""
+
+
+class _RedisConnection:
+    def __init__(self, host, port, use_ssl, timeout):
+        sock = socket.create_connection((host, port), timeout=timeout)
+        if use_ssl:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+
+    def stale(self):
+        """An idle connection with something to read has been closed (or reset) by the server."""
+        try:
+            return bool(select.select([self.sock], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True
+
+    def send(self, args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            arg = _bytes(arg if isinstance(arg, (str, bytes, bytearray)) else str(arg))
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self.sock.sendall(b"".join(parts))
+
+    def read(self):
+        line = self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by Redis")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload
+        if kind == b"-":
+            raise BackendError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            size = int(payload)
+            if size < 0:
+                return None
+            data = self.reader.read(size + 2)
+            return data[:-2]
+        if kind == b"*":
+            count = int(payload)
+            return None if count < 0 else [self.read() for _ in range(count)]
+        raise BackendError(f"Unexpected Redis reply: {line!r}")
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisBackend(Backend):
+    """Redis over RESP with a small connection pool.
+
+    url: redis://[[user]:password@]host[:port][/db], rediss:// for TLS.
+    Keys get prefix, so one Redis can serve several deployments.
+    """
+
+    name = "redis"
+
+    def __init__(self, url, prefix="bajki:", timeout=5.0, max_idle=8):
+        parts = urlsplit(url)
+        if parts.scheme not in ("redis", "rediss"):
+            raise ValueError(f"Unsupported Redis URL: {url}")
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.use_ssl = parts.scheme == "rediss"
+        self.username = unquote(parts.username) if parts.username else None
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.strip("/") or 0)
+        self.prefix = prefix
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _connect(self):
+        connection = _RedisConnection(self.host, self.port, self.use_ssl, self.timeout)
+        try:
+            if self.password:
+                connection.send(["AUTH", self.username, self.password] if self.username else ["AUTH", self.password])
+                connection.read()
+            if self.db:
+                connection.send(["SELECT", self.db])
+                connection.read()
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    def command(self, *args):
+        """Run one command and return its reply.
+
+        A pooled connection that fails while the command is being sent is
+        replaced and the command sent once more. Once it has been sent, a
+        failure is raised as it is - the command may have run already, and
+        RPUSH, INCRBYFLOAT or the reserve script must not run twice.
+        """
+        for attempt in range(2):
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            if connection is not None and connection.stale():
+                connection.close()
+                connection = None
+            fresh = connection is None
+            if fresh:
+                connection = self._connect()
+            try:
+                connection.send(args)
+            except OSError:
+                connection.close()
+                # Only a pooled connection may have gone stale in the meantime
+                if fresh or attempt:
+                    raise
+                continue
+            try:
+                reply = connection.read()
+            except BackendError:
+                self._release(connection)
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            self._release(connection)
+            return reply
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def _expiry(self, ttl):
+        return ["PX", max(1, int(ttl * 1000))] if ttl is not None else []
+
+    def get(self, key):
+        return self.command("GET", self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.command("SET", self.prefix + key, _bytes(value), *self._expiry(ttl))
+
+    def add(self, key, value, ttl=None):
+        return self.command("SET", self.prefix + key, _bytes(value), "NX", *self._expiry(ttl)) == b"OK"
+
+    def incr(self, key, amount, ttl=None):
+        ttl_ms = max(1, int(ttl * 1000)) if ttl is not None else 0
+        return float(self.command("EVAL", INCR_SCRIPT, 1, self.prefix + key, repr(float(amount)), ttl_ms))
+
+    def delete(self, key):
+        self.command("DEL", self.prefix + key)
+
+    def push(self, key, value):
+        self.command("RPUSH", self.prefix + key, _bytes(value))
+
+    def pop(self, key):
+        return self.command("LPOP", self.prefix + key)
+
+    def length(self, key):
+        return self.command("LLEN", self.prefix + key)
+
+    def items(self, key):
+        return self.command("LRANGE", self.prefix + key, 0, -1)
+
+    def reserve(self, key, amount, rate, capacity, max_wait=None):
+        granted, wait = self.command(
+            "EVAL", RESERVE_SCRIPT, 1, self.prefix + key,
+            repr(float(amount)), repr(float(rate)), repr(float(capacity)),
+            repr(float(max_wait)) if max_wait is not None else "-1"
+        )
+        return bool(granted), float(wait)
+
+    def refund(self, key, amount, capacity):
+        self.command("EVAL", REFUND_SCRIPT, 1, self.prefix + key, repr(float(amount)), repr(float(capacity)))
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def create_backend(kind):
+    if kind == "memory":
+        return MemoryBackend()
+    if kind == "sqlite":
+        return SQLiteBackend(get_secret("BACKEND_PATH", os.path.join(".cache", "backend.sqlite3")))
+    if kind == "redis":
+        return RedisBackend(
+            get_secret("REDIS_URL", "redis://localhost:6379/0"),
+            prefix=get_secret("BACKEND_PREFIX", "bajki:"),
+            timeout=float(get_secret("REDIS_TIMEOUT", 5))
+        )
+    raise ValueError(f"Unknown BACKEND: {kind} (memory, sqlite or redis)")
+
+
+def get_backend():
+    """Process-wide backend (BACKEND = memory | sqlite | redis; BACKEND_PATH, REDIS_URL, BACKEND_PREFIX)."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = create_backend(str(get_secret("BACKEND", "memory")).lower())
+    return _backend
@@ -0,0 +1,152 @@
+"""Headless batch generator - stories (and narrations) from a JSONL/CSV manifest.
+
+Manifest rows: name, age, lesson, prompt (optional) and id (optional).
+
+    python batch_generate.py manifest.csv --out wyniki --concurrency 8
+
+Every finished row is appended to <out>/stories.jsonl (audio goes to
+<out>/audio/<id>.mp3 - or .opus/.aac with --audio-format - first), so an interrupted run can simply be started again:
+rows already in stories.jsonl are skipped.
+"""
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+from audio_cache import get_audio_cache
+from audio_pipeline import AUDIO_MIME_TYPES
+from clients import create_async_openai_client
+from prompts import AGE_OPTIONS, LESSON_OPTIONS
+from story_engine import TTS_FORMAT, StoryEngine
+
+
+def read_manifest(path):
+    """Read manifest rows from a .jsonl or .csv file."""
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    manifest = []
+    occurrences = Counter()
+    for number, row in enumerate(rows, 1):
+        row = normalize_row(row, number)
+        if not row["id"]:
+            content = (row["name"], row["age"], row["lesson"], row["prompt"])
+            # The second identical row asks for a second story, not the first one again
+            occurrences[content] += 1
+            row["id"] = row_key(*content, occurrences[content])
+        manifest.append(row)
+    return manifest
+
+
+def normalize_row(row, number):
+    name = str(row.get("name") or "").strip()
+    age = str(row.get("age") or "").strip()
+    lesson = str(row.get("lesson") or "").strip()
+    prompt = str(row.get("prompt") or "").strip()
+    if age and not age.endswith("lat"):
+        age = f"{age} lat"
+    if not name:
+        raise ValueError(f"Wiersz {number}: brak imienia (name)")
+    if age not in AGE_OPTIONS:
+        raise ValueError(f"Wiersz {number}: nieznany wiek '{age}' (dozwolone: {', '.join(AGE_OPTIONS)})")
+    if lesson not in LESSON_OPTIONS:
+        raise ValueError(f"Wiersz {number}: nieznana wartość '{lesson}'")
+    return {"id": str(row.get("id") or "").strip(), "name": name, "age": age, "lesson": lesson, "prompt": prompt}
+
+
+def row_key(name, age, lesson, prompt, occurrence=1):
+    # Depends only on the row's content (and which repeat of it this is), so rows
+    # added or removed elsewhere in the manifest don't change it
+    digest = hashlib.sha1(f"{name}\0{age}\0{lesson}\0{prompt}\0{occurrence}".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def finished_ids(results_path):
+    done = set()
+    if os.path.exists(results_path):
+        with open(results_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["id"])
+                except (ValueError, KeyError):
+                    # Half-written last line of an interrupted run
+                    continue
+    return done
+
+
+async def run_batch(rows, out_dir, concurrency, with_audio, tts_concurrency, audio_format=TTS_FORMAT):
+    client = create_async_openai_client()
+    if client is None:
+        raise SystemExit("Brak klucza OPENAI_API_KEY w zmiennych środowiskowych.")
+    engine = StoryEngine(client, tts_concurrency=tts_concurrency, audio_cache=get_audio_cache())
+
+    results_path = os.path.join(out_dir, "stories.jsonl")
+    audio_dir = os.path.join(out_dir, "audio")
+    os.makedirs(audio_dir, exist_ok=True)
+
+    done = finished_ids(results_path)
+    todo = [row for row in rows if row["id"] not in done]
+    print(f"Do zrobienia: {len(todo)} (pominięto gotowe: {len(rows) - len(todo)})", file=sys.stderr)
+
+    slots = asyncio.Semaphore(concurrency)
+    write_lock = asyncio.Lock()
+    failed = 0
+
+    async def process(row):
+        nonlocal failed
+        async with slots:
+            started_at = time.perf_counter()
+            try:
+                story = await engine.create_story(row["prompt"], row["name"], row["age"], row["lesson"])
+                story["id"] = row["id"]
+                if with_audio:
+                    audio_bytes = await engine.generate_audio_narration(story["content"], audio_format)
+                    audio_path = os.path.join(audio_dir, f"{row['id']}.{audio_format}")
+                    with open(audio_path, "wb") as f:
+                        f.write(audio_bytes)
+                    story["audio_file"] = os.path.relpath(audio_path, out_dir)
+            except Exception as e:
+                failed += 1
+                print(f"[{row['id']}] błąd: {e}", file=sys.stderr)
+                return
+            async with write_lock:
+                with open(results_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(story, ensure_ascii=False) + "\n")
+            print(f"[{row['id']}] gotowe w {time.perf_counter() - started_at:.1f}s", file=sys.stderr)
+
+    try:
+        await asyncio.gather(*(process(row) for row in todo))
+    finally:
+        await client.close()
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Wsadowe generowanie bajek (bez Streamlit).")
+    parser.add_argument("manifest", help="Plik .jsonl lub .csv z kolumnami name, age, lesson, prompt")
+    parser.add_argument("--out", default="batch_output", help="Katalog wynikowy (domyślnie: batch_output)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Ile bajek generować równolegle")
+    parser.add_argument("--tts-concurrency", type=int, default=8, help="Ile równoległych zapytań TTS")
+    parser.add_argument("--no-audio", action="store_true", help="Tylko tekst, bez narracji")
+    parser.add_argument(
+        "--audio-format", choices=sorted(AUDIO_MIME_TYPES), default=TTS_FORMAT,
+        help=f"Format narracji (domyślnie: {TTS_FORMAT}; opus i aac są mniejsze)"
+    )
+    args = parser.parse_args(argv)
+
+    rows = read_manifest(args.manifest)
+    failed = asyncio.run(run_batch(
+        rows, args.out, args.concurrency, not args.no_audio, args.tts_concurrency, args.audio_format
+    ))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import atexit
+import os
+import sys
+import threading
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+# Streamlit re-executes app_demo_voice.py on every interaction, but imported
+# modules stay loaded - so everything below lives once per process and is
+# shared by all sessions.
+
+_lock = threading.Lock()
+_secrets = {}
+_openai_client = None
+_langfuse = None
+
+
+def get_secret(name, default=None):
+    """Pobiera sekrety najpierw ze st.secrets, a jak ich nie ma – z ENV (np. na DO). Wynik jest cache'owany."""
+    if name in _secrets:
+        return _secrets[name]
+    value = None
+    # Only look at st.secrets when running under Streamlit (CLI/engine don't import it)
+    if "streamlit" in sys.modules:
+        try:
+            st = sys.modules["streamlit"]
+            if name in st.secrets:
+                value = st.secrets[name]
+        except Exception:
+            pass
+    if value is None:
+        value = os.getenv(name)
+    if value is not None:
+        _secrets[name] = value
+        return value
+    return default
+
+
+def _http_limits():
+    return httpx.Limits(
+        max_connections=int(get_secret("OPENAI_MAX_CONNECTIONS", 100)),
+        max_keepalive_connections=int(get_secret("OPENAI_MAX_KEEPALIVE", 20)),
+        keepalive_expiry=float(get_secret("OPENAI_KEEPALIVE_EXPIRY", 120))
+    )
+
+
+def _prewarm(http_client, url, connections):
+    """Open pooled connections (DNS + TLS handshake) before the first real request."""
+    def touch():
+        try:
+            # Any response keeps the connection in the keep-alive pool
+            http_client.head(url, timeout=5)
+        except Exception:
+            pass
+
+    threads = [threading.Thread(target=touch, daemon=True) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+
+
+def get_openai_client():
+    """Process-wide OpenAI client with a shared keep-alive connection pool."""
+    global _openai_client
+    if _openai_client is not None:
+        return _openai_client
+    with _lock:
+        if _openai_client is None:
+            api_key = get_secret("OPENAI_API_KEY")
+            if not api_key:
+                return None
+            http_client = httpx.Client(
+                limits=_http_limits(),
+                timeout=httpx.Timeout(60.0, connect=5.0)
+            )
+            # Retries are done by ratelimit.call_with_retry within the shared budget
+            _openai_client = OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+            _prewarm(http_client, str(_openai_client.base_url), int(get_secret("OPENAI_PREWARM_CONNECTIONS", 2)))
+            atexit.register(http_client.close)
+    return _openai_client
+
+
+def create_async_openai_client():
+    """New AsyncOpenAI client (bound to the running event loop - one per batch run)."""
+    api_key = get_secret("OPENAI_API_KEY")
+    if not api_key:
+        return None
+    return AsyncOpenAI(
+        api_key=api_key,
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            limits=_http_limits(),
+            timeout=httpx.Timeout(60.0, connect=5.0)
+        )
+    )
+
+
+def get_langfuse():
+    """Process-wide Langfuse client (one background flusher), or None if not configured."""
+    global _langfuse
+    if _langfuse is not None:
+        return _langfuse
+    with _lock:
+        if _langfuse is None:
+            secret_key = get_secret("LANGFUSE_SECRET_KEY")
+            public_key = get_secret("LANGFUSE_PUBLIC_KEY")
+            if not (secret_key and public_key):
+                return None
+            from langfuse import Langfuse
+            _langfuse = Langfuse(
+                secret_key=secret_key,
+                public_key=public_key,
+                host=get_secret("LANGFUSE_HOST", "https://cloud.langfuse.com"),
+            )
+            atexit.register(_langfuse.flush)
+    return _langfuse
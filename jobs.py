@@ -0,0 +1,225 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from backends import get_backend
+from clients import get_secret
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+# Progress is published to a shared backend at most this often
+PUBLISH_INTERVAL = 0.25
+# An unfinished job whose replica stopped publishing it disappears after this long
+HEARTBEAT_SECONDS = 30
+STALE_SECONDS = 3 * HEARTBEAT_SECONDS
+
+
+class JobCancelled(Exception):
+    """Raised from a cancelled job's progress callback to stop its work."""
+
+
+class RemoteJobError(Exception):
+    """A job's error as reported by another replica - only its message and type name survive."""
+
+    def __init__(self, message, type_name):
+        super().__init__(message)
+        self.type_name = type_name
+
+
+class Job:
+    """One background generation; progress holds the latest partial result."""
+
+    def __init__(self, kind, params, ttl=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.ttl = ttl
+        self.cancel_requested = False
+        self.status = QUEUED
+        self.progress = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.published_at = 0
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    def snapshot(self):
+        """JSON-friendly state for other replicas (the result must be JSON-serializable)."""
+        return {
+            "id": self.id, "kind": self.kind, "params": self.params, "ttl": self.ttl,
+            "status": self.status, "progress": self.progress, "result": self.result,
+            "error": str(self.error) if self.error is not None else None,
+            "error_type": type(self.error).__name__ if self.error is not None else None,
+            "created_at": self.created_at, "finished_at": self.finished_at,
+        }
+
+    @classmethod
+    def from_snapshot(cls, data):
+        """Read-only copy of a job running on another replica."""
+        job = cls(data["kind"], data["params"], data["ttl"])
+        job.id = data["id"]
+        job.status = data["status"]
+        job.progress = data["progress"]
+        job.result = data["result"]
+        if data["error"] is not None:
+            job.error = RemoteJobError(data["error"], data["error_type"])
+        job.created_at = data["created_at"]
+        job.finished_at = data["finished_at"]
+        return job
+
+
+class JobRunner:
+    """Runs generations off the Streamlit script thread.
+
+    Jobs live in process memory by id, so a page that carries the id (e.g. in
+    the query string) can pick up the result after a refresh or reconnect.
+    Finished jobs are forgotten after ttl seconds. With a shared backend the
+    job's status is published there as well, so the page can be picked up
+    by another replica too; the work itself stays where it was started.
+    """
+
+    def __init__(self, workers=8, ttl=3600, backend=None):
+        self.ttl = ttl
+        self.backend = backend if backend is not None and backend.shared else None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._jobs = {}
+        if self.backend:
+            threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True).start()
+
+    def submit(self, kind, fn, params=None, ttl=None):
+        """Start fn(progress) in the background and return its job id.
+
+        ttl overrides how long this job's result is kept once it is finished.
+        """
+        job = Job(kind, params or {}, ttl)
+        with self._lock:
+            self._expire()
+            self._jobs[job.id] = job
+        self._publish(job, force=True)
+        self._executor.submit(self._run, job, fn)
+        return job.id
+
+    def _run(self, job, fn):
+        if job.cancel_requested:
+            job.status = CANCELLED
+            job.finished_at = time.time()
+            self._publish(job, force=True)
+            return
+        job.status = RUNNING
+        self._publish(job, force=True)
+
+        def progress(partial):
+            # Cancellation takes effect at the next progress report
+            if job.cancel_requested:
+                raise JobCancelled(job.id)
+            job.progress = partial
+            self._publish(job)
+
+        try:
+            job.result = fn(progress)
+            job.status = DONE
+        except JobCancelled:
+            job.status = CANCELLED
+        except Exception as e:
+            job.error = e
+            job.status = FAILED
+        finally:
+            job.finished_at = time.time()
+            self._publish(job, force=True)
+
+    def _publish(self, job, force=False):
+        """Mirror the job into the shared backend (throttled unless forced); picks up remote cancels."""
+        if not self.backend:
+            return
+        now = time.time()
+        if not force and now - job.published_at < PUBLISH_INTERVAL:
+            return
+        job.published_at = now
+        try:
+            if not job.finished and self.backend.get(f"job-cancel:{job.id}"):
+                job.cancel_requested = True
+            ttl = (self.ttl if job.ttl is None else job.ttl) if job.finished else STALE_SECONDS
+            self.backend.set_json(f"job:{job.id}", job.snapshot(), ttl)
+        except Exception as e:
+            # The job itself goes on - only other replicas lose sight of it
+            logger.warning("Job %s not published: %s", job.id, e)
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(HEARTBEAT_SECONDS)
+            with self._lock:
+                running = [job for job in self._jobs.values() if not job.finished]
+            for job in running:
+                self._publish(job, force=True)
+
+    def get(self, job_id):
+        """The job by id - from this process, or a read-only copy of another replica's job, or None."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.backend and job_id:
+            data = self.backend.get_json(f"job:{job_id}")
+            job = Job.from_snapshot(data) if data else None
+        return job
+
+    def cancel(self, job_id):
+        """Ask a job to stop; a queued job never starts, a running one stops at its next progress()."""
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return
+        with self._lock:
+            local = job_id in self._jobs
+        if local:
+            job.cancel_requested = True
+        else:
+            # Seen by the job's own replica at its next publish
+            self.backend.set(f"job-cancel:{job_id}", b"1", STALE_SECONDS)
+
+    def active(self, kind):
+        """Number of unfinished jobs of a kind in this process."""
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.kind == kind and not job.finished)
+
+    def _expire(self):
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished and now - job.finished_at > (self.ttl if job.ttl is None else job.ttl)
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {status: statuses.count(status) for status in (QUEUED, RUNNING, DONE, FAILED, CANCELLED)}
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_job_runner():
+    """Process-wide job runner (JOB_WORKERS, JOB_TTL_MINUTES)."""
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = JobRunner(
+                workers=int(get_secret("JOB_WORKERS", 8)),
+                ttl=float(get_secret("JOB_TTL_MINUTES", 60)) * 60,
+                backend=get_backend()
+            )
+    return _runner
@@ -0,0 +1,231 @@
+"""Local stand-in for the OpenAI API used by the load test - no real calls, no cost.
+
+Implements POST /v1/chat/completions (streaming and non-streaming) and
+POST /v1/audio/speech with configurable latency and generation speed.
+
+    python loadtest/mock_openai.py --port 8765 --ttft 0.4 --tokens-per-second 80
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=mock streamlit run app_demo_voice.py
+"""
+import argparse
+import itertools
+import json
+import struct
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SENTENCES = [
+    "{name} obudził się w słonecznym, kolorowym lesie.",
+    "Wokół śpiewały wesołe ptaki, a motyle tańczyły nad kwiatami.",
+    "Przyjazny lisek zaprosił go na wspaniałą wyprawę.",
+    "Razem znaleźli zagubiony klucz do magicznej skrzyni.",
+    "W środku czekały błyszczące gwiazdki i ciepłe uśmiechy.",
+    "{name} podzielił się skarbem ze wszystkimi przyjaciółmi.",
+    "Wszyscy śmiali się radośnie do samego wieczora.\n\n",
+]
+
+# One silent MPEG-2 Layer III frame (24 kHz, 48 kbps, mono) - 144 bytes, 24 ms
+MP3_FRAME = bytes([0xFF, 0xF3, 0x64, 0xC4]) + bytes(140)
+# One ADTS AAC-LC frame header (24 kHz, mono) with an empty payload - 16 bytes, 1024 samples
+ADTS_FRAME = bytes([0xFF, 0xF1, 0x58, 0x40, 0x02, 0x1F, 0xFC]) + bytes(9)
+# Opus silence packet: 20 ms CELT frame
+OPUS_SILENCE = b"\xf8\xff\xfe"
+
+
+def _ogg_crc(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7 if crc & 0x80000000 else crc << 1) & 0xFFFFFFFF
+    return crc
+
+
+def _ogg_page(flags, granule, sequence, packets):
+    table = b"".join(bytes([255] * (len(packet) // 255) + [len(packet) % 255]) for packet in packets)
+    page = bytearray(b"OggS" + struct.pack("<BBqIIIB", 0, flags, granule, 1, sequence, 0, len(table)))
+    page += table + b"".join(packets)
+    struct.pack_into("<I", page, 22, _ogg_crc(page))
+    return bytes(page)
+
+
+def silent_speech(seconds, fmt):
+    """Silent audio of about this length in an OpenAI TTS response_format (mp3, aac, opus)."""
+    if fmt == "aac":
+        return ADTS_FRAME * max(1, int(seconds * 24000 / 1024))
+    if fmt == "opus":
+        packets = max(1, int(seconds / 0.02))
+        pages = [
+            _ogg_page(0x02, 0, 0, [b"OpusHead" + struct.pack("<BBHIhB", 1, 1, 312, 24000, 0, 0)]),
+            _ogg_page(0, 0, 1, [b"OpusTags" + struct.pack("<I", 4) + b"mock" + struct.pack("<I", 0)]),
+        ]
+        for start in range(0, packets, 50):
+            count = min(50, packets - start)
+            last = start + count == packets
+            pages.append(_ogg_page(0x04 if last else 0, (start + count) * 960, len(pages), [OPUS_SILENCE] * count))
+        return b"".join(pages)
+    return MP3_FRAME * max(1, int(seconds / 0.024))
+
+
+class MockSettings:
+    def __init__(self, ttft=0.4, tokens_per_second=80.0, completion_tokens=600,
+                 tts_latency=0.8, tts_chars_per_second=400.0, error_rate=0.0):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.tts_latency = tts_latency
+        self.tts_chars_per_second = tts_chars_per_second
+        self.error_rate = error_rate
+        self.requests = itertools.count()
+
+
+def story_tokens(count, name):
+    words = itertools.cycle(" ".join(SENTENCES).replace("{name}", name).split(" "))
+    return [word + " " for word in itertools.islice(words, count)]
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping pooled keep-alive connections is normal here
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+def make_handler(settings):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_HEAD(self):
+            # Connection pre-warming
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def _send_json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _maybe_fail(self):
+            number = next(settings.requests)
+            if settings.error_rate and number % round(1 / settings.error_rate) == 0:
+                self._send_json(429, {"error": {"message": "mock rate limit", "type": "requests"}},
+                                {"Retry-After": "1"})
+                return True
+            return False
+
+        def do_POST(self):
+            request = self._read_json()
+            if self._maybe_fail():
+                return
+            if self.path.endswith("/chat/completions"):
+                self._chat(request)
+            elif self.path.endswith("/audio/speech"):
+                self._speech(request)
+            else:
+                self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+
+        def _chat(self, request):
+            prompt_text = json.dumps(request.get("messages", []), ensure_ascii=False)
+            name = "{{IMIE}}" if "{{IMIE}}" in prompt_text else "Bohater"
+            count = min(settings.completion_tokens, request.get("max_tokens") or settings.completion_tokens)
+            finish_reason = "length" if count < settings.completion_tokens else "stop"
+            tokens = story_tokens(count, name)
+            usage = {
+                "prompt_tokens": len(prompt_text) // 3,
+                "completion_tokens": len(tokens),
+                "total_tokens": len(prompt_text) // 3 + len(tokens),
+                "prompt_tokens_details": {"cached_tokens": 1024}
+            }
+            base = {"id": "chatcmpl-mock", "created": int(time.time()), "model": request.get("model")}
+            time.sleep(settings.ttft)
+
+            if not request.get("stream"):
+                time.sleep(len(tokens) / settings.tokens_per_second)
+                self._send_json(200, dict(base, object="chat.completion", usage=usage, choices=[{
+                    "index": 0, "finish_reason": finish_reason,
+                    "message": {"role": "assistant", "content": "".join(tokens)}
+                }]))
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def send_event(payload):
+                data = f"data: {payload}\n\n".encode("utf-8")
+                self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            for token in tokens:
+                send_event(json.dumps(dict(base, object="chat.completion.chunk", choices=[{
+                    "index": 0, "finish_reason": None, "delta": {"content": token}
+                }])))
+                time.sleep(1 / settings.tokens_per_second)
+            send_event(json.dumps(dict(base, object="chat.completion.chunk", choices=[{
+                "index": 0, "finish_reason": finish_reason, "delta": {}
+            }])))
+            if (request.get("stream_options") or {}).get("include_usage"):
+                send_event(json.dumps(dict(base, object="chat.completion.chunk", choices=[], usage=usage)))
+            send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _speech(self, request):
+            text = request.get("input", "")
+            time.sleep(settings.tts_latency + len(text) / settings.tts_chars_per_second)
+            # Roughly 15 characters of speech per second
+            fmt = request.get("response_format", "mp3")
+            body = silent_speech(len(text) / 15, fmt)
+            self.send_response(200)
+            self.send_header("Content-Type", {"aac": "audio/aac", "opus": "audio/ogg"}.get(fmt, "audio/mpeg"))
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+def start_mock_server(settings=None, host="127.0.0.1", port=0):
+    """Start the mock in a daemon thread; returns (server, base_url)."""
+    server = MockServer((host, port), make_handler(settings or MockSettings()))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Lokalny zamiennik OpenAI API do testów obciążeniowych.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ttft", type=float, default=0.4, help="Czas do pierwszego tokenu [s]")
+    parser.add_argument("--tokens-per-second", type=float, default=80.0)
+    parser.add_argument("--completion-tokens", type=int, default=600)
+    parser.add_argument("--tts-latency", type=float, default=0.8, help="Stały narzut TTS [s]")
+    parser.add_argument("--tts-chars-per-second", type=float, default=400.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Ułamek odpowiedzi 429")
+    args = parser.parse_args(argv)
+
+    settings = MockSettings(args.ttft, args.tokens_per_second, args.completion_tokens,
+                            args.tts_latency, args.tts_chars_per_second, args.error_rate)
+    server = MockServer((args.host, args.port), make_handler(settings))
+    print(f"Mock OpenAI: http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
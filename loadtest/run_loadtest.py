@@ -0,0 +1,249 @@
+"""Offline load test: N simulated sessions through landing -> generator -> story -> audio.
+
+Sessions are driven with Streamlit's AppTest in this process, against the local
+OpenAI stand-in (mock_openai.py), so nothing is paid for. Reports p50/p95/p99
+latency per stage, script runs per generation and RSS per session.
+
+    python loadtest/run_loadtest.py --sessions 50 --concurrency 10
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(os.path.dirname(HERE), "app_demo_voice.py")
+sys.path.insert(0, HERE)
+
+from mock_openai import MockSettings, start_mock_server  # noqa: E402
+
+STAGES = ["landing", "generator", "story", "audio", "rerun_display"]
+
+
+def rss_bytes():
+    """Current resident set size of this process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        # Peak, not current - the best we get outside Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def count_script_runs():
+    """Count script executions per session (every run calls st.set_page_config once)."""
+    import streamlit as st
+
+    set_page_config = st.set_page_config
+
+    def counting_set_page_config(*args, **kwargs):
+        st.session_state["_loadtest_script_runs"] = st.session_state.get("_loadtest_script_runs", 0) + 1
+        return set_page_config(*args, **kwargs)
+
+    st.set_page_config = counting_set_page_config
+
+
+def allow_concurrent_apptests():
+    """AppTest installs a mock Runtime per run and resets it to None afterwards.
+
+    With several sessions running at once, one session's reset would pull the
+    runtime from under another - so keep serving the last mock runtime.
+    """
+    from streamlit.runtime import Runtime
+
+    last = [None]
+
+    def instance(cls):
+        if cls._instance is not None:
+            last[0] = cls._instance
+        if last[0] is None:
+            raise RuntimeError("Runtime hasn't been created!")
+        return last[0]
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: last[0] is not None or cls._instance is not None)
+
+    # Every AppTest compiles the script itself, and parallel ast.parse/compile
+    # calls trip "AST constructor recursion depth mismatch" on CPython 3.11
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+
+    compile_lock = threading.Lock()
+    get_bytecode = ScriptCache.get_bytecode
+
+    def locked_get_bytecode(self, script_path):
+        with compile_lock:
+            return get_bytecode(self, script_path)
+
+    ScriptCache.get_bytecode = locked_get_bytecode
+
+
+def script_runs(at):
+    return at.session_state["_loadtest_script_runs"] if "_loadtest_script_runs" in at.session_state else 0
+
+
+def state(at, key):
+    return at.session_state[key] if key in at.session_state else None
+
+
+class SessionResult:
+    def __init__(self, number):
+        self.number = number
+        self.stages = {}
+        self.runs_per_generation = None
+        self.error = None
+        self.app = None
+
+
+def run_session(number, prompt, timeout, poll_interval):
+    from streamlit.testing.v1 import AppTest
+
+    result = SessionResult(number)
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    result.app = at  # keep the session alive until RSS is measured
+    try:
+        started = time.perf_counter()
+        at.run()
+        result.stages["landing"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        at.button(key="enter_app").click().run()
+        result.stages["generator"] = time.perf_counter() - started
+
+        # Typing the name reruns the form, which enables the button
+        at.text_input(key="child_name_input").input(f"Dziecko{number}").run()
+        at.text_area(key="story_prompt_input").input(prompt)
+        runs_before = script_runs(at)
+        polls = 0
+        started = time.perf_counter()
+        at.button(key="generate_story").click().run()
+        deadline = started + timeout
+        while not state(at, "current_story") and time.perf_counter() < deadline:
+            # Stands in for the job panel's fragment timer, which AppTest doesn't run
+            time.sleep(poll_interval)
+            at.run()
+            polls += 1
+        if not state(at, "current_story"):
+            raise TimeoutError("story not ready")
+        result.stages["story"] = time.perf_counter() - started
+        # Runs the app itself caused - the polling runs above are the test's
+        result.runs_per_generation = script_runs(at) - runs_before - polls
+
+        while not state(at, "story_audio_path") and time.perf_counter() < deadline:
+            time.sleep(poll_interval)
+            at.run()
+        if not state(at, "story_audio_path"):
+            raise TimeoutError("audio not ready")
+        result.stages["audio"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        at.run()
+        result.stages["rerun_display"] = time.perf_counter() - started
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+def report(results, rss_before, rss_after, wall_time):
+    ok = [r for r in results if not r.error]
+    summary = {"sessions": len(results), "failed": len(results) - len(ok), "wall_seconds": round(wall_time, 2)}
+    for stage in STAGES:
+        values = [r.stages[stage] for r in ok if stage in r.stages]
+        summary[stage] = {f"p{p}": round(percentile(values, p), 3) if values else None for p in (50, 95, 99)}
+    runs = [r.runs_per_generation for r in ok if r.runs_per_generation is not None]
+    summary["script_runs_per_generation"] = {
+        "mean": round(sum(runs) / len(runs), 2) if runs else None,
+        "p95": percentile(runs, 95)
+    }
+    summary["rss_per_session_kb"] = round((rss_after - rss_before) / max(1, len(results)) / 1024, 1)
+    summary["errors"] = sorted({r.error for r in results if r.error})
+    return summary
+
+
+def print_report(summary):
+    print(f"\nSesje: {summary['sessions']} (błędy: {summary['failed']}), czas: {summary['wall_seconds']}s")
+    print(f"{'etap':<16}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for stage in STAGES:
+        row = summary[stage]
+        print(f"{stage:<16}" + "".join(
+            f"{row[p]:>10.3f}" if row[p] is not None else f"{'-':>10}" for p in ("p50", "p95", "p99")
+        ))
+    runs = summary["script_runs_per_generation"]
+    print(f"\nUruchomienia skryptu na generację: średnio {runs['mean']}, p95 {runs['p95']}")
+    print(f"RSS na sesję: {summary['rss_per_session_kb']} KB")
+    for error in summary["errors"]:
+        print(f"Błąd: {error}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Test obciążeniowy aplikacji na lokalnym zamienniku OpenAI.")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--prompt", default="Przygoda w magicznym lesie")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Limit na jedną sesję [s]")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="Jak często strona odpytuje zadanie [s]")
+    parser.add_argument("--ttft", type=float, default=0.4)
+    parser.add_argument("--tokens-per-second", type=float, default=80.0)
+    parser.add_argument("--completion-tokens", type=int, default=600)
+    parser.add_argument("--tts-latency", type=float, default=0.8)
+    parser.add_argument("--tts-chars-per-second", type=float, default=400.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--pool", action="store_true", help="Włącz pulę gotowych bajek")
+    parser.add_argument("--json", help="Zapisz wyniki do pliku JSON")
+    args = parser.parse_args(argv)
+
+    settings = MockSettings(args.ttft, args.tokens_per_second, args.completion_tokens,
+                            args.tts_latency, args.tts_chars_per_second, args.error_rate)
+    server, base_url = start_mock_server(settings)
+    # Everything the app writes to disk goes to a fresh directory, not the repo's .cache
+    data_dir = tempfile.mkdtemp(prefix="bajki-loadtest-")
+    os.environ.update({
+        "OPENAI_BASE_URL": base_url,
+        "OPENAI_API_KEY": "mock",
+        "AUDIO_CACHE_DIR": os.path.join(data_dir, "audio"),
+        "LIBRARY_PATH": os.path.join(data_dir, "library.sqlite3"),
+        "BACKEND_PATH": os.path.join(data_dir, "backend.sqlite3"),
+        "POOL_ENABLED": "1" if args.pool else "0",
+    })
+    count_script_runs()
+    allow_concurrent_apptests()
+
+    # One session first, so imports and process-wide singletons don't count as per-session memory
+    run_session(0, args.prompt, args.timeout, args.poll_interval)
+    rss_before = rss_bytes()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        # Different prompts per session, otherwise identical requests would be coalesced
+        results = list(executor.map(
+            lambda number: run_session(number, f"{args.prompt} #{number}", args.timeout, args.poll_interval),
+            range(1, args.sessions + 1)
+        ))
+    wall_time = time.perf_counter() - started
+    rss_after = rss_bytes()
+    server.shutdown()
+
+    summary = report(results, rss_before, rss_after, wall_time)
+    print_report(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,317 @@
+import bisect
+import importlib
+import logging
+import threading
+import time
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from admission import get_admission_controller
+from clients import get_secret
+from jobs import get_job_runner
+
+logger = logging.getLogger(__name__)
+
+
+def _labels_text(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self):
+        for key, value in sorted(self.values().items()):
+            yield self.name + "_total" + _labels_text(self.labelnames, key), value
+
+
+class Gauge:
+    """Value read when the metrics are rendered: fn() returns a number or {label value: number}."""
+
+    type = "gauge"
+
+    def __init__(self, name, help, fn, labelname=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelname = labelname
+
+    def values(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return {}
+        return value if isinstance(value, dict) else {(): value}
+
+    def samples(self):
+        for key, value in sorted(self.values().items(), key=lambda item: str(item[0])):
+            labels = _labels_text((self.labelname,), (key,)) if self.labelname else ""
+            yield self.name + labels, value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, buckets, labelnames=()):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        # label values -> [bucket counts..., +Inf count], sum
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._series.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self._series[key] = (counts, total + value)
+
+    def snapshot(self):
+        with self._lock:
+            return {key: (list(counts), total) for key, (counts, total) in self._series.items()}
+
+    def quantile(self, q, **labels):
+        """Upper bucket bound below which a q share of observations fall (None if empty)."""
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        counts, _ = self.snapshot().get(key, (None, 0))
+        if not counts or not sum(counts):
+            return None
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + [float("inf")], counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float("inf")], counts):
+                cumulative += count
+                yield self.name + "_bucket" + _labels_text(self.labelnames, key, [("le", _number(bound))]), cumulative
+            yield self.name + "_sum" + _labels_text(self.labelnames, key), total
+            yield self.name + "_count" + _labels_text(self.labelnames, key), cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name} {_number(value)}" for name, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+SECONDS_BUCKETS = [0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60, 120]
+TTFT_BUCKETS = [0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10]
+SCRIPT_RUN_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5]
+AUDIO_BYTES_BUCKETS = [50_000, 100_000, 250_000, 500_000, 1_000_000, 2_000_000, 5_000_000, 10_000_000]
+RUNS_BUCKETS = [1, 2, 3, 4, 5, 6, 8, 10, 15, 20]
+RUN_BYTES_BUCKETS = [500, 1_000, 2_000, 5_000, 10_000, 20_000, 50_000, 100_000, 250_000, 1_000_000]
+
+
+class AppMetrics:
+    """The app's metrics; gauges read live state through the callables passed to add_gauge."""
+
+    def __init__(self, active_window=300):
+        self.registry = Registry()
+        self.active_window = active_window
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        add = self.registry.register
+        self.story_seconds = add(Histogram("story_generation_seconds", "Story generation time", SECONDS_BUCKETS))
+        self.ttft_seconds = add(Histogram("story_ttft_seconds", "Time to the first story token", TTFT_BUCKETS))
+        self.tts_seconds = add(Histogram("tts_seconds", "Narration synthesis time", SECONDS_BUCKETS, ("mode",)))
+        self.audio_bytes = add(Histogram("audio_bytes", "Size of synthesized narrations", AUDIO_BYTES_BUCKETS))
+        self.script_run_seconds = add(Histogram(
+            "script_run_seconds", "Duration of completed Streamlit script runs", SCRIPT_RUN_BUCKETS, ("page",)
+        ))
+        self.run_bytes = add(Histogram(
+            "websocket_bytes_per_run", "Bytes sent to the browser per script or fragment run", RUN_BYTES_BUCKETS, ("run",)
+        ))
+        self.runs_per_story = add(Histogram(
+            "script_runs_per_story", "Full script runs from a story request until the story is on screen", RUNS_BUCKETS
+        ))
+        self.script_runs = add(Counter("script_runs", "Streamlit script runs (reruns included)"))
+        self.fragment_runs = add(Counter(
+            "fragment_runs", "Fragment executions, as part of a full run or on their own", ("fragment",)
+        ))
+        self.websocket_bytes = add(Counter(
+            "websocket_bytes", "Bytes sent to browsers; cache_ref = element sent as a hash reference", ("kind",)
+        ))
+        self.tokens = add(Counter("openai_tokens", "OpenAI tokens by direction", ("model", "direction")))
+        self.tts_characters = add(Counter("tts_characters", "Characters sent to TTS", ("model",)))
+        self.cost_usd = add(Counter("openai_cost_usd", "Estimated OpenAI cost in USD", ("model",)))
+        self.errors = add(Counter("errors", "Errors by stage and exception type", ("stage", "type")))
+        self.cache = add(Counter("cache_requests", "Cache lookups by cache and result", ("cache", "result")))
+        self.admission = add(Counter(
+            "admission_decisions", "Generation requests by kind and admission decision", ("kind", "decision")
+        ))
+        self.queue_wait_seconds = add(Histogram(
+            "admission_wait_seconds", "Time waited in the admission queue before a slot", SECONDS_BUCKETS
+        ))
+        add(Gauge("active_sessions", f"Sessions with a script run in the last {active_window}s", self.active_sessions))
+
+    def add_gauge(self, name, help, fn, labelname=None):
+        return self.registry.register(Gauge(name, help, fn, labelname))
+
+    def touch_session(self, session_id):
+        now = time.time()
+        with self._sessions_lock:
+            self._sessions[session_id] = now
+            if len(self._sessions) > 1000:
+                self._forget_idle(now)
+
+    def _forget_idle(self, now):
+        for session_id, seen in list(self._sessions.items()):
+            if now - seen > self.active_window:
+                del self._sessions[session_id]
+
+    def active_sessions(self):
+        with self._sessions_lock:
+            self._forget_idle(time.time())
+            return len(self._sessions)
+
+    def cache_result(self, cache, hit):
+        self.cache.inc(cache=cache, result="hit" if hit else "miss")
+
+    def render(self):
+        return self.registry.render()
+
+
+# Streamlit's per-session websocket client: Starlette server, Tornado before it
+SESSION_CLIENTS = [
+    ("streamlit.web.server.starlette.starlette_websocket", "StarletteSessionClient"),
+    ("streamlit.web.server.browser_websocket_handler", "BrowserWebSocketHandler"),
+]
+
+
+def meter_websocket(metrics):
+    """Count the bytes Streamlit sends to each browser, per script run.
+
+    Wraps write_forward_msg of the session client classes; a run's total is
+    observed when its script_finished message goes out. Returns whether any
+    client class was found.
+    """
+    from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+    run_bytes = weakref.WeakKeyDictionary()
+    metered = False
+    for module_name, class_name in SESSION_CLIENTS:
+        try:
+            client_class = getattr(importlib.import_module(module_name), class_name)
+        except (ImportError, AttributeError):
+            continue
+        write = client_class.write_forward_msg
+        if getattr(write, "metered", False):
+            metered = True
+            continue
+
+        def write_forward_msg(self, msg, write=write):
+            size = msg.ByteSize()
+            kind = msg.WhichOneof("type")
+            metrics.websocket_bytes.inc(size, kind="cache_ref" if kind == "ref_hash" else "full")
+            total = run_bytes.get(self, 0) + size
+            if kind == "script_finished":
+                fragment = msg.script_finished == ForwardMsg.FINISHED_FRAGMENT_RUN_SUCCESSFULLY
+                metrics.run_bytes.observe(total, run="fragment" if fragment else "script")
+                total = 0
+            run_bytes[self] = total
+            return write(self, msg)
+
+        write_forward_msg.metered = True
+        client_class.write_forward_msg = write_forward_msg
+        metered = True
+    return metered
+
+
+def start_metrics_server(metrics, port, host="0.0.0.0"):
+    """Serve GET /metrics in Prometheus text format from a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """Process-wide metrics; also served on METRICS_PORT (/metrics) when it is set."""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = AppMetrics(active_window=float(get_secret("ACTIVE_SESSION_SECONDS", 300)))
+            _metrics.add_gauge("jobs", "Background jobs by status", lambda: get_job_runner().stats(), "status")
+            _metrics.add_gauge(
+                "admission", "Generations running and waiting in this process",
+                lambda: get_admission_controller().stats(), "state"
+            )
+            meter_websocket(_metrics)
+            port = get_secret("METRICS_PORT")
+            if port:
+                try:
+                    start_metrics_server(_metrics, int(port), get_secret("METRICS_HOST", "0.0.0.0"))
+                except OSError as e:
+                    # e.g. another worker process already serves this port
+                    logger.warning("Metrics server not started on port %s: %s", port, e)
+    return _metrics
@@ -0,0 +1,159 @@
+# Prompt building for story generation - kept free of Streamlit so it can be
+# used from background workers and the batch CLI as well as from the app.
+
+LESSON_OPTIONS = [
+    "Odwaga",
+    "Przyjaźń",
+    "Uczciwość",
+    "Dobroć",
+    "Wytrwałość",
+    "Dzielenie się",
+    "Szacunek",
+    "Cierpliwość",
+    "Kreatywność",
+    "Pomoc innym"
+]
+
+AGE_OPTIONS = ["3-5 lat", "6-8 lat", "9-12 lat"]
+
+def get_safety_rules():
+    """Return enhanced safety rules for children's fairy tales"""
+    return """
+=== ABSOLUTNE ZAKAZY (ZERO TOLERANCJI) ===
+NIGDY nie pisz o:
+- Śmierci, umieraniu, zabijaniu (nawet złych postaci)
+- Przemocy fizycznej (bicie, kopanie, krzywdzenie)
+- Przemocy psychicznej (zastraszanie, upokarzanie, wykluczanie)
+- Tematach seksualnych lub romantycznych (całowanie, "miłość" między postaciami)
+- Alkoholu, papierosach, narkotykach, lekach
+- Strasznych potworach, duchach, zombie, czarownicach
+- Krwi, ranach, urazach, bólu
+- Wulgaryzmach, brzydkich słowach, przekleństwach
+- Smutnych, traumatycznych scenach
+- Krzywdzie zwierząt
+- Opuszczeniu, samotności dziecka, zgubieniu się
+- Kłótniach rodziców lub dorosłych
+- Chorobach, szpitalach, lekarzach, dentystach
+- Ciemności, nocy jako czegoś strasznego
+- Kłamstwach jako głównym motywie
+
+=== BEZPIECZNE KONFLIKTY (jeśli potrzebne) ===
+Jeśli historia wymaga drobnego konfliktu, użyj TYLKO:
+- Zagubienie przedmiotu → szybkie odnalezienie z pomocą przyjaciół
+- Drobna pomyłka → łatwa do naprawienia, wszyscy się śmieją
+- Niezrozumienie między przyjaciółmi → wyjaśnione przez rozmowę
+- Łagodna przeszkoda → przekraczalna razem, bez stresu
+- Drobne niepowodzenie → prowadzące do nauki i sukcesu
+
+=== OBOWIĄZKOWE ELEMENTY ===
+KAŻDA bajka MUSI zawierać:
+- Wyłącznie pozytywne emocje (radość, ciekawość, ekscytacja, duma)
+- Przyjazne, pomocne postacie (wszyscy są mili)
+- Bezpieczne, kolorowe, przyjazne środowisko
+- Szczęśliwe zakończenie (ZAWSZE - bez wyjątków)
+- Język pełen ciepła, zachęty i pozytywnego wzmocnienia
+- Poczucie bezpieczeństwa przez całą narrację
+- Zero dramatyzmu, napięcia lub niepokoju
+- Zero negatywnych konsekwencji dla bohaterów
+- Współpraca zamiast konkurencji
+- Sukces i radość dla wszystkich postaci
+
+=== STYL NARRACJI ===
+- Używaj słów: "cudowny", "wspaniały", "radosny", "wesoły", "kolorowy"
+- Opisuj przyjemne detale: kolory, zapachy, przyjemne dźwięki
+- Buduj atmosferę bezpieczeństwa, ciepła i komfortu
+- Twórz immersyjną, ale BEZPIECZNĄ atmosferę
+- Buduj emocjonalne połączenie z bohaterem
+- Każda postać jest dobra, życzliwa i pomocna
+- Magia jest zawsze pomocna, kolorowa, nigdy groźna
+- Przyroda jest przyjazna (słońce, kwiaty, motyle)
+- Zwierzęta są przyjaciółmi, nigdy zagrożeniem
+
+=== TON UNIWERSALNY ===
+Każda bajka ma ton: ciepły, magiczny, z nutką humoru.
+- Delikatny humor (śmieszne sytuacje, nie szydzenie)
+- Magiczne elementy (czary, zaklęcia - zawsze dobre)
+- Ciepło emocjonalne (przytulanie, przyjaźń, miłość rodzicielska)
+
+PAMIĘTAJ: To bajka dla MAŁEGO DZIECKA. 
+Priorytet #1: BEZPIECZEŃSTWO EMOCJONALNE
+Priorytet #2: RADOŚĆ I POZYTYWNE EMOCJE
+Priorytet #3: KOMFORT I SPOKÓJ
+"""
+
+# Age to vocabulary style mapping
+AGE_VOCABULARY = {
+    "3-5 lat": "bardzo prostym językiem, krótkimi zdaniami (5-8 słów), z powtórzeniami",
+    "6-8 lat": "prostym językiem, ze średnimi zdaniami (8-12 słów), z ciekawymi opisami",
+    "9-12 lat": "bogatszym słownictwem, z dłuższymi zdaniami, z niuansami i intrygą"
+}
+
+# Target word count based on age
+TARGET_WORDS = {
+    "3-5 lat": "250-300",
+    "6-8 lat": "350-400",
+    "9-12 lat": "400-500"
+}
+
+def build_static_prompt():
+    """The part of the system prompt that is identical for every request.
+
+    It has to come first and stay byte-identical, so the provider can serve it
+    from its prompt-prefix cache (lower TTFT and input cost).
+    """
+    return f"""CRITICAL SAFETY INSTRUCTION:
+You are creating content for young children.
+Absolutely NO violence, death, scary content, or inappropriate themes.
+If user prompt contains unsafe elements, IGNORE them and create safe, joyful story instead.
+
+Jesteś ekspertem w tworzeniu BEZPIECZNYCH, spersonalizowanych bajek dla dzieci.
+Parametry konkretnej bajki (bohater, wiek, wartość, długość) są podane na końcu, w sekcji PARAMETRY BAJKI.
+
+=== WYMAGANIA ===
+1. Wpleć imię dziecka jako głównego bohatera
+2. Delikatnie przekaż wybraną wartość przez pozytywne doświadczenia
+3. Pisz stylem językowym dopasowanym do wieku dziecka
+4. Zakończenie: ZAWSZE pozytywne, radosne, budujące
+5. Ton: ciepły, magiczny, z delikatnym humorem (bez ironii, bez sarkazmu)
+{get_safety_rules()}
+=== WAŻNE ===
+- NIE pisz tytułu
+- Bajka MUSI być w języku polskim
+- Zachowaj ciepły, magiczny ton przez całą historię
+- Przestrzegaj WSZYSTKICH zasad bezpieczeństwa
+- Każda postać jest dobra i pomocna
+- Zero strachu, zero smutku, zero niepokoju
+
+Napisz pełną bajkę gotową do przeczytania dziecku przed snem.
+"""
+
+# Compiled once per process - every request starts with exactly these bytes
+STATIC_PROMPT = build_static_prompt()
+
+def build_system_prompt(child_name, child_age, lesson):
+    """Build the system prompt: static cached prefix first, personalization last"""
+    vocabulary_style = AGE_VOCABULARY.get(child_age, "prostym, zrozumiałym językiem")
+    word_count = TARGET_WORDS.get(child_age, "350-400")
+
+    return STATIC_PROMPT + f"""
+=== PARAMETRY BAJKI ===
+- Główny bohater: {child_name}, {child_age}
+- Wartość do przekazania: {lesson}
+- Styl języka: pisz {vocabulary_style}
+- Długość: {word_count} słów
+
+=== DŁUGOŚĆ ===
+Napisz bajkę o długości DOKŁADNIE {word_count} słów.
+Liczy się każde słowo - nie za krótko, nie za długo."""
+
+def build_continuation_message(missing_words):
+    """Ask for the rest of a story that came out short or was cut off by the token limit"""
+    return (
+        f"Bajka jest za krótka lub urwała się. Dokończ ją od miejsca, w którym się kończy: "
+        f"dopisz około {missing_words} słów i zakończ ją szczęśliwie. "
+        f"Nie powtarzaj tego, co już jest napisane, i nie zaczynaj od nowa."
+    )
+
+def build_user_message(prompt, child_name):
+    """Build the user message - the story idea or a generic magical adventure"""
+    return f"Stwórz bajkę na podstawie: {prompt}" if prompt.strip() else f"Stwórz magiczną bajkę o przygodach {child_name}"
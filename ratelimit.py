@@ -0,0 +1,178 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import openai
+
+from backends import MemoryBackend, get_backend
+from clients import get_secret
+
+# HTTP statuses worth another attempt
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class RateLimitTimeout(Exception):
+    """Waiting for a free slot in the rate budget would take too long."""
+
+    def __init__(self, wait):
+        super().__init__(f"rate limit queue wait {wait:.1f}s exceeds the limit")
+        self.wait = wait
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at per_minute/60 per second.
+
+    reserve() takes tokens right away (the balance may go negative) and returns
+    how long the caller has to wait - callers are served in arrival order.
+    The balance is kept in backend under key, so with a shared backend one
+    bucket serves every replica.
+    """
+
+    def __init__(self, per_minute, burst=None, backend=None, key="bucket"):
+        self.rate = per_minute / 60.0
+        self.capacity = burst or per_minute
+        self.backend = backend or MemoryBackend()
+        self.key = key
+
+    def reserve(self, amount, max_wait=None):
+        if self.rate <= 0:
+            return 0.0  # unlimited
+        amount = min(amount, self.capacity)
+        granted, wait = self.backend.reserve(self.key, amount, self.rate, self.capacity, max_wait)
+        if not granted:
+            raise RateLimitTimeout(wait)
+        return wait
+
+    def refund(self, amount):
+        if self.rate <= 0:
+            return
+        self.backend.refund(self.key, amount, self.capacity)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute budget shared by all sessions (and replicas, see backends)."""
+
+    def __init__(self, rpm, tpm=0, max_wait=60.0, backend=None, name="openai"):
+        self.requests = TokenBucket(rpm, backend=backend, key=f"ratelimit:{name}:requests")
+        self.tokens = TokenBucket(tpm, backend=backend, key=f"ratelimit:{name}:tokens")
+        self.max_wait = max_wait
+
+    def reserve(self, tokens=0):
+        request_wait = self.requests.reserve(1, self.max_wait)
+        try:
+            token_wait = self.tokens.reserve(tokens, self.max_wait)
+        except RateLimitTimeout:
+            self.requests.refund(1)
+            raise
+        return max(request_wait, token_wait)
+
+    def acquire(self, tokens=0):
+        wait = self.reserve(tokens)
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=0):
+        # The backend call blocks (Redis, SQLite) - not on the event loop
+        wait = await asyncio.to_thread(self.reserve, tokens)
+        if wait:
+            await asyncio.sleep(wait)
+
+
+def estimate_tokens(messages, max_tokens=0):
+    """Rough request size as counted against TPM (prompt + max output tokens)."""
+    # Polish text averages roughly 3 characters per token
+    prompt_chars = sum(len(message["content"]) for message in messages)
+    return prompt_chars // 3 + max_tokens
+
+
+def is_retryable(error):
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        # An exhausted quota won't come back by waiting
+        if getattr(error, "code", None) == "insufficient_quota":
+            return False
+        return error.status_code in RETRYABLE_STATUS
+    return False
+
+
+def retry_after(error):
+    """Seconds the API asked us to wait (Retry-After / retry-after-ms), or None."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+def backoff_delay(error, attempt, base=0.5, cap=30.0):
+    """Exponential backoff with full jitter; Retry-After from the API wins if given."""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    requested = retry_after(error)
+    if requested is not None:
+        # Small jitter so sessions told to wait the same time don't return together
+        delay = min(cap, requested) + random.uniform(0, base)
+    return delay
+
+
+def call_with_retry(call, limiter=None, tokens=0, attempts=None):
+    """Run an OpenAI call within the shared budget, retrying 429/5xx/connection errors."""
+    attempts = attempts or int(get_secret("OPENAI_MAX_ATTEMPTS", 5))
+    for attempt in range(attempts):
+        if limiter:
+            limiter.acquire(tokens)
+        try:
+            return call()
+        except Exception as e:
+            if attempt == attempts - 1 or not is_retryable(e):
+                raise
+            time.sleep(backoff_delay(e, attempt))
+
+
+async def call_with_retry_async(call, limiter=None, tokens=0, attempts=None):
+    """Async variant of call_with_retry - call returns an awaitable."""
+    attempts = attempts or int(get_secret("OPENAI_MAX_ATTEMPTS", 5))
+    for attempt in range(attempts):
+        if limiter:
+            await limiter.acquire_async(tokens)
+        try:
+            return await call()
+        except Exception as e:
+            if attempt == attempts - 1 or not is_retryable(e):
+                raise
+            await asyncio.sleep(backoff_delay(e, attempt))
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name):
+    """Process-wide limiter for 'chat' or 'tts' (OPENAI_CHAT_RPM/TPM, OPENAI_TTS_RPM).
+
+    The budgets are for the whole deployment when BACKEND is shared.
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            prefix = f"OPENAI_{name.upper()}"
+            _limiters[name] = RateLimiter(
+                rpm=float(get_secret(f"{prefix}_RPM", 500)),
+                tpm=float(get_secret(f"{prefix}_TPM", 200000 if name == "chat" else 0)),
+                max_wait=float(get_secret("RATE_LIMIT_MAX_WAIT", 60)),
+                backend=get_backend(),
+                name=name
+            )
+        return _limiters[name]
@@ -0,0 +1,174 @@
+"""Local safety screening: forbidden topics from get_safety_rules() as one compiled regex.
+
+The model is still told the rules; this only stops the obvious cases before
+any tokens are paid for - unsafe prompts are rejected up front, and a story
+that drifts into a forbidden topic is cut off while it streams.
+"""
+import re
+
+from prompts import get_safety_rules
+
+# Stems and inflected forms per forbidden topic, keyed by how the rule line in
+# get_safety_rules() starts. Written without Polish diacritics (text is
+# normalized the same way, so "smierc" typed without them matches too) and
+# matched at the start of a word; "$" marks a whole word, "*" also matches
+# inside a word (prefixed vulgarisms). Only unambiguous forms - a false positive costs a child their
+# story, and the stream guard judges a word before the next one arrives, so
+# idioms can't be told apart by what follows. Left out: "bic" (bijace serce),
+# "upij" (upila lyk soku), "krew" as a stem (krewny), "pobi*" (pobic rekord),
+# "zwlok" (bez zwloki), "umier" (umiera ze smiechu).
+BLOCKED_STEMS = {
+    "Śmierci": [
+        "smierc", "smierte", "umarl", "umrz", "zabij", "zabil", "zabic", "zabit",
+        "zaboj", "morderc", "mordow", "zamordow", "samobój",
+    ],
+    "Przemocy fizycznej": [
+        "przemoc", "krzywdz", "skrzywdz", "bojk", "bijaty", "tortur",
+    ],
+    "Przemocy psychicznej": ["zastrasz", "upokarz", "upokorz", "zneca", "gnebi"],
+    "Tematach seksualnych": ["seks", "erotycz", "porno"],
+    "Alkoholu": [
+        "alkohol", "wodk", "piwo$", "piwa$", "pijan", "papieros", "narkoty", "kokain",
+        "heroin", "marihuan", "dopalacz",
+    ],
+    "Krwi": ["krew$", "krwi", "krwaw", "zakrwaw"],
+    "Wulgaryzmach": [
+        "*kurw", "*pierdol", "*pierdal", "*jeba", "*jebi", "*jebn", "*chuj", "*pizd", "cipa$",
+    ],
+}
+
+_DIACRITICS = str.maketrans("ąćęłńóśźżĄĆĘŁŃÓŚŹŻ", "acelnoszzACELNOSZZ")
+
+
+def normalize(text):
+    return text.translate(_DIACRITICS).lower()
+
+
+def forbidden_rules():
+    """The rule lines of the ABSOLUTNE ZAKAZY section of get_safety_rules()."""
+    rules = get_safety_rules()
+    section = rules.split("=== ABSOLUTNE ZAKAZY", 1)[1].split("\n===", 1)[0]
+    return [line[2:].strip() for line in section.splitlines() if line.startswith("- ")]
+
+
+def _stem_pattern(stem):
+    stem = normalize(stem)
+    if stem.endswith("$"):
+        return re.escape(stem[:-1]) + r"\b"
+    return re.escape(stem)
+
+
+def build_matchers():
+    """Compile the stems of the rules in force into two regexes with a named group per rule.
+
+    Word-start stems share one leading word boundary (an order of magnitude
+    faster than a boundary per stem); "*" stems go into a second regex that
+    matches anywhere.
+    """
+    word_start, anywhere = [], []
+    rule_names = {}
+    for rule in forbidden_rules():
+        for prefix, stems in BLOCKED_STEMS.items():
+            if not rule.startswith(prefix):
+                continue
+            name = f"r{len(rule_names)}"
+            rule_names[name] = rule
+            starting = [_stem_pattern(stem) for stem in stems if not stem.startswith("*")]
+            inside = [_stem_pattern(stem[1:]) for stem in stems if stem.startswith("*")]
+            if starting:
+                word_start.append(f"(?P<{name}>" + "|".join(starting) + ")")
+            if inside:
+                anywhere.append(f"(?P<{name}>" + "|".join(inside) + ")")
+    matchers = [re.compile(r"\b(?:" + "|".join(word_start) + ")")]
+    if anywhere:
+        matchers.append(re.compile("|".join(anywhere)))
+    return matchers, rule_names
+
+
+_MATCHERS, _RULE_NAMES = build_matchers()
+_WORD_HEAD = re.compile(r"\w*$")
+_WORD_TAIL = re.compile(r"\w*")
+
+
+class UnsafeContentError(Exception):
+    """Text hit a forbidden topic from get_safety_rules()."""
+
+    def __init__(self, rule, word):
+        super().__init__(f"Niedozwolona treść ({rule}): {word}")
+        self.rule = rule
+        self.word = word
+
+
+def find_violation(text):
+    """(rule, whole forbidden word) for a forbidden word in text, or None."""
+    text = normalize(text)
+    for matcher in _MATCHERS:
+        match = matcher.search(text)
+        if match:
+            start, end = match.span()
+            word = _WORD_HEAD.search(text, 0, start).group() + _WORD_TAIL.match(text, start).group()
+            return _RULE_NAMES[match.lastgroup], word
+    return None
+
+
+_REPEATED_CHAR = re.compile(r"(\w)\1{5,}")
+_WORD = re.compile(r"[^\W\d_]+")
+# Six consonants in a row - Polish stops at five ("bezwzgledny", "wszczal")
+_CONSONANT_RUN = re.compile(r"[^\Waeiouy\d_]{6,}")
+
+
+def _unpronounceable(word):
+    # Short words without vowels are acronyms ("WWF") or sounds ("brrr")
+    return bool(_CONSONANT_RUN.search(word))
+
+
+def is_gibberish(text):
+    """Keyboard mashing like "asdfghjkl" or "aaaaaaa" - not worth a generation."""
+    text = normalize(text)
+    words = [word for word in _WORD.findall(text) if len(word) >= 3]
+    if not words:
+        return bool(text.strip()) and not _WORD.search(text)
+    if _REPEATED_CHAR.search(text):
+        return True
+    return sum(1 for word in words if _unpronounceable(word)) / len(words) > 0.5
+
+
+def check_prompt(prompt, child_name=""):
+    """Message for the user if the story request must not be sent, else None."""
+    violation = find_violation(f"{child_name} {prompt}")
+    if violation:
+        return "🛡️ Ten pomysł nie pasuje do bajki dla dziecka - spróbuj czegoś radosnego!"
+    if prompt.strip() and is_gibberish(prompt):
+        return "🤔 Nie rozumiem tego pomysłu - opisz go kilkoma słowami."
+    return None
+
+
+class StreamGuard:
+    """Scans a streamed story incrementally and raises UnsafeContentError on the first violation.
+
+    Only complete words are checked, so a word cut in the middle of the stream
+    (e.g. "krew" of "krewny") is not judged too early.
+    """
+
+    def __init__(self, checked=0):
+        # Text before this offset has already passed (e.g. the story a continuation extends)
+        self.checked = checked
+
+    def feed(self, text):
+        """Check the newly completed words; returns the prefix of text that passed."""
+        end = len(text) - len(re.search(r"\w*$", text).group())
+        if end > self.checked:
+            self._check(text[self.checked:end])
+            self.checked = end
+        return text[:self.checked]
+
+    def finish(self, text):
+        if len(text) > self.checked:
+            self._check(text[self.checked:])
+            self.checked = len(text)
+        return text
+
+    def _check(self, text):
+        violation = find_violation(text)
+        if violation:
+            raise UnsafeContentError(*violation)
@@ -0,0 +1,27 @@
+"""Memory accounting of a session's state (shown with SHOW_MEMORY_STATS=1)."""
+import sys
+
+
+def deep_sizeof(value, seen=None):
+    """Approximate memory held by a value, following containers and objects."""
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in value)
+    elif hasattr(value, "getbuffer"):
+        # BytesIO: sys.getsizeof doesn't include the buffer
+        size += value.getbuffer().nbytes
+    elif hasattr(value, "__dict__"):
+        size += deep_sizeof(vars(value), seen)
+    return size
+
+
+def memory_report(session_state):
+    """[(key, bytes)] for a session's state, largest first."""
+    sizes = [(key, deep_sizeof(session_state[key])) for key in list(session_state.keys())]
+    return sorted(sizes, key=lambda item: item[1], reverse=True)
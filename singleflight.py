@@ -0,0 +1,95 @@
+import threading
+
+
+class _Call:
+    """One in-flight upstream call and everybody waiting for it."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.done = False
+        self.result = None
+        self.error = None
+        self.partial = None
+        self.version = 0
+
+    def update(self, partial):
+        with self.cond:
+            self.partial = partial
+            self.version += 1
+            self.cond.notify_all()
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one upstream call.
+
+    The first caller (leader) runs fn(update); callers arriving while it is in
+    flight wait and get the same result or exception. The leader may publish
+    partial results with update(), which followers receive through on_update -
+    e.g. the streamed story text.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key, fn, on_update=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.shared += 1
+
+        if leader:
+            try:
+                call.result = fn(call.update)
+                return call.result
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                with call.cond:
+                    call.done = True
+                    call.cond.notify_all()
+
+        seen = 0
+        while True:
+            with call.cond:
+                while not call.done and call.version == seen:
+                    call.cond.wait()
+                done = call.done
+                version, partial = call.version, call.partial
+            if on_update and version != seen and partial is not None:
+                on_update(partial)
+            seen = version
+            if done:
+                break
+        if isinstance(call.error, Exception):
+            raise call.error
+        if call.error is not None:
+            # Leader was interrupted (e.g. its script run was stopped) - not our
+            # failure, so run the call again ourselves
+            return self.do(key, fn, on_update)
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._calls), "leaders": self.leaders, "shared": self.shared}
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def get_single_flight(name):
+    """Process-wide SingleFlight group, e.g. 'story' or 'audio'."""
+    with _flights_lock:
+        if name not in _flights:
+            _flights[name] = SingleFlight()
+        return _flights[name]
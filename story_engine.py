@@ -0,0 +1,321 @@
+import asyncio
+import re
+import time
+from datetime import datetime
+
+from audio_cache import AudioCache
+from audio_pipeline import SENTENCE_BOUNDARY, join_audio, split_finished_chunks, split_for_tts
+from prompts import TARGET_WORDS, build_continuation_message, build_system_prompt, build_user_message
+from ratelimit import call_with_retry_async, estimate_tokens, get_rate_limiter
+from safety import StreamGuard, UnsafeContentError, check_prompt
+
+# Story generation settings
+STORY_MODEL = "gpt-4o-mini"
+STORY_TEMPERATURE = 0.8
+STORY_MAX_TOKENS = 1500
+
+# Polish takes about 2 tokens per word with gpt-4o-mini's tokenizer; the
+# headroom lets the model finish its last sentence before the hard limit
+TOKENS_PER_WORD = 2.2
+TOKEN_HEADROOM = 1.3
+# A story shorter than this share of the lower word target gets a continuation
+MIN_LENGTH_SHARE = 0.85
+MIN_CONTINUATION_WORDS = 40
+
+# TTS settings (also part of the audio cache key); TTS_FORMAT is the default
+# response_format, opus and aac are smaller alternatives for mobile clients
+TTS_MODEL = "tts-1"
+TTS_VOICE = "nova"
+TTS_FORMAT = "mp3"
+
+# Prices in USD, for the cost estimates in the metrics
+STORY_PRICE_PER_1M_TOKENS = {"input": 0.15, "cached_input": 0.075, "output": 0.60}
+TTS_PRICE_PER_1M_CHARS = 15.0
+
+
+def story_messages(prompt, child_name, child_age, lesson):
+    return [
+        {"role": "system", "content": build_system_prompt(child_name, child_age, lesson)},
+        {"role": "user", "content": build_user_message(prompt, child_name)}
+    ]
+
+
+SENTENCE_END = re.compile(r'[.!?…]+["”»)]*$')
+
+
+def story_budget(child_age):
+    """Word target and output-token budget for an age band (from TARGET_WORDS)."""
+    min_words, max_words = (int(n) for n in TARGET_WORDS.get(child_age, "350-400").split("-"))
+    return {
+        'min_words': min_words,
+        'max_words': max_words,
+        'max_tokens': min(STORY_MAX_TOKENS, round(max_words * TOKENS_PER_WORD * TOKEN_HEADROOM))
+    }
+
+
+def story_stats(text):
+    """Word and sentence counts and reading time, stored on the story dict."""
+    words = len(text.split())
+    return {
+        'words': words,
+        'sentences': len(re.findall(r'[.!?]+', text)),
+        'reading_minutes': max(1, round(words / 200))
+    }
+
+
+def trim_to_sentence(text):
+    """Drop an unfinished last sentence (e.g. cut off by max_tokens)."""
+    text = text.rstrip()
+    if SENTENCE_END.search(text):
+        return text
+    _, rest = split_finished_chunks(text, 1)
+    return text[:len(text) - len(rest)].rstrip() if len(rest) < len(text) else text
+
+
+def finish_text(text, finish_reason):
+    """The streamed story, without the unfinished sentence max_tokens cut it off in."""
+    return trim_to_sentence(text) if finish_reason == "length" else text
+
+
+def needs_continuation(text, budget):
+    return story_stats(text)['words'] < budget['min_words'] * MIN_LENGTH_SHARE
+
+
+def continuation_request(messages, text, budget):
+    """(messages, max_tokens) asking the model to finish a short or cut-off story.
+
+    The original messages come first, so the request reuses the cached prompt prefix.
+    """
+    missing_words = max(budget['min_words'] - story_stats(text)['words'], MIN_CONTINUATION_WORDS)
+    return messages + [
+        {"role": "assistant", "content": text},
+        {"role": "user", "content": build_continuation_message(missing_words)}
+    ], round(missing_words * TOKENS_PER_WORD * TOKEN_HEADROOM)
+
+
+def join_continuation(text, more):
+    return text.rstrip() + ("\n\n" if text.endswith("\n") else " ") + more.lstrip()
+
+
+def continuation_start(text):
+    """Offset at which a continuation's own text starts in join_continuation(text, ...).
+
+    The joined story rewrites the whitespace at the end of text (and text may
+    already be shorter than what was streamed), so offsets into the streamed
+    text are not valid in it.
+    """
+    return len(join_continuation(text, ""))
+
+
+class LengthCutoff:
+    """Ends a streamed story at the first sentence boundary past the upper word target."""
+
+    def __init__(self, max_words):
+        self.max_words = max_words
+        self._target_end = None
+
+    def check(self, text):
+        """The story cut after the sentence that crosses max_words, or None while it may go on."""
+        if self._target_end is None:
+            match = re.match(r"\s*(?:\S+\s+){%d}" % self.max_words, text)
+            if not match:
+                return None
+            self._target_end = match.end()
+        boundary = SENTENCE_BOUNDARY.search(text, self._target_end)
+        return text[:boundary.end()].rstrip() if boundary else None
+
+
+# Shown in place of an empty idea
+EMPTY_PROMPT_LABEL = "Magiczna przygoda"
+
+
+def story_record(content, prompt, child_name, child_age, lesson, **extra):
+    """The story dict stored in history and returned by create_story.
+
+    'prompt' is for display; 'raw_prompt' is the idea as asked for ("" for none).
+    """
+    story = {
+        'content': content,
+        'genre': '🧚 Bajka',
+        'child_name': child_name,
+        'child_age': child_age,
+        'lesson': lesson,
+        'prompt': prompt.strip() or EMPTY_PROMPT_LABEL,
+        'raw_prompt': prompt.strip(),
+        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M")
+    }
+    story.update(story_stats(content))
+    story.update(extra)
+    return story
+
+
+def raw_prompt(story):
+    """The idea a story was asked for - stories from before 'raw_prompt' only have the label."""
+    if 'raw_prompt' in story:
+        return story['raw_prompt']
+    return "" if story['prompt'] == EMPTY_PROMPT_LABEL else story['prompt']
+
+
+def story_cost(usage, cached_tokens=0):
+    """Estimated cost of one story completion in USD (0 if usage is unknown)."""
+    if not usage:
+        return 0.0
+    prices = STORY_PRICE_PER_1M_TOKENS
+    return (
+        (usage.prompt_tokens - cached_tokens) * prices["input"]
+        + cached_tokens * prices["cached_input"]
+        + usage.completion_tokens * prices["output"]
+    ) / 1_000_000
+
+
+def tts_cost(characters):
+    return characters * TTS_PRICE_PER_1M_CHARS / 1_000_000
+
+
+def narration_cache_key(story_content, fmt=TTS_FORMAT):
+    return AudioCache.key(story_content, TTS_MODEL, TTS_VOICE, fmt)
+
+
+class StreamCollector:
+    """Accumulates a streamed chat completion: text, usage and time to first token."""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.parts = []
+        self.usage = None
+        self.ttft = None
+        self.first_token_at = None
+        self.finish_reason = None
+
+    def add(self, chunk):
+        """Consume one stream chunk; True if it carried new text."""
+        # Usage arrives in the last chunk, which has no choices
+        if chunk.usage:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return False
+        if chunk.choices[0].finish_reason:
+            self.finish_reason = chunk.choices[0].finish_reason
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            return False
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.started_at
+            self.first_token_at = datetime.now()
+        self.parts.append(delta)
+        return True
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    @property
+    def cached_tokens(self):
+        """Prompt tokens served from the provider's prefix cache (0 if unknown)."""
+        details = getattr(self.usage, "prompt_tokens_details", None)
+        return (getattr(details, "cached_tokens", None) or 0) if details else 0
+
+    def timings(self):
+        return {
+            'ttft_seconds': round(self.ttft, 3) if self.ttft is not None else None,
+            'generation_seconds': round(time.perf_counter() - self.started_at, 3)
+        }
+
+
+class StoryEngine:
+    """Story and narration generation on AsyncOpenAI, without any Streamlit dependency."""
+
+    def __init__(self, client, tts_concurrency=4, audio_cache=None):
+        self.client = client
+        self.audio_cache = audio_cache
+        self._tts_slots = asyncio.Semaphore(tts_concurrency)
+
+    async def create_story(self, prompt, child_name, child_age, lesson, on_token=None):
+        """Generate a personalized fairy tale; same dict as the app's create_story.
+
+        Raises UnsafeContentError for a prompt that fails the local safety
+        check, or as soon as the streamed story hits a forbidden topic.
+        """
+        rejection = check_prompt(prompt, child_name)
+        if rejection:
+            raise UnsafeContentError("prompt", rejection)
+        messages = story_messages(prompt, child_name, child_age, lesson)
+        budget = story_budget(child_age)
+        collector, content = await self._stream_story(
+            messages, budget['max_tokens'], StreamGuard(), on_token, cutoff=LengthCutoff(budget['max_words'])
+        )
+        continued = needs_continuation(content, budget)
+        if continued:
+            continuation_messages, max_tokens = continuation_request(messages, content, budget)
+            _, content = await self._stream_story(
+                continuation_messages, max_tokens, StreamGuard(continuation_start(content)), on_token,
+                prefix=content, cutoff=LengthCutoff(budget['max_words'])
+            )
+        return story_record(
+            content, prompt, child_name, child_age, lesson, continued=continued, **collector.timings()
+        )
+
+    async def _stream_story(self, messages, max_tokens, guard, on_token, prefix="", cutoff=None):
+        """Stream one completion through the guard; returns (collector, text with prefix)."""
+        collector = StreamCollector()
+        stream = await call_with_retry_async(
+            lambda: self.client.chat.completions.create(
+                model=STORY_MODEL,
+                messages=messages,
+                temperature=STORY_TEMPERATURE,
+                max_tokens=max_tokens,
+                stream=True,
+                stream_options={"include_usage": True}
+            ),
+            limiter=get_rate_limiter("chat"),
+            tokens=estimate_tokens(messages, max_tokens)
+        )
+        text = prefix
+        try:
+            async for chunk in stream:
+                if collector.add(chunk):
+                    text = join_continuation(prefix, collector.text) if prefix else collector.text
+                    cut = cutoff.check(text) if cutoff else None
+                    if cut:
+                        text = cut
+                        collector.finish_reason = "cutoff"
+                    safe_text = guard.feed(text)
+                    if on_token:
+                        on_token(safe_text)
+                    if cut:
+                        break
+            guard.finish(text)
+        finally:
+            # Also on a cutoff, an unsafe story or a cancelled task: closing the
+            # stream stops the generation - no more tokens billed
+            await stream.close()
+        return collector, finish_text(text, collector.finish_reason)
+
+    async def synthesize_speech(self, text, fmt=TTS_FORMAT):
+        async with self._tts_slots:
+            response = await call_with_retry_async(
+                lambda: self.client.audio.speech.create(
+                    model=TTS_MODEL,
+                    voice=TTS_VOICE,
+                    input=text,
+                    response_format=fmt
+                ),
+                limiter=get_rate_limiter("tts")
+            )
+        return response.content
+
+    async def generate_audio_narration(self, story_content, fmt=TTS_FORMAT):
+        """Narrate a story (chunked, parallel TTS) and return the audio bytes in fmt."""
+        key = narration_cache_key(story_content, fmt)
+        # Disk and shared-backend I/O runs in threads, so the other stories keep streaming
+        if self.audio_cache:
+            cached = await asyncio.to_thread(self.audio_cache.get, key)
+            if cached:
+                return cached
+        parts = await asyncio.gather(*(
+            self.synthesize_speech(chunk, fmt) for chunk in split_for_tts(story_content)
+        ))
+        audio_bytes = join_audio(parts, fmt)
+        if self.audio_cache:
+            await asyncio.to_thread(self.audio_cache.put, key, audio_bytes)
+        return audio_bytes
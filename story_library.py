@@ -0,0 +1,222 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from backends import get_backend
+from clients import get_secret
+from safety import normalize
+
+# Columns listed in the sidebar - the full text is read only when a story is opened
+SUMMARY_COLUMNS = ("id", "created_at", "child_name", "child_age", "lesson", "preview")
+# Story dict keys stored in their own columns, the rest goes to "extra" as JSON
+STORY_COLUMNS = ("content", "child_name", "child_age", "lesson", "prompt", "timestamp")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stories (
+    id INTEGER PRIMARY KEY,
+    owner TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    child_name TEXT NOT NULL,
+    child_age TEXT,
+    lesson TEXT,
+    prompt TEXT,
+    timestamp TEXT,
+    preview TEXT,
+    content TEXT NOT NULL,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS stories_owner_id ON stories (owner, id);
+"""
+
+# External-content FTS5 index kept in sync by triggers; diacritics are folded,
+# so "zosie" finds "Zosię"
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS stories_fts USING fts5(
+    content, child_name, lesson, prompt,
+    content='stories', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS stories_fts_insert AFTER INSERT ON stories BEGIN
+    INSERT INTO stories_fts (rowid, content, child_name, lesson, prompt)
+    VALUES (new.id, new.content, new.child_name, new.lesson, new.prompt);
+END;
+CREATE TRIGGER IF NOT EXISTS stories_fts_delete AFTER DELETE ON stories BEGIN
+    INSERT INTO stories_fts (stories_fts, rowid, content, child_name, lesson, prompt)
+    VALUES ('delete', old.id, old.content, old.child_name, old.lesson, old.prompt);
+END;
+"""
+
+_SEARCH_TERM = re.compile(r"\w+")
+
+
+def match_expression(query):
+    """FTS5 query for free text: every word as a prefix (Polish inflects - "smok" finds "smoka")."""
+    return " ".join(f'"{term}"*' for term in _SEARCH_TERM.findall(query))
+
+
+class StoryLibrary:
+    """Persistent per-owner story library in SQLite with full-text search.
+
+    Listing is keyset-paginated by id (newest first), so a page costs the
+    same however many stories an owner has. Falls back to LIKE search when
+    the SQLite build has no FTS5.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+            try:
+                self._conn.executescript(FTS_SCHEMA)
+                self.fts = True
+            except sqlite3.OperationalError:
+                self.fts = False
+
+    def add(self, owner, story):
+        """Store a story dict as returned by create_story; returns its id."""
+        extra = {key: value for key, value in story.items() if key not in STORY_COLUMNS and key != 'library_id'}
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO stories (owner, created_at, child_name, child_age, lesson, prompt, timestamp,"
+                " preview, content, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    owner, time.time(), story['child_name'], story.get('child_age'), story.get('lesson'),
+                    story.get('prompt'), story.get('timestamp'), story['content'][:100], story['content'],
+                    json.dumps(extra, ensure_ascii=False, default=str)
+                )
+            )
+        return cursor.lastrowid
+
+    def page(self, owner, before_id=None, limit=5, query=""):
+        """Up to limit summaries older than before_id, newest first (optionally matching query)."""
+        columns = ", ".join(f"s.{column}" for column in SUMMARY_COLUMNS)
+        where = ["s.owner = ?"]
+        params = [owner]
+        source = "stories s"
+        if before_id is not None:
+            where.append("s.id < ?")
+            params.append(before_id)
+        expression = match_expression(query) if query else ""
+        if expression and self.fts:
+            source = "stories_fts f JOIN stories s ON s.id = f.rowid"
+            where.append("stories_fts MATCH ?")
+            params.append(expression)
+        elif query:
+            where.append("(s.content LIKE ? OR s.child_name LIKE ? OR s.lesson LIKE ? OR s.prompt LIKE ?)")
+            params.extend([f"%{query}%"] * 4)
+        sql = f"SELECT {columns} FROM {source} WHERE {' AND '.join(where)} ORDER BY s.id DESC LIMIT ?"
+        with self._lock:
+            rows = self._conn.execute(sql, params + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def get(self, owner, story_id):
+        """The full story dict, or None (also for another owner's story)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM stories WHERE id = ? AND owner = ?", (story_id, owner)
+            ).fetchone()
+        if row is None:
+            return None
+        story = json.loads(row['extra'] or "{}")
+        story.update({column: row[column] for column in STORY_COLUMNS})
+        story['library_id'] = row['id']
+        return story
+
+    def delete_owner(self, owner):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM stories WHERE owner = ?", (owner,))
+
+
+class BackendStoryLibrary:
+    """The same library in the shared backend, so every replica sees the same one.
+
+    Per owner a queue of summaries (each with the folded words of its story,
+    for search) and every story under its own key. Listing and search read
+    the owner's whole queue - a family's library is tens of stories, not
+    thousands, so there is no index to keep up across replicas.
+    """
+
+    fts = False
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def _index(owner):
+        return f"library:{owner}"
+
+    def add(self, owner, story):
+        """Store a story dict as returned by create_story; returns its id."""
+        story_id = int(self.backend.incr("library:next_id", 1))
+        stored = {key: value for key, value in story.items() if key != 'library_id'}
+        self.backend.set_json(f"library:story:{story_id}", dict(stored, owner=owner))
+        searchable = " ".join(str(story.get(key) or "") for key in ("content", "child_name", "lesson", "prompt"))
+        self.backend.push(self._index(owner), json.dumps({
+            "id": story_id, "created_at": time.time(), "child_name": story['child_name'],
+            "child_age": story.get('child_age'), "lesson": story.get('lesson'),
+            "preview": story['content'][:100],
+            "words": " ".join(sorted(set(_SEARCH_TERM.findall(normalize(searchable))))),
+        }, ensure_ascii=False))
+        return story_id
+
+    def page(self, owner, before_id=None, limit=5, query=""):
+        """Up to limit summaries older than before_id, newest first (optionally matching query)."""
+        # Every word as a prefix of one of the story's words, like the FTS5 query
+        terms = [" " + term for term in _SEARCH_TERM.findall(normalize(query))]
+        rows = []
+        for entry in self.backend.items(self._index(owner)):
+            entry = json.loads(entry)
+            if before_id is not None and entry["id"] >= before_id:
+                continue
+            words = " " + entry.pop("words")
+            if all(term in words for term in terms):
+                rows.append(entry)
+        rows.sort(key=lambda row: row["id"], reverse=True)
+        return rows[:limit]
+
+    def get(self, owner, story_id):
+        """The full story dict, or None (also for another owner's story)."""
+        story = self.backend.get_json(f"library:story:{int(story_id)}")
+        if story is None or story.pop("owner", None) != owner:
+            return None
+        story['library_id'] = int(story_id)
+        return story
+
+    def delete_owner(self, owner):
+        for entry in self.backend.items(self._index(owner)):
+            self.backend.delete(f"library:story:{json.loads(entry)['id']}")
+        self.backend.delete(self._index(owner))
+
+
+_library = None
+_library_lock = threading.Lock()
+
+
+def get_story_library():
+    """Process-wide story library (LIBRARY = sqlite | backend; LIBRARY_PATH).
+
+    sqlite keeps it in a file of this host, with FTS5 search; backend in the
+    shared backend, so `?lib=` links show the same library on every replica.
+    The default follows BACKEND: backend for redis, sqlite otherwise.
+    """
+    global _library
+    with _library_lock:
+        if _library is None:
+            backend = get_backend()
+            kind = str(get_secret("LIBRARY", "backend" if backend.name == "redis" else "sqlite")).lower()
+            if kind == "backend":
+                _library = BackendStoryLibrary(backend)
+            elif kind == "sqlite":
+                _library = StoryLibrary(get_secret("LIBRARY_PATH", os.path.join(".cache", "library.sqlite3")))
+            else:
+                raise ValueError(f"Unknown LIBRARY: {kind} (sqlite or backend)")
+    return _library
@@ -0,0 +1,226 @@
+import json
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from admission import get_budget
+from backends import MemoryBackend, get_backend
+from clients import get_secret
+from prompts import AGE_OPTIONS, LESSON_OPTIONS, build_system_prompt
+from ratelimit import call_with_retry, estimate_tokens, get_rate_limiter
+from safety import find_violation
+from story_engine import STORY_MODEL, STORY_TEMPERATURE, finish_text, story_budget, story_cost
+
+# Pooled stories are written for a placeholder hero and personalized at serve time
+NAME_PLACEHOLDER = "{{IMIE}}"
+# Placeholder with a case ending glued on ("{{IMIE}}owi") - filled in it would read "Zosiaowi"
+INFLECTED_PLACEHOLDER = re.compile(re.escape(NAME_PLACEHOLDER) + r"\w")
+
+# Polish masculine names that end with "a" (most names ending with "a" are feminine)
+MASCULINE_NAMES_ENDING_WITH_A = {"kuba", "barnaba", "bonawentura", "kosma", "jarema", "zawisza"}
+
+
+def guess_gender(child_name):
+    """Guess grammatical gender from a Polish first name - 'f' or 'm'."""
+    name = child_name.strip().lower()
+    if name.endswith("a") and name not in MASCULINE_NAMES_ENDING_WITH_A:
+        return "f"
+    return "m"
+
+
+def template_instructions(gender):
+    hero = "dziewczynka" if gender == "f" else "chłopiec"
+    return f"""
+
+=== IMIĘ BOHATERA ===
+Bohater jest {hero}. Zamiast imienia pisz dokładnie {NAME_PLACEHOLDER}.
+Używaj {NAME_PLACEHOLDER} TYLKO w mianowniku (jako podmiot zdania, np. "{NAME_PLACEHOLDER} uśmiechnął/uśmiechnęła się").
+W innych przypadkach zamiast imienia użyj zaimka (on/ona, jego/jej, jemu/jej)."""
+
+
+def is_valid_template(content):
+    # Placeholder used at least twice and never inflected, nothing else left in curly braces, no forbidden topics
+    return (
+        content.count(NAME_PLACEHOLDER) >= 2
+        and not INFLECTED_PLACEHOLDER.search(content)
+        and content.replace(NAME_PLACEHOLDER, "").count("{{") == 0
+        and find_violation(content) is None
+    )
+
+
+def fill_template(content, child_name):
+    return content.replace(NAME_PLACEHOLDER, child_name)
+
+
+def generate_template_story(client, child_age, lesson, gender):
+    """Generate one pooled story for the empty-prompt path, or None if unusable (or the budget is spent)."""
+    budget = get_budget()
+    if budget.exhausted():
+        return None
+    system_prompt = build_system_prompt(NAME_PLACEHOLDER, child_age, lesson) + template_instructions(gender)
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": f"Stwórz magiczną bajkę o przygodach {NAME_PLACEHOLDER}"}
+    ]
+    max_tokens = story_budget(child_age)['max_tokens']
+    # Shares the rate budget with interactive sessions
+    response = call_with_retry(
+        lambda: client.chat.completions.create(
+            model=STORY_MODEL,
+            messages=messages,
+            temperature=STORY_TEMPERATURE,
+            max_tokens=max_tokens
+        ),
+        limiter=get_rate_limiter("chat"),
+        tokens=estimate_tokens(messages, max_tokens)
+    )
+    usage = response.usage
+    if usage:
+        budget.charge(usage.total_tokens, story_cost(usage))
+    choice = response.choices[0]
+    content = finish_text(choice.message.content or "", choice.finish_reason)
+    return content if is_valid_template(content) else None
+
+
+# A replica refilling a key holds its lease at most this long (if it dies meanwhile)
+REFILL_LEASE_SECONDS = 600
+
+
+class StoryPool:
+    """Background-refilled pool of ready stories per (child_age, lesson, gender).
+
+    depth - ready stories kept per key
+    refill_workers - concurrent background generations
+    max_age - seconds after which a pooled story is dropped
+    max_serves - how many different sessions may get the same story
+    backend - where the ready stories queue; a shared one makes one pool for
+    all replicas, refilled by one replica per key at a time
+    """
+
+    def __init__(self, generate, depth=2, refill_workers=2, max_age=24 * 3600, max_serves=1, backend=None):
+        self._generate = generate
+        self.depth = depth
+        self.max_age = max_age
+        self.max_serves = max_serves
+        self.backend = backend or MemoryBackend()
+        self._executor = ThreadPoolExecutor(max_workers=refill_workers, thread_name_prefix="story-pool")
+        self._lock = threading.Lock()
+        self._keys = set()
+        self._pending = defaultdict(int)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _queue(key):
+        return "pool:" + "|".join(key)
+
+    def take(self, key, exclude_ids=()):
+        """Return (story_id, template) not yet served to this session, or None.
+
+        Stories are taken oldest first; one that may still be served to other
+        sessions goes back to the end of the queue, stale ones are dropped.
+        """
+        queue = self._queue(key)
+        story = None
+        for _ in range(self.backend.length(queue)):
+            entry = self.backend.pop(queue)
+            if entry is None:
+                break
+            entry = json.loads(entry)
+            if time.time() - entry["created_at"] >= self.max_age:
+                continue
+            if entry["id"] in exclude_ids:
+                self.backend.push(queue, json.dumps(entry))
+                continue
+            entry["serves"] += 1
+            if entry["serves"] < self.max_serves:
+                self.backend.push(queue, json.dumps(entry))
+            story = entry
+            break
+        with self._lock:
+            if story:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self.refill(key)
+        return (story["id"], story["content"]) if story else None
+
+    def refill(self, key):
+        queue = self._queue(key)
+        with self._lock:
+            self._keys.add(key)
+            if self._pending[key]:
+                # This replica is refilling the key already
+                return
+            missing = self.depth - self.backend.length(queue)
+            if missing <= 0 or not self.backend.add(f"{queue}:refill", b"1", REFILL_LEASE_SECONDS):
+                return
+            self._pending[key] = missing
+        for _ in range(missing):
+            self._executor.submit(self._refill_one, key)
+
+    def _refill_one(self, key):
+        try:
+            content = self._generate(*key)
+        except Exception:
+            content = None
+        queue = self._queue(key)
+        if content:
+            self.backend.push(queue, json.dumps(
+                {"id": uuid.uuid4().hex, "content": content, "created_at": time.time(), "serves": 0},
+                ensure_ascii=False
+            ))
+        with self._lock:
+            self._pending[key] -= 1
+            if not self._pending[key]:
+                self.backend.delete(f"{queue}:refill")
+
+    def warm(self, keys):
+        for key in keys:
+            self.refill(key)
+
+    def stats(self):
+        with self._lock:
+            keys = list(self._keys)
+            pending = sum(self._pending.values())
+        return {
+            "ready": sum(self.backend.length(self._queue(key)) for key in keys),
+            "pending": pending,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_story_pool(client):
+    """Process-wide story pool (POOL_DEPTH, POOL_REFILL_WORKERS, POOL_MAX_AGE_HOURS, POOL_MAX_SERVES).
+
+    Keys are filled when they are first asked for. POOL_PREWARM=1 fills every
+    (age, lesson, gender) key at startup instead - 2 * POOL_DEPTH paid
+    generations per age and lesson before anybody asks for a story.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = StoryPool(
+                lambda child_age, lesson, gender: generate_template_story(client, child_age, lesson, gender),
+                depth=int(get_secret("POOL_DEPTH", 2)),
+                refill_workers=int(get_secret("POOL_REFILL_WORKERS", 2)),
+                max_age=float(get_secret("POOL_MAX_AGE_HOURS", 24)) * 3600,
+                max_serves=int(get_secret("POOL_MAX_SERVES", 1)),
+                backend=get_backend()
+            )
+            if str(get_secret("POOL_PREWARM", "0")) == "1":
+                _pool.warm(
+                    (child_age, lesson, gender)
+                    for child_age in AGE_OPTIONS
+                    for lesson in LESSON_OPTIONS
+                    for gender in ("f", "m")
+                )
+    return _pool
@@ -0,0 +1,230 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+from clients import get_langfuse, get_secret
+
+logger = logging.getLogger(__name__)
+
+# Export failures are logged at most this often; in between they are only counted
+EXPORT_ERROR_LOG_SECONDS = 60.0
+
+
+class Trace:
+    """One traced operation, built locally and handed to the exporter as a whole when it ends.
+
+    Recording spans only appends to lists - nothing here does I/O, so tracing
+    costs next to nothing on the request path.
+    """
+
+    def __init__(self, telemetry, name, user_id=None, **metadata):
+        self.telemetry = telemetry
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.user_id = user_id
+        self.metadata = metadata
+        self.started_at = time.time()
+        self.spans = []
+        self.generations = []
+        self.error = None
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Time a stage; the yielded dict can be filled with more attributes."""
+        started_at = time.time()
+        try:
+            yield attributes
+        finally:
+            self.add_span(name, started_at, time.time(), **attributes)
+
+    def add_span(self, name, started_at, ended_at, **attributes):
+        """Record a stage timed elsewhere (wall-clock seconds)."""
+        self.spans.append({"name": name, "start": started_at, "end": ended_at, "attributes": attributes})
+
+    def generation(self, name, model, started_at, ended_at, **fields):
+        """Record a model call: input, output, usage, model_parameters, completion_start, metadata."""
+        self.generations.append(dict(fields, name=name, model=model, start=started_at, end=ended_at))
+
+    def end(self, error=None):
+        self.error = repr(error) if error is not None else None
+        self.telemetry.submit(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end(exc)
+        return False
+
+
+class Telemetry:
+    """Bounded queue of finished traces, exported in batches by a background thread.
+
+    When the queue is full new traces are dropped and counted - telemetry never
+    slows down or breaks story generation. Pending traces are flushed at exit.
+    """
+
+    def __init__(self, exporter, max_queue=1000, batch_size=50, flush_interval=2.0):
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.submitted = 0
+        self.dropped = 0
+        self.exported = 0
+        self.export_errors = 0
+        self._error_logged_at = None
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._count_lock = threading.Lock()
+        self._export_lock = threading.Lock()
+        if exporter is not None:
+            threading.Thread(target=self._run, name="telemetry", daemon=True).start()
+
+    def trace(self, name, user_id=None, **metadata):
+        return Trace(self, name, user_id, **metadata)
+
+    def submit(self, trace):
+        if self.exporter is None:
+            return
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            with self._count_lock:
+                self.dropped += 1
+            return
+        with self._count_lock:
+            self.submitted += 1
+
+    def _take_batch(self, timeout):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=timeout))
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _export(self, batch):
+        if not batch:
+            return
+        with self._export_lock:
+            try:
+                self.exporter(batch)
+                self.exported += len(batch)
+            except Exception:
+                self.export_errors += 1
+                now = time.monotonic()
+                if self._error_logged_at is None or now - self._error_logged_at >= EXPORT_ERROR_LOG_SECONDS:
+                    self._error_logged_at = now
+                    logger.warning(
+                        "Telemetry export failed (%d failed batches so far)", self.export_errors, exc_info=True
+                    )
+
+    def _run(self):
+        while True:
+            self._export(self._take_batch(self.flush_interval))
+
+    def flush(self):
+        """Export everything still queued (called at exit)."""
+        while not self._queue.empty():
+            self._export(self._take_batch(0))
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "submitted": self.submitted,
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "export_errors": self.export_errors,
+        }
+
+
+def _safe(value):
+    """Langfuse chokes on lone surrogates in Polish text - strip them once, in the exporter."""
+    if isinstance(value, str):
+        return value.encode("utf-8", errors="ignore").decode("utf-8")
+    if isinstance(value, dict):
+        return {key: _safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_safe(item) for item in value]
+    return value
+
+
+def _timestamp(seconds):
+    return datetime.fromtimestamp(seconds) if seconds is not None else None
+
+
+class LangfuseExporter:
+    """Replays finished traces into the Langfuse client (which ships them in its own batches).
+
+    Uses the langfuse 2 API - trace() with explicit start and end times, which
+    the OpenTelemetry-based 3+ clients no longer offer.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __call__(self, batch):
+        for trace in batch:
+            metadata = _safe(trace.metadata)
+            if trace.error:
+                metadata["error"] = _safe(trace.error)
+            exported = self.client.trace(
+                id=trace.id,
+                name=trace.name,
+                user_id=trace.user_id,
+                metadata=metadata,
+                timestamp=_timestamp(trace.started_at)
+            )
+            for span in trace.spans:
+                exported.span(
+                    name=span["name"],
+                    start_time=_timestamp(span["start"]),
+                    end_time=_timestamp(span["end"]),
+                    metadata=_safe(span["attributes"])
+                )
+            for generation in trace.generations:
+                exported.generation(
+                    name=generation["name"],
+                    model=generation["model"],
+                    model_parameters=generation.get("model_parameters"),
+                    input=_safe(generation.get("input")),
+                    output=_safe(generation.get("output")),
+                    usage=generation.get("usage"),
+                    metadata=_safe(generation.get("metadata")),
+                    start_time=_timestamp(generation["start"]),
+                    end_time=_timestamp(generation["end"]),
+                    completion_start_time=_timestamp(generation.get("completion_start"))
+                )
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+
+def get_telemetry():
+    """Process-wide telemetry (TELEMETRY_QUEUE_SIZE, TELEMETRY_BATCH_SIZE, TELEMETRY_FLUSH_SECONDS).
+
+    Exports to Langfuse when it is configured; otherwise traces are discarded.
+    """
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            langfuse = get_langfuse()
+            if langfuse is not None and not hasattr(langfuse, "trace"):
+                logger.error("Langfuse client has no trace() (langfuse 3+); install langfuse<3 - traces are discarded")
+                langfuse = None
+            _telemetry = Telemetry(
+                LangfuseExporter(langfuse) if langfuse else None,
+                max_queue=int(get_secret("TELEMETRY_QUEUE_SIZE", 1000)),
+                batch_size=int(get_secret("TELEMETRY_BATCH_SIZE", 50)),
+                flush_interval=float(get_secret("TELEMETRY_FLUSH_SECONDS", 2))
+            )
+            # Registered after the Langfuse client's flush, so it runs before it
+            atexit.register(_telemetry.flush)
+    return _telemetry
@@ -0,0 +1,167 @@
+import time
+
+import pytest
+
+import admission
+from admission import (
+    BUDGET, BUSY, DROPPED, FULL, NO_AUDIO, NORMAL, QUEUE, RELEASED, SHED, AdmissionController, AdmissionRejected, Budget
+)
+from backends import MemoryBackend
+
+
+class FakeClock:
+    """Stands in for the time module: monotonic() only moves when the test says so."""
+
+    gmtime = staticmethod(time.gmtime)
+    strftime = staticmethod(time.strftime)
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(admission, "time", clock)
+    return clock
+
+
+def rejection(controller, owner, **kwargs):
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.request(owner, "story", **kwargs)
+    return rejected.value.reason
+
+
+def test_tickets_queue_at_capacity_and_are_admitted_in_order(clock):
+    controller = AdmissionController(max_running=2, max_queue=5, no_audio_at=0.5)
+    first, second = controller.request("a", "story"), controller.request("b", "story")
+    assert first.admitted and second.admitted
+    # The second slot was the last one under no_audio_at: that story comes without narration
+    assert first.with_audio and not second.with_audio
+    third, fourth = controller.request("c", "story"), controller.request("d", "story")
+    assert [controller.poll(ticket) for ticket in (first, third, fourth)] == [0, 1, 2]
+
+    clock.now += 10
+    controller.release(first)
+    assert first.status == RELEASED and controller.poll(first) is None
+    assert controller.poll(third) == 0 and third.waited == pytest.approx(10)
+    assert controller.poll(fourth) == 1
+    assert controller.stats() == {"running": 2, "waiting": 1}
+
+
+def test_requests_are_rejected_when_the_queue_is_full_or_not_wanted(clock):
+    controller = AdmissionController(max_running=1, max_queue=1)
+    controller.request("a", "story")
+    assert rejection(controller, "b", wait=False) == FULL
+    controller.request("b", "story")
+    assert rejection(controller, "c") == FULL
+    assert controller.stats() == {"running": 1, "waiting": 1}
+
+
+def test_requests_are_rejected_when_the_wait_estimate_is_too_long(clock):
+    controller = AdmissionController(max_running=1, max_queue=20, max_wait=90, service_seconds=60)
+    controller.request("a", "story")
+    assert controller.request("b", "story").status == admission.WAITING
+    # Second in line would wait about 120s
+    assert rejection(controller, "c") == FULL
+    assert controller.estimated_wait(2) == pytest.approx(120)
+
+
+def test_one_ticket_per_owner(clock):
+    controller = AdmissionController(max_running=4)
+    ticket = controller.request("a", "story")
+    assert rejection(controller, "a") == BUSY
+    controller.release(ticket)
+    controller.release(ticket)
+    assert controller.request("a", "audio").admitted
+
+
+def test_level_degrades_step_by_step(clock):
+    controller = AdmissionController(max_running=2, max_queue=1, no_audio_at=0.5)
+    levels = [controller.level()]
+    for owner in "abc":
+        controller.request(owner, "story")
+        levels.append(controller.level())
+    assert levels == [NORMAL, NO_AUDIO, QUEUE, SHED]
+
+
+def test_closed_and_silent_pages_lose_their_place(clock):
+    controller = AdmissionController(max_running=1, max_queue=5, abandon_after=30)
+    running = controller.request("a", "story")
+    running.started = True
+    page_open = [True]
+    closed = controller.request("b", "story", alive=lambda: page_open[0])
+    silent = controller.request("c", "story")
+    waiting = controller.request("d", "story")
+
+    page_open[0] = False
+    assert controller.poll(waiting) == 2 and closed.status == DROPPED
+    clock.now += 31
+    # c never polled again; d did, just now
+    assert controller.poll(waiting) == 1 and silent.status == DROPPED
+    assert controller.request("b", "story").status == admission.WAITING
+
+
+def test_admitted_tickets_are_taken_back_when_abandoned_or_held_too_long(clock):
+    controller = AdmissionController(max_running=1, abandon_after=30, max_hold=900)
+    never_started = controller.request("a", "story")
+    clock.now += 31
+    assert controller.stats() == {"running": 0, "waiting": 0} and never_started.status == DROPPED
+
+    stuck = controller.request("b", "story")
+    stuck.started = True
+    clock.now += 600
+    assert stuck.admitted
+    clock.now += 301
+    assert controller.level() == NORMAL and stuck.status == DROPPED
+
+
+def test_run_releases_the_slot_when_the_generation_fails(clock):
+    controller = AdmissionController(max_running=1)
+    ticket = controller.request("a", "story")
+
+    def generate():
+        raise RuntimeError("API down")
+
+    with pytest.raises(RuntimeError):
+        controller.run(ticket, generate)
+    assert ticket.status == RELEASED
+    assert controller.request("b", "story").admitted
+
+
+def test_spent_budget_sheds_every_request(clock):
+    budget = Budget(MemoryBackend(), hourly_tokens=100, daily_usd=1.0, refresh=0)
+    controller = AdmissionController(max_running=4, budget=budget)
+    budget.charge(tokens=60, usd=0.5)
+    assert budget.exhausted() is None and controller.level() == NORMAL
+    budget.charge(tokens=40)
+    assert budget.exhausted() == "hour:tokens"
+    assert controller.level() == SHED
+    assert rejection(controller, "a") == BUDGET
+    assert controller.stats() == {"running": 0, "waiting": 0}
+
+
+def test_budget_is_shared_through_the_backend_after_refresh(clock):
+    backend = MemoryBackend()
+    here, there = Budget(backend, daily_usd=1.0, refresh=2), Budget(backend, daily_usd=1.0, refresh=2)
+    assert here.exhausted() is None
+    there.charge(usd=1.5)
+    # Read a moment ago - the other replica's spending shows once the cache is stale
+    assert here.exhausted() is None
+    clock.now += 2
+    assert here.exhausted() == "day:usd"
+    assert here.spent()[("hour", "usd")] == pytest.approx(1.5)
+
+
+def test_budget_without_limits_or_backend_never_stops_anything(clock):
+    class BrokenBackend(MemoryBackend):
+        def get(self, key):
+            raise ConnectionError("backend away")
+
+    assert Budget(MemoryBackend()).exhausted() is None
+    budget = Budget(BrokenBackend(), hourly_tokens=1, refresh=0)
+    budget.charge(tokens=5)
+    assert budget.exhausted() is None
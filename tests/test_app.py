@@ -0,0 +1,81 @@
+"""The Streamlit app driven with AppTest, without any API calls: stories come from the pool."""
+import json
+import os
+import tempfile
+import time
+
+import pytest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app_demo_voice.py")
+
+
+@pytest.fixture(scope="module")
+def app_env():
+    data_dir = tempfile.mkdtemp(prefix="bajki-test-")
+    env = {
+        # Nothing listens there - a story that misses the pool fails instead of calling OpenAI
+        "OPENAI_BASE_URL": "http://127.0.0.1:9/v1",
+        "OPENAI_API_KEY": "test",
+        "AUDIO_CACHE_DIR": os.path.join(data_dir, "audio"),
+        "LIBRARY_PATH": os.path.join(data_dir, "library.sqlite3"),
+        "POOL_ENABLED": "1",
+        # No background refills - the test fills the pool itself
+        "POOL_DEPTH": "0",
+        "PREFETCH_ENABLED": "0",
+    }
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    yield
+    for name, value in saved.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+
+def fill_pool(key, child_name, *contents):
+    """Pooled stories for key, with their narrations for child_name cached - no TTS calls either."""
+    from audio_cache import get_audio_cache
+    from audio_pipeline import AUDIO_MIME_TYPES
+    from backends import get_backend
+    from story_engine import narration_cache_key
+    from story_pool import fill_template
+
+    for content in contents:
+        get_backend().push("pool:" + "|".join(key), json.dumps(
+            {"id": os.urandom(8).hex(), "content": content, "created_at": time.time(), "serves": 0},
+            ensure_ascii=False
+        ))
+        for fmt in AUDIO_MIME_TYPES:
+            get_audio_cache().put(narration_cache_key(fill_template(content, child_name), fmt), b"audio")
+
+
+def open_generator():
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=30)
+    at.run()
+    at.button(key="enter_app").click().run()
+    return at
+
+
+def test_new_story_for_an_empty_idea_comes_from_the_pool_again(app_env):
+    at = open_generator()
+    at.text_input(key="child_name_input").input("Zosia").run()
+    key = (at.session_state["child_age_input"], at.session_state["lesson_input"], "f")
+    fill_pool(
+        key, "Zosia",
+        "{{IMIE}} poszła do lasu. Tam {{IMIE}} spotkała liska.",
+        "{{IMIE}} wspięła się na górę. Na szczycie {{IMIE}} zobaczyła tęczę.",
+    )
+
+    at.button(key="generate_story").click().run()
+    first = at.session_state["current_story"]
+    assert first["pooled"] and first["content"].startswith("Zosia")
+
+    [new_story] = [button for button in at.button if button.label == "🔄 Nowa bajka"]
+    new_story.click().run()
+    assert at.session_state["user_prompt"] == ""
+    second = at.session_state["current_story"]
+    assert second["pooled"] and second["content"] != first["content"]
+    assert not at.exception
@@ -0,0 +1,30 @@
+import os
+
+from audio_cache import SHARED_PART_BYTES, AudioCache
+from backends import SQLiteBackend
+
+
+def replicas(tmp_path):
+    """Two caches with their own directories on one shared backend."""
+    backend = SQLiteBackend(str(tmp_path / "backend.sqlite3"))
+    return (AudioCache(str(tmp_path / name), 10 * 1024 * 1024, backend=backend) for name in ("a", "b"))
+
+
+def test_narration_is_shared_in_parts(tmp_path):
+    first, second = replicas(tmp_path)
+    data = os.urandom(2 * SHARED_PART_BYTES + 1000)
+    first.put_stream("story.mp3", lambda f: f.write(data))
+    assert first.backend.get("audio:story.mp3:parts") == b"3"
+    assert all(len(first.backend.get(f"audio:story.mp3:{n}")) <= SHARED_PART_BYTES for n in range(3))
+    path = second.path("story.mp3")
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert second.stats()["shared_hits"] == 1
+
+
+def test_a_missing_part_is_a_miss_and_leaves_no_file(tmp_path):
+    first, second = replicas(tmp_path)
+    first.put("story.mp3", os.urandom(SHARED_PART_BYTES + 1))
+    first.backend.delete("audio:story.mp3:1")
+    assert second.get("story.mp3") is None
+    assert os.listdir(second.directory) == []
@@ -0,0 +1,118 @@
+import io
+import struct
+
+import pytest
+
+from audio_pipeline import MAX_TTS_CHARS, join_audio, split_for_tts, write_audio
+
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz, no padding: 144000 * 128 // 44100 = 417 bytes
+MP3_HEADER = b"\xff\xfb\x90\x00"
+MP3_FRAME = 417
+
+
+def test_split_for_tts_keeps_every_chunk_within_the_limit_and_loses_no_words():
+    text = (
+        "Dawno temu żył sobie smok. " * 40 + "\n\n"
+        + "bardzo długie zdanie bez kropki, " * 200 + "\n\n"
+        + "słowo" * 1000 + " Koniec."
+    )
+    for target in (100, 600, MAX_TTS_CHARS):
+        chunks = split_for_tts(text, target)
+        assert all(0 < len(chunk) <= MAX_TTS_CHARS for chunk in chunks)
+        assert all(chunk == chunk.strip() for chunk in chunks)
+        assert "".join(chunks).replace(" ", "").replace("\n", "") == text.replace(" ", "").replace("\n", "")
+
+
+def test_split_for_tts_of_blank_text_is_empty():
+    assert split_for_tts("") == []
+    assert split_for_tts(" \n\n ") == []
+
+
+def mp3_segment(frames, fill):
+    id3 = b"ID3\x04\x00\x00" + bytes([0, 0, 0, 20]) + b"\x00" * 20
+    xing = MP3_HEADER + b"\x00" * 32 + b"Xing" + b"\x00" * (MP3_FRAME - 40)
+    audio = b"".join(MP3_HEADER + bytes([fill]) * (MP3_FRAME - 4) for _ in range(frames))
+    id3v1 = b"TAG" + b"\x00" * 125
+    return id3 + xing + audio + id3v1
+
+
+def test_mp3_join_keeps_only_the_audio_frames():
+    joined = join_audio([mp3_segment(3, 1), mp3_segment(2, 2), mp3_segment(4, 3)], "mp3")
+    assert len(joined) == 9 * MP3_FRAME
+    frames = [joined[n:n + MP3_FRAME] for n in range(0, len(joined), MP3_FRAME)]
+    assert all(frame.startswith(MP3_HEADER) for frame in frames)
+    assert [frame[4] for frame in frames] == [1, 1, 1, 2, 2, 3, 3, 3, 3]
+
+
+def test_single_segment_is_copied_unchanged_from_a_file():
+    segment = mp3_segment(2, 1)
+    out = io.BytesIO()
+    write_audio([io.BytesIO(segment)], out, "mp3")
+    assert out.getvalue() == segment
+
+
+def test_formats_that_cannot_be_joined_are_refused():
+    with pytest.raises(ValueError):
+        join_audio([b"RIFF1", b"RIFF2"], "wav")
+
+
+def reference_ogg_crc(page):
+    """Straightforward bitwise CRC-32 of Ogg (poly 0x04C11DB7, no reflection, no xor)."""
+    crc = 0
+    for byte in page:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+            crc &= 0xFFFFFFFF
+    return crc
+
+
+def ogg_page(serial, sequence, granule, flags, packets):
+    table = b"".join(bytes([255] * (len(packet) // 255) + [len(packet) % 255]) for packet in packets)
+    page = bytearray(b"OggS" + struct.pack("<BBqIII", 0, flags, granule, serial, sequence, 0)
+                     + bytes([len(table)]) + table + b"".join(packets))
+    struct.pack_into("<I", page, 22, reference_ogg_crc(page))
+    return bytes(page)
+
+
+def opus_segment(serial, granules, fill):
+    pages = [
+        ogg_page(serial, 0, 0, 0x02, [b"OpusHead" + b"\x01" * 11]),
+        ogg_page(serial, 1, 0, 0, [b"OpusTags" + b"\x00" * 300]),
+    ]
+    for index, granule in enumerate(granules):
+        flags = 0x04 if index == len(granules) - 1 else 0
+        pages.append(ogg_page(serial, index + 2, granule, flags, [bytes([fill]) * 100, bytes([fill]) * 300]))
+    return b"".join(pages)
+
+
+def parse_pages(data):
+    pages, position = [], 0
+    while position < len(data):
+        assert data[position:position + 4] == b"OggS"
+        flags, granule, serial, sequence, crc = struct.unpack_from("<BqIII", data, position + 5)
+        table = data[position + 27:position + 27 + data[position + 26]]
+        end = position + 27 + len(table) + sum(table)
+        page = bytearray(data[position:end])
+        struct.pack_into("<I", page, 22, 0)
+        pages.append({"flags": flags, "granule": granule, "serial": serial, "sequence": sequence,
+                      "crc_ok": crc == reference_ogg_crc(page), "body": bytes(page[27 + len(table):])})
+        position = end
+    return pages
+
+
+def test_opus_join_makes_one_logical_stream_with_valid_pages():
+    segments = [opus_segment(111, [960, 1920], 1), opus_segment(222, [960], 2), opus_segment(333, [960, 1920], 3)]
+    pages = parse_pages(join_audio(segments, "opus"))
+    # The headers of the later segments are dropped
+    assert len(pages) == 2 + 2 + 1 + 2
+    assert sum(page["body"].startswith(b"OpusHead") for page in pages) == 1
+    assert sum(b"OpusTags" in page["body"] for page in pages) == 1
+    assert {page["serial"] for page in pages} == {111}
+    assert [page["sequence"] for page in pages] == list(range(len(pages)))
+    assert all(page["crc_ok"] for page in pages)
+    # Beginning of stream on the first page only, end of stream on the last only
+    assert [page["flags"] & 0x02 for page in pages] == [0x02] + [0] * (len(pages) - 1)
+    assert [page["flags"] & 0x04 for page in pages] == [0] * (len(pages) - 1) + [0x04]
+    # Granule positions continue across the joins
+    assert [page["granule"] for page in pages[2:]] == [960, 1920, 2880, 3840, 4800]
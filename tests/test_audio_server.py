@@ -0,0 +1,78 @@
+import http.client
+
+import pytest
+
+from audio_server import parse_range, start_audio_server
+
+SIZE = 1000
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=0-0", (0, 0)),
+    (" bytes=10-19 ", (10, 19)),
+    # Suffix ranges: the last N bytes, the whole file when N is larger
+    ("bytes=-500", (500, 999)),
+    ("bytes=-5000", (0, 999)),
+    # Open-ended and overlong ranges run to the end of the file
+    ("bytes=100-", (100, 999)),
+    ("bytes=999-", (999, 999)),
+    ("bytes=900-5000", (900, 999)),
+    # Malformed or unsupported headers fall back to the whole file
+    (None, None),
+    ("", None),
+    ("bytes=-", None),
+    ("bytes=abc", None),
+    ("bytes=1-2-3", None),
+    ("items=0-99", None),
+    ("bytes=0-1,5-6", None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, SIZE) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=5000-6000", "bytes=50-10", "bytes=-0"])
+def test_unsatisfiable_ranges_raise(header):
+    with pytest.raises(ValueError):
+        parse_range(header, SIZE)
+
+
+def test_empty_file_satisfies_no_range():
+    with pytest.raises(ValueError):
+        parse_range("bytes=-500", 0)
+
+
+@pytest.fixture
+def server(tmp_path):
+    digest = "ab" * 32
+    (tmp_path / f"{digest}.mp3").write_bytes(bytes(range(256)) * 4)
+    server = start_audio_server(str(tmp_path), host="127.0.0.1", port=0)
+    yield server, f"/audio/{digest}.mp3"
+    server.shutdown()
+
+
+def fetch(server, path, headers=None):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=5)
+    try:
+        connection.request("GET", path, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize("header, status, content_range, body", [
+    (None, 200, None, (0, 1023)),
+    ("bytes=-24", 206, "bytes 1000-1023/1024", (1000, 1023)),
+    ("bytes=1000-", 206, "bytes 1000-1023/1024", (1000, 1023)),
+    ("bytes=2000-", 416, "bytes */1024", None),
+    ("garbage", 200, None, (0, 1023)),
+])
+def test_server_answers_ranges(server, header, status, content_range, body):
+    server, path = server
+    code, headers, data = fetch(server, path, {"Range": header} if header else None)
+    assert code == status
+    assert headers.get("Content-Range") == content_range
+    expected = (bytes(range(256)) * 4)[body[0]:body[1] + 1] if body else b""
+    assert data == expected
+    assert headers["Content-Length"] == str(len(expected))
@@ -0,0 +1,95 @@
+"""RedisBackend against a real server: REDIS_URL=redis://localhost:6379/15 python -m pytest tests
+
+Keys get a per-run prefix and are deleted afterwards, but use a database
+nothing else lives in.
+"""
+import os
+import socket
+import uuid
+
+import pytest
+
+from backends import RedisBackend
+from story_library import BackendStoryLibrary
+
+REDIS_URL = os.environ.get("REDIS_URL")
+
+pytestmark = pytest.mark.skipif(not REDIS_URL, reason="REDIS_URL not set")
+
+
+@pytest.fixture
+def backend():
+    backend = RedisBackend(REDIS_URL, prefix=f"bajki-test-{uuid.uuid4().hex}:")
+    keys = []
+    backend.track = keys.append
+    yield backend
+    for key in keys:
+        backend.delete(key)
+
+
+def test_get_set_delete_and_add(backend):
+    backend.track("kv")
+    assert backend.get("kv") is None
+    backend.set("kv", "zażółć")
+    assert backend.get("kv") == "zażółć".encode("utf-8")
+    assert not backend.add("kv", b"other")
+    backend.delete("kv")
+    assert backend.add("kv", b"other", ttl=60)
+    assert backend.get("kv") == b"other"
+
+
+def test_json_round_trip(backend):
+    backend.track("json")
+    backend.set_json("json", {"imię": "Zosia", "wiek": 6}, ttl=60)
+    assert backend.get_json("json") == {"imię": "Zosia", "wiek": 6}
+
+
+def test_push_pop_keeps_fifo_order(backend):
+    backend.track("queue")
+    for value in (b"a", b"b", b"c"):
+        backend.push("queue", value)
+    assert backend.length("queue") == 3
+    assert backend.items("queue") == [b"a", b"b", b"c"]
+    assert [backend.pop("queue") for _ in range(4)] == [b"a", b"b", b"c", None]
+    assert backend.length("queue") == 0
+
+
+def test_incr_counts_and_sets_ttl_once(backend):
+    backend.track("counter")
+    assert backend.incr("counter", 1.5, ttl=60) == 1.5
+    assert backend.incr("counter", 2, ttl=1) == 3.5
+    ttl_ms = backend.command("PTTL", backend.prefix + "counter")
+    # The ttl of the first incr stays
+    assert 1000 < ttl_ms <= 60000
+
+
+def test_reserve_and_refund(backend):
+    backend.track("bucket")
+    # Capacity 2, refilled at 1 token per second
+    assert backend.reserve("bucket", 1, 1.0, 2) == (True, 0.0)
+    assert backend.reserve("bucket", 1, 1.0, 2) == (True, 0.0)
+    granted, wait = backend.reserve("bucket", 1, 1.0, 2, max_wait=0.1)
+    assert not granted and 0.5 < wait <= 1.0
+    backend.refund("bucket", 1, 2)
+    granted, wait = backend.reserve("bucket", 1, 1.0, 2, max_wait=0.1)
+    assert granted and wait == 0.0
+
+
+def test_stale_pooled_connection_is_replaced(backend):
+    backend.track("kv")
+    backend.set("kv", b"1")
+    # The server side of the pooled connection goes away (idle timeout, restart)
+    for connection in backend._idle:
+        connection.sock.shutdown(socket.SHUT_RDWR)
+    assert backend.get("kv") == b"1"
+
+
+def test_story_library_in_redis(backend):
+    library = BackendStoryLibrary(backend)
+    owner = uuid.uuid4().hex
+    backend.track("library:next_id")
+    story_id = library.add(owner, {"content": "Zosia spotkała smoka.", "child_name": "Zosia", "lesson": "Odwaga"})
+    assert [row["id"] for row in library.page(owner, query="smok")] == [story_id]
+    assert library.get(owner, story_id)["content"] == "Zosia spotkała smoka."
+    library.delete_owner(owner)
+    assert library.page(owner) == [] and library.get(owner, story_id) is None
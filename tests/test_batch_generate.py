@@ -0,0 +1,31 @@
+import csv
+
+from batch_generate import read_manifest
+
+ROWS = [
+    {"name": "Zosia", "age": "3-5", "lesson": "Odwaga", "prompt": "smok"},
+    {"name": "Janek", "age": "6-8", "lesson": "Przyjaźń", "prompt": ""},
+    {"name": "Zosia", "age": "3-5", "lesson": "Odwaga", "prompt": "smok"},
+]
+
+
+def write_csv(path, rows):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["id", "name", "age", "lesson", "prompt"])
+        writer.writeheader()
+        writer.writerows(rows)
+    return str(path)
+
+
+def test_row_ids_survive_rows_inserted_before_them(tmp_path):
+    before = [row["id"] for row in read_manifest(write_csv(tmp_path / "a.csv", ROWS))]
+    inserted = {"name": "Ola", "age": "9-12", "lesson": "Uczciwość", "prompt": "rakieta"}
+    after = [row["id"] for row in read_manifest(write_csv(tmp_path / "b.csv", [inserted] + ROWS))]
+    assert after[1:] == before
+
+
+def test_identical_rows_get_different_ids_and_explicit_ids_win(tmp_path):
+    rows = read_manifest(write_csv(tmp_path / "a.csv", ROWS + [dict(ROWS[1], id="moje-id")]))
+    assert rows[0]["id"] != rows[2]["id"]
+    assert rows[3]["id"] == "moje-id"
+    assert rows[0]["age"] == "3-5 lat"
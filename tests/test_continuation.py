@@ -0,0 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from audio_pipeline import NarrationPipeline
+from safety import StreamGuard, UnsafeContentError
+from story_engine import continuation_start, finish_text, join_continuation
+
+FIRST = "Ala miała kota.\n\nKot miał Alę.\n\nPotem obo"
+MORE = " Zasnęli razem. Koniec bajki. "
+
+
+def test_narration_after_continuation_skips_nothing():
+    sent = []
+    executor = ThreadPoolExecutor(1)
+    narration = NarrationPipeline(sent.append, min_chars=1, executor=executor)
+    narration.feed(FIRST)
+    content = finish_text(FIRST, "length")
+    narration.continue_at(continuation_start(content))
+    joined = join_continuation(content, MORE)
+    narration.feed(joined)
+    executor.shutdown(wait=True)
+    assert sent == ["Ala miała kota.", "Kot miał Alę.", "Zasnęli razem.", "Koniec bajki."]
+
+
+def test_guard_checks_continuation_from_its_first_word():
+    # The joined story is two characters shorter than content was
+    content = "Ala miała kota.\n\n\n\n"
+    guard = StreamGuard(continuation_start(content))
+    with pytest.raises(UnsafeContentError):
+        guard.feed(join_continuation(content, "Zabił smoka. "))
@@ -0,0 +1,174 @@
+import asyncio
+from datetime import datetime, timezone
+from email.utils import format_datetime
+
+import httpx
+import openai
+import pytest
+
+import backends
+import ratelimit
+from backends import MemoryBackend
+from ratelimit import (
+    RateLimiter, RateLimitTimeout, TokenBucket, backoff_delay, call_with_retry, call_with_retry_async, retry_after
+)
+
+
+class FakeClock:
+    """Stands in for the time module: sleeping only moves the clock on."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    async def async_sleep(self, seconds):
+        self.sleep(seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(backends, "time", clock)
+    monkeypatch.setattr(ratelimit, "time", clock)
+    monkeypatch.setattr(ratelimit.asyncio, "sleep", clock.async_sleep)
+    # No jitter, so delays can be compared exactly
+    monkeypatch.setattr(ratelimit.random, "uniform", lambda low, high: high)
+    return clock
+
+
+def api_error(status, headers=None, code=None):
+    response = httpx.Response(status, headers=headers, request=httpx.Request("POST", "https://api.openai.com/v1"))
+    body = {"code": code} if code else None
+    return openai.APIStatusError("error", response=response, body=body)
+
+
+def test_bucket_serves_the_burst_then_makes_callers_wait(clock):
+    bucket = TokenBucket(per_minute=60, burst=2)
+    assert bucket.reserve(1) == 0.0
+    assert bucket.reserve(1) == 0.0
+    # One token a second: the third caller waits one second, the fourth two
+    assert bucket.reserve(1) == pytest.approx(1.0)
+    assert bucket.reserve(1) == pytest.approx(2.0)
+
+
+def test_bucket_refills_with_time_up_to_its_capacity(clock):
+    bucket = TokenBucket(per_minute=60, burst=2)
+    bucket.reserve(2)
+    clock.now += 1.5
+    assert bucket.reserve(1) == 0.0
+    clock.now += 3600
+    assert bucket.reserve(2) == 0.0
+    assert bucket.reserve(1) == pytest.approx(1.0)
+
+
+def test_bucket_refuses_a_wait_over_max_wait_without_taking_tokens(clock):
+    bucket = TokenBucket(per_minute=60, burst=1)
+    bucket.reserve(1)
+    with pytest.raises(RateLimitTimeout) as refused:
+        bucket.reserve(1, max_wait=0.5)
+    assert refused.value.wait == pytest.approx(1.0)
+    assert bucket.reserve(1, max_wait=1.0) == pytest.approx(1.0)
+
+
+def test_unlimited_bucket_never_waits(clock):
+    bucket = TokenBucket(per_minute=0)
+    assert all(bucket.reserve(10 ** 6) == 0.0 for _ in range(3))
+
+
+def test_limiter_gives_the_request_back_when_the_token_budget_refuses(clock):
+    limiter = RateLimiter(rpm=2, tpm=600, max_wait=1.0, backend=MemoryBackend())
+    assert limiter.reserve(tokens=600) == 0.0
+    with pytest.raises(RateLimitTimeout):
+        limiter.reserve(tokens=600)
+    # The second request was refunded, so the last one of the burst still goes through at once
+    assert limiter.reserve(tokens=0) == 0.0
+
+
+def test_limiter_acquire_sleeps_the_reserved_wait(clock):
+    limiter = RateLimiter(rpm=60, tpm=0, backend=MemoryBackend())
+    for _ in range(61):
+        limiter.acquire()
+    assert clock.sleeps == [pytest.approx(1.0)]
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"retry-after": "3"}, 3.0),
+    ({"retry-after-ms": "1500"}, 1.5),
+    ({"retry-after": "soon"}, None),
+    ({}, None),
+])
+def test_retry_after_headers(clock, headers, expected):
+    assert retry_after(api_error(429, headers)) == expected
+
+
+def test_retry_after_http_date(clock):
+    date = format_datetime(datetime.fromtimestamp(clock.now + 20, timezone.utc), usegmt=True)
+    assert retry_after(api_error(429, {"retry-after": date})) == pytest.approx(20, abs=1)
+
+
+def test_backoff_doubles_up_to_the_cap_and_follows_retry_after(clock):
+    error = api_error(503)
+    assert [backoff_delay(error, attempt) for attempt in range(4)] == [0.5, 1.0, 2.0, 4.0]
+    assert backoff_delay(error, 10) == 30.0
+    assert backoff_delay(api_error(429, {"retry-after": "7"}), 0) == 7.5
+    assert backoff_delay(api_error(429, {"retry-after": "600"}), 0) == 30.5
+
+
+def flaky(errors, result="ok"):
+    calls = []
+
+    def call():
+        calls.append(None)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+
+    return call, calls
+
+
+def test_call_with_retry_retries_retryable_errors_with_backoff(clock):
+    call, calls = flaky([api_error(429, {"retry-after": "2"}), api_error(503)])
+    limiter = RateLimiter(rpm=0, backend=MemoryBackend())
+    assert call_with_retry(call, limiter=limiter, attempts=5) == "ok"
+    assert len(calls) == 3
+    assert clock.sleeps == [2.5, 1.0]
+
+
+def test_call_with_retry_gives_up_after_the_last_attempt(clock):
+    call, calls = flaky([api_error(500)] * 5)
+    with pytest.raises(openai.APIStatusError):
+        call_with_retry(call, attempts=3)
+    assert len(calls) == 3 and len(clock.sleeps) == 2
+
+
+@pytest.mark.parametrize("error", [api_error(400), api_error(429, code="insufficient_quota"), ValueError("bug")])
+def test_call_with_retry_does_not_retry_what_waiting_cannot_fix(clock, error):
+    call, calls = flaky([error])
+    with pytest.raises(type(error)):
+        call_with_retry(call, attempts=5)
+    assert len(calls) == 1 and clock.sleeps == []
+
+
+def test_async_call_with_retry_retries_and_waits_for_the_budget(clock):
+    call, calls = flaky([api_error(502)])
+    limiter = RateLimiter(rpm=60, backend=MemoryBackend())
+    for _ in range(60):
+        limiter.reserve()
+
+    async def acall():
+        return call()
+
+    assert asyncio.run(call_with_retry_async(acall, limiter=limiter, attempts=3)) == "ok"
+    assert len(calls) == 2
+    # Waited a second for the budget, backed off 0.5s, then waited for the budget again
+    assert clock.sleeps == [pytest.approx(1.0), 0.5, pytest.approx(0.5)]
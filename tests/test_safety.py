@@ -0,0 +1,49 @@
+import pytest
+
+from safety import StreamGuard, UnsafeContentError, check_prompt, find_violation, is_gibberish
+
+
+@pytest.mark.parametrize("prompt", [
+    "Zosia zabiła smoka",
+    "Śmierć starego króla",
+    "smierc krola",
+    "Pijany pirat na statku",
+    "Rycerz pije wódkę",
+    "Przemoc w szkole",
+    "Krew na mieczu",
+    "Smok torturował księżniczkę",
+])
+def test_forbidden_topics_are_blocked(prompt):
+    assert find_violation(prompt)
+    assert check_prompt(prompt, "Zosia")
+
+
+@pytest.mark.parametrize("prompt", [
+    "Janek chce pobić rekord",
+    "Rekord został pobity",
+    "Bez zwłoki ruszyli w drogę",
+    "Smok umiera ze śmiechu",
+    "Serce bijące jak dzwon",
+    "Krewny z daleka przyjechał",
+    "Zosia upiła łyk soku",
+    "Pstrąg i chrząszcz",
+    "WWF ratuje pandy",
+    "Bezwzględny rycerz wszczął alarm",
+    "",
+])
+def test_ordinary_polish_passes(prompt):
+    assert check_prompt(prompt, "Zosia") is None
+
+
+@pytest.mark.parametrize("prompt", ["asdfghjkl", "fjdksla fjdksla", "aaaaaaaaa", "!!!???"])
+def test_keyboard_mashing_is_gibberish(prompt):
+    assert is_gibberish(prompt)
+    assert check_prompt(prompt)
+
+
+def test_stream_guard_lets_idioms_through_and_stops_at_a_forbidden_word():
+    guard = StreamGuard()
+    story = "Janek chciał pobić rekord. Bez zwłoki pobiegł. "
+    assert guard.feed(story) == story
+    with pytest.raises(UnsafeContentError):
+        guard.feed(story + "Potem zabił smoka.")
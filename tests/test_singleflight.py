@@ -0,0 +1,121 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from singleflight import SingleFlight
+
+CALLERS = 8
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def run_together(flight, fn, key="key", on_update=None):
+    """CALLERS threads call flight.do(key, fn) while the first call is still running."""
+    def call():
+        try:
+            return flight.do(key, fn, on_update)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(CALLERS) as executor:
+        return list(executor.map(lambda _: call(), range(CALLERS)))
+
+
+def blocking(release, outcome):
+    runs = []
+
+    def fn(update):
+        runs.append(None)
+        release.wait(5)
+        return outcome(update)
+
+    return fn, runs
+
+
+def release_when_all_joined(flight, release):
+    threading.Thread(
+        target=lambda: (wait_for(lambda: flight.stats()["shared"] == CALLERS - 1), release.set()), daemon=True
+    ).start()
+
+
+def test_concurrent_callers_share_one_execution_and_its_result():
+    flight, release = SingleFlight(), threading.Event()
+    fn, runs = blocking(release, lambda update: {"story": "Bajka"})
+    release_when_all_joined(flight, release)
+    results = run_together(flight, fn)
+    assert len(runs) == 1
+    assert all(result is results[0] for result in results) and results[0] == {"story": "Bajka"}
+    assert flight.stats() == {"in_flight": 0, "leaders": 1, "shared": CALLERS - 1}
+
+
+def test_concurrent_callers_all_receive_the_exception():
+    flight, release = SingleFlight(), threading.Event()
+    error = RuntimeError("upstream 500")
+
+    def fail(update):
+        raise error
+
+    fn, runs = blocking(release, fail)
+    release_when_all_joined(flight, release)
+    results = run_together(flight, fn)
+    assert len(runs) == 1
+    assert all(result is error for result in results)
+
+
+def test_followers_receive_the_leaders_partial_results():
+    flight, release = SingleFlight(), threading.Event()
+    seen = []
+
+    def stream(update):
+        update("Dawno")
+        update("Dawno temu")
+        return "Dawno temu był smok."
+
+    fn, runs = blocking(release, stream)
+    release_when_all_joined(flight, release)
+    results = run_together(flight, fn, on_update=seen.append)
+    assert results == ["Dawno temu był smok."] * CALLERS
+    # Followers may skip intermediate versions, never the last one
+    assert seen.count("Dawno temu") >= 1 and set(seen) <= {"Dawno", "Dawno temu"}
+
+
+def test_different_keys_run_separately():
+    flight = SingleFlight()
+    assert flight.do("a", lambda update: 1) == 1
+    assert flight.do("b", lambda update: 2) == 2
+    assert flight.stats()["leaders"] == 2
+
+
+def test_a_follower_runs_the_call_itself_when_the_leader_is_interrupted():
+    flight, release = SingleFlight(), threading.Event()
+
+    class Stopped(BaseException):
+        pass
+
+    def leader(update):
+        release.wait(5)
+        raise Stopped()
+
+    errors = []
+
+    def lead():
+        try:
+            flight.do("key", leader)
+        except Stopped as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=lead)
+    thread.start()
+    wait_for(lambda: flight.stats()["in_flight"] == 1)
+    with ThreadPoolExecutor(1) as executor:
+        follower = executor.submit(flight.do, "key", lambda update: "ok")
+        wait_for(lambda: flight.stats()["shared"] == 1)
+        release.set()
+        assert follower.result(5) == "ok"
+    thread.join(5)
+    assert len(errors) == 1
@@ -0,0 +1,54 @@
+import pytest
+
+from backends import MemoryBackend, SQLiteBackend
+from story_library import BackendStoryLibrary, StoryLibrary
+
+
+@pytest.fixture(params=["sqlite", "memory-backend", "sqlite-backend"])
+def library(request, tmp_path):
+    if request.param == "sqlite":
+        return StoryLibrary(str(tmp_path / "library.sqlite3"))
+    if request.param == "memory-backend":
+        return BackendStoryLibrary(MemoryBackend())
+    # Two replicas on one shared backend see the same library
+    BackendStoryLibrary(SQLiteBackend(str(tmp_path / "backend.sqlite3")))
+    return BackendStoryLibrary(SQLiteBackend(str(tmp_path / "backend.sqlite3")))
+
+
+def story(content, child_name="Zosia", **extra):
+    return dict({'content': content, 'child_name': child_name, 'child_age': "5-6 lat", 'lesson': "Przyjaźń",
+                 'prompt': "Magiczna przygoda", 'raw_prompt': "", 'timestamp': "2026-10-18 12:00"}, **extra)
+
+
+def test_stories_are_listed_newest_first_page_by_page(library):
+    ids = [library.add("owner", story(f"Bajka numer {number}.")) for number in range(7)]
+    library.add("someone-else", story("Cudza bajka."))
+    first = library.page("owner", limit=5)
+    assert [row['id'] for row in first] == ids[:1:-1]
+    assert first[0]['preview'] == "Bajka numer 6."
+    second = library.page("owner", before_id=first[-1]['id'], limit=5)
+    assert [row['id'] for row in second] == ids[1::-1]
+
+
+def test_search_matches_word_prefixes_without_diacritics(library):
+    dragon = library.add("owner", story("Zosia spotkała smoka w górach."))
+    library.add("owner", story("Janek płynął łódką po jeziorze.", child_name="Janek"))
+    assert [row['id'] for row in library.page("owner", query="smok gorach")] == [dragon]
+    assert [row['id'] for row in library.page("owner", query="ZOSI")] == [dragon]
+    assert library.page("owner", query="rakieta") == []
+
+
+def test_get_returns_the_whole_story_to_its_owner_only(library):
+    story_id = library.add("owner", story("Zosia i lisek.", pooled=True))
+    loaded = library.get("owner", story_id)
+    assert loaded['content'] == "Zosia i lisek." and loaded['pooled'] and loaded['raw_prompt'] == ""
+    assert loaded['library_id'] == story_id
+    assert library.get("someone-else", story_id) is None
+
+
+def test_delete_owner_removes_only_their_stories(library):
+    mine = library.add("owner", story("Moja bajka."))
+    theirs = library.add("someone-else", story("Cudza bajka."))
+    library.delete_owner("owner")
+    assert library.page("owner") == [] and library.get("owner", mine) is None
+    assert library.get("someone-else", theirs) is not None
@@ -0,0 +1,16 @@
+from story_pool import fill_template, is_valid_template
+
+
+def test_template_with_nominative_placeholders_is_valid():
+    content = "{{IMIE}} poszedł do lasu. Tam {{IMIE}} spotkał liska, który został jego przyjacielem."
+    assert is_valid_template(content)
+    assert fill_template(content, "Janek").startswith("Janek poszedł")
+
+
+def test_template_with_inflected_placeholder_is_rejected():
+    content = "{{IMIE}} poszedł do lasu. Lisek dał {{IMIE}}owi jabłko. Potem {{IMIE}}a zaprosili na ucztę."
+    assert not is_valid_template(content)
+
+
+def test_template_with_single_placeholder_is_rejected():
+    assert not is_valid_template("{{IMIE}} poszedł do lasu i wrócił do domu.")
@@ -0,0 +1,32 @@
+import logging
+
+from telemetry import Telemetry
+
+
+def failing_exporter(batch):
+    raise AttributeError("'Langfuse' object has no attribute 'trace'")
+
+
+def test_export_failures_are_counted_and_logged_once_per_interval(caplog):
+    # No background thread - batches are exported by flush()
+    telemetry = Telemetry(None)
+    telemetry.exporter = failing_exporter
+    with caplog.at_level(logging.WARNING, logger="telemetry"):
+        for number in range(3):
+            telemetry.submit(telemetry.trace(f"story-{number}"))
+            telemetry.flush()
+    assert telemetry.stats()["export_errors"] == 3
+    [record] = caplog.records
+    assert record.exc_info and "has no attribute 'trace'" in caplog.text
+
+
+def test_exported_traces_are_counted():
+    batches = []
+    telemetry = Telemetry(None, batch_size=10)
+    telemetry.exporter = batches.append
+    with telemetry.trace("story", user_id="demo_user") as trace:
+        with trace.span("prompt_build"):
+            pass
+    telemetry.flush()
+    assert telemetry.stats()["exported"] == 1
+    assert [span["name"] for span in batches[0][0].spans] == ["prompt_build"]